@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+"""
+  Usage:
+  benchmark.py [--environments N] [--instances N] [--dispatch-instances N]
+
+  Measures enviroform's own overhead against a synthetic environments tree
+  shaped like example/, with a fake terraform binary that only sleeps
+  and prints. Reports discovery time, dispatch throughput, startup
+  latency and peak RSS.
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import enviroform
+
+
+FAKE_TERRAFORM = '''#!/bin/sh
+# a stand-in for terraform: sleeps, prints, exits like terraform would
+sleep "${FAKE_TF_SLEEP:-0}"
+if [ "${FAKE_TF_LINES:-0}" -gt 0 ]; then
+  yes "fake terraform output for $1" | head -n "$FAKE_TF_LINES"
+fi
+[ "$1" = plan ] && exit "${FAKE_TF_PLAN_RC:-0}"
+exit 0
+'''
+
+CONFIG_TYPES = ['apps', 'infra']
+
+
+def generate_tree(
+    base_path: str,
+    environments: int,
+    regions: int,
+    configs: int,
+    instances: int
+) -> int:
+    """
+    Writes <base_path>/environments and <base_path>/terraform, laid out
+    like example/, with about `instances` instance .tfvars files spread
+    over the environments, regions and configs.
+    Returns the number of instances written.
+    """
+    for i in range(configs):
+        config_dir = os.path.join(
+            base_path, 'terraform',
+            CONFIG_TYPES[i % len(CONFIG_TYPES)], f'config-{i}'
+        )
+        os.makedirs(config_dir, exist_ok=True)
+        with open(os.path.join(config_dir, 'main.tf'), 'w') as f:
+            f.write('terraform {\n  backend "s3" {}\n}\n')
+
+    per_region = max(1, instances // (environments * regions * configs))
+    written = 0
+    for e in range(environments):
+        env_dir = os.path.join(base_path, 'environments', f'env-{e}')
+        os.makedirs(env_dir, exist_ok=True)
+        with open(os.path.join(env_dir, 'environment.tfvars'), 'w') as f:
+            f.write(f'env_name = "env-{e}"\n')
+        for r in range(regions):
+            region_dir = os.path.join(env_dir, f'region-{r}')
+            os.makedirs(region_dir, exist_ok=True)
+            with open(os.path.join(region_dir, 'region.tfvars'), 'w') as f:
+                f.write(f'aws_region = "region-{r}"\n')
+            with open(os.path.join(region_dir, 'backend.tfvars'), 'w') as f:
+                f.write(f'bucket = "env-{e}-region-{r}-tf-state"\n')
+            for c in range(configs):
+                tfvars_dir = os.path.join(
+                    region_dir, CONFIG_TYPES[c % len(CONFIG_TYPES)],
+                    f'config-{c}'
+                )
+                os.makedirs(tfvars_dir, exist_ok=True)
+                for n in range(per_region):
+                    name = 'default' if n == 0 else f'instance-{n}'
+                    path = os.path.join(tfvars_dir, f'{name}.tfvars')
+                    with open(path, 'w') as f:
+                        f.write(f'app_name = "{name}"\n')
+                    written += 1
+    return written
+
+
+def write_fake_terraform(base_path: str) -> str:
+    """Writes the fake terraform binary, returns its path."""
+    path = os.path.join(base_path, 'fake-terraform')
+    with open(path, 'w') as f:
+        f.write(FAKE_TERRAFORM)
+    os.chmod(path, 0o755)
+    return path
+
+
+def bench_discovery(root_path: str) -> dict:
+    """Times finding every instance with a cold, then a warm, index."""
+    index_path = os.path.join(
+        enviroform.get_state_dir(root_path), 'index.json'
+    )
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(index_path)
+    times = {}
+    for label in ['cold', 'warm']:
+        start = time.monotonic()
+        count = len(enviroform.discover_instances(
+            root_path, 'environments', 'terraform'
+        ))
+        times[f'discovery_{label}_s'] = round(time.monotonic() - start, 4)
+    times['instances'] = count
+    return times
+
+
+def bench_dispatch(
+    root_path: str, terraform_path: str, instances: int, jobs: int
+) -> dict:
+    """Runs a fleet plan over the first `instances` instances."""
+    labels = [
+        i.label for i in enviroform.discover_instances(
+            root_path, 'environments', 'terraform'
+        )[:instances]
+    ]
+    known_args, other_args = enviroform.parse_args([
+        '--environments-dir', 'environments',
+        '--terraform-dir', 'terraform',
+        '--jobs', str(jobs),
+        '--quiet',
+        '--log-dir', os.path.join(root_path, 'logs'),
+        'fleet', 'plan',
+    ])
+    fleet = enviroform.Fleet(terraform_path, root_path, known_args, other_args)
+    fleet.process_args()
+    os.makedirs(fleet.log_dir, exist_ok=True)
+    selected = [i for i in fleet.select_instances() if i.label in set(labels)]
+    start = time.monotonic()
+    with open(os.devnull, 'w') as devnull, \
+            contextlib.redirect_stdout(devnull):
+        results = fleet.schedule(selected)
+    elapsed = time.monotonic() - start
+    failed = [r for r in results if r.rc not in fleet.expected_rcs()]
+    return {
+        'dispatch_instances': len(results),
+        'dispatch_failed': len(failed),
+        'dispatch_s': round(elapsed, 4),
+        'dispatch_instances_per_s': round(len(results) / elapsed, 1),
+    }
+
+
+def bench_startup(root_path: str, terraform_path: str, runs: int) -> dict:
+    """Times `enviroform.py --dry-run plan` for one instance end to end."""
+    instance = enviroform.discover_instances(
+        root_path, 'environments', 'terraform'
+    )[0]
+    cmd = [
+        sys.executable,
+        os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                     'enviroform.py'),
+        '--dry-run',
+        '-t', instance.terraform_config_path,
+        '-z', instance.tfvars_file_path,
+        'plan',
+    ]
+    env = dict(os.environ, TERRAFORM_EXECUTABLE=terraform_path)
+    times = []
+    for _ in range(runs):
+        start = time.monotonic()
+        subprocess.run(
+            cmd, cwd=root_path, env=env, check=True,
+            stdout=subprocess.DEVNULL
+        )
+        times.append(time.monotonic() - start)
+    return {
+        'startup_median_s': round(statistics.median(times), 4),
+        'startup_max_s': round(max(times), 4),
+    }
+
+
+def peak_rss() -> dict:
+    """Peak RSS of this process and of its largest child, in MB."""
+    scale = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    return {
+        'peak_rss_mb': round(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale, 1),
+        'peak_child_rss_mb': round(
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale, 1),
+    }
+
+
+def parse_args() -> argparse.Namespace:
+    """Parses command line args."""
+    parser = argparse.ArgumentParser(
+        description='benchmark.py: measures enviroform overhead.'
+    )
+    parser.add_argument('--environments', type=int, default=50)
+    parser.add_argument('--regions', type=int, default=2)
+    parser.add_argument('--configs', type=int, default=10)
+    parser.add_argument(
+        '--instances', type=int, default=10000,
+        help='total instances in the synthetic tree'
+    )
+    parser.add_argument(
+        '--dispatch-instances', type=int, default=500,
+        help='instances to run through fleet mode'
+    )
+    parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1)
+    parser.add_argument(
+        '--startup-runs', type=int, default=10,
+        help='single runs to time startup over'
+    )
+    parser.add_argument(
+        '--tf-sleep', type=float, default=0,
+        help='seconds the fake terraform sleeps per command'
+    )
+    parser.add_argument(
+        '--tf-lines', type=int, default=0,
+        help='lines the fake terraform prints per command'
+    )
+    parser.add_argument(
+        '--work-dir',
+        help='where to generate the tree (default: a temp dir, removed)'
+    )
+    parser.add_argument('--json', help='also write the report here')
+    return parser.parse_args()
+
+
+def main() -> int:
+    """Generates a tree, runs every benchmark, prints a report."""
+    args = parse_args()
+    with contextlib.ExitStack() as stack:
+        root_path = args.work_dir or stack.enter_context(
+            tempfile.TemporaryDirectory(prefix='enviroform-bench-')
+        )
+        os.makedirs(root_path, exist_ok=True)
+        # enviroform finds its root with git
+        subprocess.run(['git', 'init', '-q', root_path], check=True)
+        os.environ['ENVIROFORM_STATE_DIR'] = os.path.join(
+            root_path, '.enviroform'
+        )
+        os.environ['FAKE_TF_SLEEP'] = str(args.tf_sleep)
+        os.environ['FAKE_TF_LINES'] = str(args.tf_lines)
+
+        start = time.monotonic()
+        written = generate_tree(
+            root_path, args.environments, args.regions, args.configs,
+            args.instances
+        )
+        report = {
+            'generated_instances': written,
+            'generate_s': round(time.monotonic() - start, 2),
+        }
+        terraform_path = write_fake_terraform(root_path)
+        report.update(bench_discovery(root_path))
+        report.update(bench_dispatch(
+            root_path, terraform_path, args.dispatch_instances, args.jobs
+        ))
+        report.update(bench_startup(
+            root_path, terraform_path, args.startup_runs
+        ))
+        report.update(peak_rss())
+
+    width = max(len(k) for k in report)
+    for key, value in report.items():
+        print(f'{key:<{width}}  {value}')
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
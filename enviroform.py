@@ -5,18 +5,747 @@
 
   Runs the tf <tf_command> (with tf <options>) for the terraform config
   found in <terraform_path>. See README.md for details.
+
+  enviroform.py --environments-dir <envs_path> --terraform-dir <tf_path> \
+    fleet <tf_command> [<options>]
+
+  Runs the tf <tf_command> for every instance discovered under <envs_path>.
 """
 
 import argparse
+import asyncio
+import codecs
+import collections
+import collections.abc
+import concurrent.futures
+import contextlib
+import dataclasses
+import fcntl
+import fnmatch
+import glob
+import hashlib
+import heapq
+import io
+import itertools
+import json
 import os
+import re
+import resource
+import selectors
+import shlex
+import shutil
+import signal
+import socket
+import socketserver
+import sqlite3
+import statistics
 import sys
 import subprocess
+import threading
+import time
+import typing
+import urllib.parse
+import urllib.request
+
+
+# raised by run_tf_cmd once a user requested 'init' has completed
+INIT_ONLY_MESSAGE = 'You specified init, so we will stop here. exit.'
+
+# written into .terraform after a successful init, see init_fingerprint()
+INIT_FINGERPRINT_FILE = 'enviroform-init.sha256'
+
+# .tf blocks which change what init installs or configures: terraform
+# (required_providers, backend) and module blocks
+INIT_RELEVANT_TF_BLOCK = re.compile(
+    r'^[ \t]*(?:terraform|module[ \t]+"[^"\n]*")[ \t]*\{', re.M
+)
+
+# written into a template data dir once its init has completed
+TEMPLATE_READY_FILE = 'enviroform-template-ready'
+
+# the dependency lock file terraform init writes into a config
+LOCK_FILE = '.terraform.lock.hcl'
+# provider blocks of a lock file, and what we need from them
+LOCK_PROVIDER_BLOCK = re.compile(r'^provider\s+"([^"]+)"\s*\{(.*?)^\}', re.M | re.S)  # NOQA
+LOCK_VERSION = re.compile(r'^\s*version\s*=\s*"([^"]+)"', re.M)
+LOCK_ZIP_HASH = re.compile(r'"(zh:[0-9a-f]{64})"')
+# where provider sources without a host come from
+DEFAULT_REGISTRY_HOST = 'registry.terraform.io'
+# the provider mirror, and the CLI config pointing init at it, in the
+# state dir, see warm_main()
+PROVIDER_MIRROR_DIR = 'provider-mirror'
+PROVIDER_MIRROR_CONFIG = 'provider-mirror.tfrc'
+# the mirror's CLI config combined with yours, see cli_config_with_mirror()
+PROVIDER_MIRROR_CONFIGS = 'provider-mirror-configs'
+# a CLI config block choosing where providers are installed from
+PROVIDER_INSTALLATION = re.compile(r'^\s*provider_installation\b', re.M)
+# the daemon's socket, in the state dir, see Daemon
+DAEMON_SOCKET = 'daemon.sock'
+# commands the daemon sends back to the client: they print to sys.stdout
+DAEMON_LOCAL_COMMANDS = [
+    'fleet', 'affected', 'index', 'history', 'warm', 'export', 'outputs',
+    'daemon',
+]
+# env vars of a client's shell which don't make its request different
+DAEMON_IGNORED_ENV = [
+    '_', 'OLDPWD', 'PWD', 'SHLVL', 'SSH_TTY', 'TERM_SESSION_ID', 'TMUX_PANE',
+    'WINDOWID',
+]
+# characters of a daemon run's output kept for clients joining it late,
+# once every client following it has been sent them
+DAEMON_OUTPUT_KEEP = 1024 * 1024
+# seconds an instance's cached outputs are used for, see OutputsCache
+DEFAULT_OUTPUTS_TTL = 300
+# size bound for the shared TF_PLUGIN_CACHE_DIR, in MB
+DEFAULT_PLUGIN_CACHE_MAX_MB = 5120
+
+# how long a --plan-cache result is reused, in seconds
+DEFAULT_PLAN_CACHE_TTL = 900
+
+# bytes read from a child's pipe at a time
+PIPE_READ_SIZE = 65536
+
+# lines of each run's output kept in memory, e.g. for fleet summaries
+DEFAULT_TAIL_LINES = 20
+
+# a partial line longer than this is passed on as is
+MAX_LINE_LENGTH = 65536
+
+# kinds of resource change counted by --summarize, see PlanSummarizer
+PLAN_ACTIONS = ['create', 'update', 'replace', 'delete']
+
+# reported by fleet for an instance skipped because a dependency failed
+SKIPPED_RC = -1
+
+# terraform gave up waiting for another run's lock on the state
+STATE_LOCK_ERROR = 'Error acquiring the state lock'
+
+# fleet requeues an instance which failed on STATE_LOCK_ERROR
+DEFAULT_LOCK_RETRIES = 3
+# seconds before a requeued instance runs again
+LOCK_RETRY_DELAY = 5.0
+
+# output showing a failure worth retrying, see fleet --retries
+TRANSIENT_ERRORS = [
+    'RequestLimitExceeded',
+    'ThrottlingException',
+    'Throttling: Rate exceeded',
+    'TooManyRequestsException',
+    'SlowDown',
+    'connection reset by peer',
+    'i/o timeout',
+    'TLS handshake timeout',
+    'net/http: request canceled',
+    'Service Unavailable',
+]
+# seconds before the first retry of a transient failure, doubling after
+RETRY_DELAY = 2.0
+
+# commands which take -parallelism, i.e. walk the resource graph
+PARALLELISM_COMMANDS = [
+    'plan', 'apply', 'refresh', 'destroy', 'import', 'apply-saved'
+]
+# fleet's total -parallelism across running instances, per cpu. With
+# --jobs at the cpu count, each instance gets terraform's default of 10
+DEFAULT_PARALLELISM_PER_CPU = 10
+# memory fleet keeps free before starting another instance, in MB
+DEFAULT_MIN_FREE_MB = 1024
+# seconds between checks while fleet waits for memory or load to drop
+BUDGET_POLL_INTERVAL = 1.0
+# where runs can't be measured whole, what the biggest terraform process
+# seen is multiplied by, to allow for its provider plugins
+RSS_SAFETY_FACTOR = 2
+
+# seconds terraform gets to stop after SIGINT, e.g. to release its state
+# lock, before SIGTERM; then after SIGTERM, before SIGKILL
+DEFAULT_INTERRUPT_GRACE = 30.0
+DEFAULT_TERMINATE_GRACE = 10.0
+# seconds between checks of the cancel event while a command runs
+CANCEL_POLL_INTERVAL = 0.2
+
+
+class CommandError(Exception):
+    """A command returned an rc that was not expected."""
+
+    def __init__(self, rc: int) -> None:
+        super().__init__(f'Command failed with rc {rc}')
+        self.rc = rc
+
+
+class Cancelled(Exception):
+    """A run was cancelled, e.g. by fleet --fail-fast."""
+
+
+def signal_process_group(pgid: int, sig: int) -> None:
+    """Sends sig to a process group, if any of it is still around."""
+    with contextlib.suppress(ProcessLookupError, PermissionError):
+        os.killpg(pgid, sig)
+
+
+class FileLock:
+    """
+    An exclusive flock() on a file. Works across processes, and across
+    threads since every FileLock opens its own file description.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.file = None
+
+    def __enter__(self) -> 'FileLock':
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.file = open(self.path, 'w')
+        fcntl.flock(self.file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        fcntl.flock(self.file, fcntl.LOCK_UN)
+        self.file.close()
+        self.file = None
+
+
+# what run() and run_async() report in RunResult.error instead of raising
+RUN_ERRORS = (
+    CommandError,
+    Cancelled,
+    SystemExit,
+    OSError,
+    subprocess.SubprocessError,
+    asyncio.TimeoutError,
+)
+
+
+class InputHasher:
+    """Builds a sha256 over labelled inputs, e.g. to fingerprint a run."""
+
+    def __init__(self) -> None:
+        self.digest = hashlib.sha256()
+
+    def add(self, label: str, data: bytes) -> None:
+        """Adds one input. Lengths are included, so inputs can't run on."""
+        self.digest.update(f'{label}:{len(data)}:'.encode())
+        self.digest.update(data)
+
+    def add_file(self, label: str, path: str) -> None:
+        """Adds a file's contents, or notes that it doesn't exist."""
+        try:
+            with open(path, 'rb') as f:
+                self.add(label, f.read())
+        except OSError:
+            self.add(label + ':missing', b'')
+
+    def add_args(self, label: str, args: list[str]) -> None:
+        """
+        Adds -flag=value args and, for values that are files,
+        e.g. -var-file=<path>, the file's contents.
+        """
+        for arg in args:
+            self.add(label, arg.encode())
+            value = arg.split('=', 1)[-1]
+            if os.path.isfile(value):
+                self.add_file(label + ':file', value)
+
+    def add_tree(self, label: str, path: str) -> None:
+        """Adds every file below path, except terraform data dirs."""
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames[:] = sorted(d for d in dirnames if d != '.terraform')
+            for name in sorted(filenames):
+                file_path = os.path.join(dirpath, name)
+                rel_path = os.path.relpath(file_path, path)
+                self.add_file(f'{label}:{rel_path}', file_path)
+
+    def hexdigest(self) -> str:
+        return self.digest.hexdigest()
+
+
+def hcl_block_end(text: str, start: int) -> int:
+    """
+    Returns the index just past the brace closing the block whose
+    opening brace is at text[start], skipping braces in strings and
+    comments, or len(text) if it isn't closed.
+    """
+    depth = 0
+    i = start
+    while i < len(text):
+        char = text[i]
+        if char == '"':
+            i += 1
+            while i < len(text) and text[i] not in '"\n':
+                i += 2 if text[i] == '\\' else 1
+        elif char == '#' or text.startswith('//', i):
+            i = text.find('\n', i)
+            if i < 0:
+                return len(text)
+        elif text.startswith('/*', i):
+            i = text.find('*/', i)
+            if i < 0:
+                return len(text)
+            i += 1
+        elif char == '{':
+            depth += 1
+        elif char == '}':
+            depth -= 1
+            if depth == 0:
+                return i + 1
+        i += 1
+    return len(text)
+
+
+def init_relevant_blocks(text: str) -> list[str]:
+    """
+    The terraform and module blocks of a .tf file, whole, however
+    they are laid out, e.g. a provider's source and version on one
+    line of required_providers.
+    """
+    blocks = []
+    position = 0
+    while True:
+        match = INIT_RELEVANT_TF_BLOCK.search(text, position)
+        if match is None:
+            return blocks
+        position = hcl_block_end(text, match.end() - 1)
+        blocks.append(text[match.start():position])
+
+
+def terraform_identity(terraform_path: str) -> bytes:
+    """
+    Identifies the terraform binary. `terraform version` is too slow
+    to run on every call, the binary's path, size and mtime change
+    whenever it is upgraded.
+    """
+    tf_binary = shutil.which(terraform_path) or terraform_path
+    if os.path.isfile(tf_binary):
+        st = os.stat(tf_binary)
+        tf_binary = f'{os.path.realpath(tf_binary)}:{st.st_size}:{st.st_mtime_ns}'  # NOQA
+    return tf_binary.encode()
+
+
+class TeeStream(io.TextIOBase):
+    """
+    Writes to several text streams. Having no fileno(), it makes call()
+    pipe a child's output through us.
+    """
+
+    def __init__(self, *streams: typing.TextIO) -> None:
+        self.streams = streams
+
+    def write(self, text: str) -> int:
+        for stream in self.streams:
+            stream.write(text)
+        return len(text)
+
+    def flush(self) -> None:
+        for stream in self.streams:
+            stream.flush()
+
+
+class OutputSink(io.TextIOBase):
+    """
+    Where the output of one run goes, when many runs share a console:
+    everything is written to the log file, complete lines are written
+    to the console prefixed with the run's label, and only the last
+    tail_lines lines are kept in memory.
+    """
+
+    # one console line at a time, whichever run it is from
+    console_lock = threading.Lock()
+
+    def __init__(
+        self,
+        label: str = '',
+        console: typing.TextIO = None,
+        log: typing.TextIO = None,
+        tail_lines: int = DEFAULT_TAIL_LINES,
+        watch: list[str] = ()
+    ) -> None:
+
+        self.label = label
+        self.console = console
+        self.log = log
+        self.tail = collections.deque(maxlen=tail_lines)
+        self.partial = ''
+        # the strings of watch seen in any line
+        self.watch = list(watch)
+        self.seen = set()
+
+    def write(self, text: str) -> int:
+        if self.log is not None:
+            self.log.write(text)
+        lines = (self.partial + text).split('\n')
+        self.partial = lines.pop()
+        if len(self.partial) > MAX_LINE_LENGTH:
+            lines.append(self.partial)
+            self.partial = ''
+        self.emit(lines)
+        return len(text)
+
+    def emit(self, lines: list[str]) -> None:
+        """Passes complete lines on to the tail and the console."""
+        if not lines:
+            return
+        self.tail.extend(lines)
+        for text in self.watch:
+            if text not in self.seen and any(text in line for line in lines):
+                self.seen.add(text)
+        if self.console is not None:
+            prefix = f'[{self.label}] ' if self.label else ''
+            text = ''.join(f'{prefix}{line}\n' for line in lines)
+            with self.console_lock:
+                self.console.write(text)
+                self.console.flush()
+
+    def flush(self) -> None:
+        if self.log is not None:
+            self.log.flush()
+
+    def finish(self) -> None:
+        """Passes on a trailing line that has no newline."""
+        if self.partial:
+            self.emit([self.partial])
+            self.partial = ''
+        self.flush()
+
+
+class PlanSummarizer(io.TextIOBase):
+    """
+    Counts the resource changes in `terraform show -json` output as it
+    is written. It only keeps its place in the JSON and the counts, so
+    memory stays flat however big the plan is: the before/after values,
+    the bulk of a plan, are scanned past without being parsed.
+    """
+
+    # containers we look inside of, by path from the root
+    VISITED = {
+        (),
+        ('resource_changes',),
+        ('resource_changes', '#'),
+        ('resource_changes', '#', 'change'),
+        ('resource_changes', '#', 'change', 'actions'),
+    }
+    TYPE_PATH = ('resource_changes', '#', 'type')
+    ACTION_PATH = ('resource_changes', '#', 'change', 'actions', '#')
+    # strings we keep are cut off beyond this
+    MAX_STRING = 1024
+
+    TOKEN = re.compile(r'\s*(?:([{}\[\]:,"])|([^\s{}\[\]:,"]+))')
+    # everything up to the next bracket or unfinished string
+    SKIPPED = re.compile(
+        r'[^"{}\[\]]*(?:"[^"\\]*(?:\\.[^"\\]*)*"[^"{}\[\]]*)*'
+    )
+    STRING_BODY = re.compile(r'[^"\\]*')
+
+    def __init__(self) -> None:
+        self.counts = collections.defaultdict(collections.Counter)
+        # [is_object, key, expecting_key] per open container
+        self.stack = []
+        # an unfinished token, carried over to the next write
+        self.carry = ''
+        self.in_string = False
+        # the string being read, None if it isn't kept
+        self.string = None
+        self.string_is_key = False
+        # open containers below one we aren't looking inside of
+        self.skip_depth = 0
+        # the resource change being read
+        self.change = None
+
+    def path(self) -> tuple:
+        """The path of the value about to be read."""
+        return tuple(
+            frame[1] if frame[0] else '#' for frame in self.stack
+        )
+
+    def write(self, text: str) -> int:
+        length = len(text)
+        text, self.carry = self.carry + text, ''
+        pos, end = 0, len(text)
+        while pos < end:
+            if self.in_string:
+                pos = self.read_string(text, pos)
+            elif self.skip_depth:
+                pos = self.SKIPPED.match(text, pos).end()
+                if pos == end:
+                    break
+                char = text[pos]
+                pos += 1
+                if char == '"':
+                    # it goes on in the next write
+                    self.in_string = True
+                    self.string = None
+                elif char in '{[':
+                    self.skip_depth += 1
+                else:
+                    self.skip_depth -= 1
+            else:
+                match = self.TOKEN.match(text, pos)
+                if match is None:
+                    break
+                if match.group(2) is not None and match.end() == end:
+                    # a number or literal which may go on in the next write
+                    self.carry = match.group(2)
+                    break
+                pos = match.end()
+                if match.group(1) is not None:
+                    self.structure(match.group(1))
+        return length
+
+    def read_string(self, text: str, pos: int) -> int:
+        """Reads on through a string, returns where it stopped."""
+        match = self.STRING_BODY.match(text, pos)
+        self.keep(match.group())
+        pos = match.end()
+        if pos == len(text):
+            return pos
+        if text[pos] == '\\':
+            if pos + 1 == len(text):
+                self.carry = '\\'
+                return pos + 1
+            self.keep(text[pos:pos + 2])
+            return pos + 2
+        # the closing quote
+        self.in_string = False
+        if self.string is not None:
+            self.string_done(json.loads('"' + self.string + '"'))
+        return pos + 1
+
+    def keep(self, part: str) -> None:
+        if self.string is not None and len(self.string) < self.MAX_STRING:
+            self.string += part[:self.MAX_STRING - len(self.string)]
+
+    def structure(self, char: str) -> None:
+        """Handles one of {}[]:," outside of strings."""
+        frame = self.stack[-1] if self.stack else None
+        if char == '"':
+            self.in_string = True
+            self.string_is_key = frame is not None and frame[0] and frame[2]
+            self.string = '' if self.string_is_key or self.path() in [
+                self.TYPE_PATH, self.ACTION_PATH
+            ] else None
+        elif char in '{[':
+            path = self.path()
+            if path not in self.VISITED:
+                self.skip_depth = 1
+                return
+            if path == ('resource_changes', '#'):
+                self.change = {'type': '', 'actions': []}
+            self.stack.append([char == '{', None, True])
+        elif char in '}]':
+            if self.stack:
+                self.stack.pop()
+            if self.change is not None and len(self.stack) == 2:
+                self.count(self.change)
+                self.change = None
+        elif char == ':' and frame is not None:
+            frame[2] = False
+        elif char == ',' and frame is not None and frame[0]:
+            frame[1], frame[2] = None, True
+
+    def string_done(self, value: str) -> None:
+        if self.string_is_key:
+            self.stack[-1][1] = value
+        elif self.change is None:
+            return
+        elif len(self.stack) == 3:
+            self.change['type'] = value
+        else:
+            self.change['actions'].append(value)
+
+    def count(self, change: dict) -> None:
+        """Counts one resource change by type and kind of action."""
+        actions = change['actions']
+        if sorted(actions) == ['create', 'delete']:
+            action = 'replace'
+        elif actions in [['create'], ['update'], ['delete']]:
+            action = actions[0]
+        else:
+            # no-op, or read for data sources
+            return
+        self.counts[change['type']][action] += 1
+
+    def summary(self) -> dict:
+        """The counts, in total and by resource type."""
+        return summarize_counts({
+            t: dict(counts) for t, counts in sorted(self.counts.items())
+        })
+
+
+def summarize_counts(by_type: dict[str, dict[str, int]]) -> dict:
+    """A plan summary from counts of each action by resource type."""
+    summary = {action: 0 for action in PLAN_ACTIONS}
+    for counts in by_type.values():
+        for action, count in counts.items():
+            summary[action] += count
+    summary['by_type'] = by_type
+    return summary
+
+
+def merge_summaries(summaries: list[dict]) -> dict:
+    """Adds up plan summaries, e.g. for a fleet."""
+    by_type = collections.defaultdict(collections.Counter)
+    for summary in summaries:
+        for resource_type, counts in summary['by_type'].items():
+            by_type[resource_type].update(counts)
+    return summarize_counts({
+        t: dict(counts) for t, counts in sorted(by_type.items())
+    })
+
+
+def format_summary(summary: dict) -> str:
+    """e.g. Plan summary: 2 to create, 0 to update, 1 to replace, ..."""
+    return 'Plan summary: ' + ', '.join(
+        f'{summary[action]} to {action}' for action in PLAN_ACTIONS
+    )
+
+
+class Tracer:
+    """
+    Collects timing spans from any number of runs and threads, and
+    writes them as Chrome trace events (for Perfetto / chrome://tracing)
+    plus a plain JSON summary.
+    """
+
+    def __init__(self) -> None:
+        self.origin = time.monotonic()
+        self.spans = []
+        self.threads = {}
+        self.lock = threading.Lock()
+
+    def add(self, name: str, start: float, duration: float, **args) -> None:
+        """Records a span; start is a time.monotonic() value."""
+        tid = threading.get_native_id()
+        with self.lock:
+            self.threads.setdefault(tid, threading.current_thread().name)
+            self.spans.append({
+                'name': name,
+                'start': start - self.origin,
+                'duration': duration,
+                'tid': tid,
+                'args': args,
+            })
+
+    @contextlib.contextmanager
+    def span(self, name: str, **args) -> collections.abc.Iterator[dict]:
+        """Times the block. Yields the span's args, to be filled in."""
+        start = time.monotonic()
+        try:
+            yield args
+        finally:
+            self.add(name, start, time.monotonic() - start, **args)
+
+    def chrome_trace(self) -> dict:
+        """The spans in Chrome trace event format."""
+        pid = os.getpid()
+        events = [
+            {'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid,
+             'args': {'name': name}}
+            for tid, name in self.threads.items()
+        ]
+        for span in self.spans:
+            events.append({
+                'name': span['name'],
+                'cat': 'enviroform',
+                'ph': 'X',
+                'ts': round(span['start'] * 1e6),
+                'dur': round(span['duration'] * 1e6),
+                'pid': pid,
+                'tid': span['tid'],
+                'args': span['args'],
+            })
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def summary(self) -> dict:
+        """Time per phase overall, and per phase of each instance."""
+        phases = {}
+        instances = {}
+        for span in self.spans:
+            duration = span['duration']
+            phase = phases.setdefault(
+                span['name'], {'count': 0, 'total': 0.0, 'max': 0.0}
+            )
+            phase['count'] += 1
+            phase['total'] += duration
+            phase['max'] = max(phase['max'], duration)
+            label = span['args'].get('label')
+            if label:
+                instance = instances.setdefault(label, {
+                    'backend_key': span['args'].get('backend_key'),
+                    'phases': {},
+                })
+                instance['phases'][span['name']] = round(
+                    instance['phases'].get(span['name'], 0.0) + duration, 6
+                )
+                if 'rc' in span['args']:
+                    instance['rc'] = span['args']['rc']
+        for phase in phases.values():
+            phase['mean'] = round(phase['total'] / phase['count'], 6)
+            phase['total'] = round(phase['total'], 6)
+            phase['max'] = round(phase['max'], 6)
+        return {'phases': phases, 'instances': instances}
+
+    def write(self, path: str) -> None:
+        """Writes the trace to path, the summary next to it."""
+        with open(path, 'w') as f:
+            json.dump(self.chrome_trace(), f)
+        with open(get_summary_path(path), 'w') as f:
+            json.dump(self.summary(), f, indent=2, sort_keys=True)
+
+
+def get_summary_path(trace_path: str) -> str:
+    """trace.json -> trace.summary.json"""
+    base, ext = os.path.splitext(trace_path)
+    return f'{base}.summary{ext or ".json"}'
+
+
+@dataclasses.dataclass
+class Step:
+    """One command of a run, as planned by Enviroform.tf_steps()."""
+
+    name: str
+    cmd_list: list[str]
+    expected_rcs: list[int] = dataclasses.field(default_factory=lambda: [0])
+    # hold the plugin cache lock while this runs
+    lock: bool = False
+
+
+@dataclasses.dataclass
+class StepResult:
+    """A command that was run (or printed, for --dry-run)."""
+
+    name: str
+    cmd_list: list[str]
+    cwd: str
+    rc: int
+    duration: float
+
+
+@dataclasses.dataclass
+class RunResult:
+    """What Enviroform.run() and Enviroform.run_async() return."""
+
+    rc: int
+    duration: float
+    steps: list[StepResult]
+    # combined stdout/stderr, unless an output stream was provided
+    output: str = ''
+    error: str = ''
+    # counts of planned changes, with --summarize
+    summary: dict = None
+
+    @property
+    def commands(self) -> list[list[str]]:
+        """The resolved command lines, in the order they ran."""
+        return [step.cmd_list for step in self.steps]
 
 
 class Enviroform:
     """
     Wraps the series of steps required to run a terraform command.
-    See main() for an implementation example
+    See main() for an implementation example.
+
+    run_tf_cmd() is the CLI entry point: it raises SystemExit on bad input
+    and writes to sys.stdout. Library callers should use run() or
+    run_async(), which never touch process wide state (cwd, sys.stdout)
+    and return a RunResult instead of raising.
     """
 
     def __init__(
@@ -31,14 +760,43 @@ class Enviroform:
         self.known_args = known_args
         self.other_args = other_args
         self.root_path = root_path
-        self.environ = os.environ
+        self.environ = dict(os.environ)
         # tf apply can take a long time (e.g. db creation)
         # but 1 hour seems reasonable to just give up
         self.subprocess_timeout = 3600
+        # where our messages and terraform output go
+        self.stdout = sys.stdout
+        self.stderr = sys.stderr
+        # what terraform reads its answers from, None: our stdin
+        self.stdin = None
+        self.step_results = []
+        self.step_name = ''
+        # a TreeIndex to resolve files from, instead of stat-ing each one
+        self.index = None
+        # a Tracer to record timing spans of each phase in
+        self.tracer = None
+        # set to stop the running command, and run no more
+        self.cancel_event = threading.Event()
+        # where the next command's stdout goes instead, e.g. to be parsed
+        self.command_output = None
+        # counts of planned changes, see --summarize
+        self.summary = None
+        # where per-instance data dirs go, default <state>/data
+        self.data_dir_base = None
+        self.interrupt_grace = getattr(known_args, 'interrupt_grace', None)
+        if self.interrupt_grace is None:
+            self.interrupt_grace = DEFAULT_INTERRUPT_GRACE
+        self.terminate_grace = getattr(known_args, 'terminate_grace', None)
+        if self.terminate_grace is None:
+            self.terminate_grace = DEFAULT_TERMINATE_GRACE
 
     def check_file(self, fpath: str) -> None:
         """Raises SystemExit if file does not exit."""
-        if not os.path.isfile(fpath):
+        if self.index is not None:
+            exists = self.index.has_file(fpath)
+        else:
+            exists = os.path.isfile(fpath)
+        if not exists:
             raise SystemExit(
                 f'ERROR: file not found at: {fpath}. '
                 f'Your root is {self.root_path}'
@@ -46,52 +804,269 @@ class Enviroform:
 
     def check_dir(self, dpath: str) -> None:
         """Raises SystemExit if dir does not exit."""
-        if not os.path.isdir(dpath):
+        if self.index is not None:
+            exists = self.index.has_dir(dpath)
+        else:
+            exists = os.path.isdir(dpath)
+        if not exists:
             raise SystemExit(
                 f'ERROR: dir not found at: {dpath}'
                 f'Your root is {self.root_path}'
             )
 
-    def call(self, cmd_list: list) -> int:
-        """Wraps Popen using communicate, returns return code."""
-        stderr = sys.stderr
-        stdout = sys.stdout
+    def echo(self, *args) -> None:
+        """print() to our stdout stream."""
+        print(*args, file=self.stdout, flush=True)
+
+    def child_stream(self, stream) -> object:
+        """
+        Returns what to hand a child process for stream: the stream itself
+        if it has a file descriptor, else PIPE and we copy the output over.
+        """
+        try:
+            stream.fileno()
+        except (AttributeError, io.UnsupportedOperation):
+            return subprocess.PIPE
+        stream.flush()
+        return stream
+
+    def call(self, cmd_list: list, cwd: str = None) -> int:
+        """
+        Runs a command in its own process group, returns return code.
+        On Ctrl-C, the timeout or the cancel event, the whole group
+        (terraform and its provider plugins) is stopped, see stop().
+        """
+        if self.cancel_event.is_set():
+            raise Cancelled(f'not running {cmd_list[0]}')
+        stderr = self.child_stream(self.stderr)
+        stdout = self.child_stream(self.command_output or self.stdout)
 
+        # a group of its own: signals reach its providers, and a Ctrl-C
+        # meant for us doesn't reach it before stop() decides what to do
         prc = subprocess.Popen(
             cmd_list,
+            stdin=self.stdin,
             stdout=stdout,
             stderr=stderr,
-            env=self.environ
-        )
-        prc.communicate(timeout=self.subprocess_timeout)
-        # TODO: ^ this should work if the user sends a signal e.g. ctrl-c
-        # tf can be tricky to stop, requiring multiple attempts by the user
-        # But I believe communicate() will send that signal down to all
-        # processes and allow the user to keep sending more signals if needed
-        # If that doesn't work, the below approach may be explored
-        # try:
-        #     prc.communicate(timeout=self.subprocess_timeout)
-        # except KeyboardInterrupt:
-        #     print('Detected KeyboardInterrupt, killing process')
-        #     # TODO: should we try several times?
-        #     prc.kill()
+            cwd=cwd,
+            env=self.environ,
+            start_new_session=True
+        )
+        try:
+            if subprocess.PIPE in (stdout, stderr):
+                self.pump(prc)
+            self.wait(prc)
+        except BaseException:
+            self.stop(prc)
+            raise
+        finally:
+            # providers left behind by terraform
+            signal_process_group(prc.pid, signal.SIGKILL)
+            for pipe in [prc.stdout, prc.stderr]:
+                if pipe is not None:
+                    pipe.close()
 
         ret = prc.returncode
 
         return ret
 
+    def check_running(self, prc: subprocess.Popen, deadline: float) -> float:
+        """
+        Raises if the command should stop now, else returns how long
+        to wait before checking again.
+        """
+        if self.cancel_event.is_set():
+            raise Cancelled(f'stopped {prc.args[0]}')
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise subprocess.TimeoutExpired(
+                prc.args, self.subprocess_timeout
+            )
+        return min(remaining, CANCEL_POLL_INTERVAL)
+
+    def wait(self, prc: subprocess.Popen) -> None:
+        """Waits for the command to exit, see check_running()."""
+        deadline = time.monotonic() + self.subprocess_timeout
+        while True:
+            timeout = self.check_running(prc, deadline)
+            with contextlib.suppress(subprocess.TimeoutExpired):
+                prc.wait(timeout)
+                return
+
+    def stop(self, prc: subprocess.Popen) -> None:
+        """
+        Stops a command's process group: SIGINT, which lets terraform
+        finish gracefully and release its state lock, then SIGTERM, then
+        SIGKILL, each after its grace period. Another Ctrl-C moves on
+        to the next signal at once.
+        """
+        for sig, grace in [
+            (signal.SIGINT, self.interrupt_grace),
+            (signal.SIGTERM, self.terminate_grace),
+            (signal.SIGKILL, None),
+        ]:
+            if prc.poll() is not None:
+                return
+            self.echo(f'Stopping process group {prc.pid} with {sig.name}')
+            signal_process_group(prc.pid, sig)
+            try:
+                prc.wait(grace)
+            except (subprocess.TimeoutExpired, KeyboardInterrupt):
+                continue
+
+    def pump(self, prc: subprocess.Popen) -> None:
+        """
+        Copies a child's piped output to our streams as it arrives,
+        without ever holding more than one read of it in memory.
+        Raises when the command should stop, see check_running().
+        """
+        deadline = time.monotonic() + self.subprocess_timeout
+        with selectors.DefaultSelector() as selector:
+            for pipe, stream in [
+                (prc.stdout, self.command_output or self.stdout),
+                (prc.stderr, self.stderr)
+            ]:
+                if pipe is not None:
+                    decoder = codecs.getincrementaldecoder('utf-8')('replace')
+                    selector.register(
+                        pipe, selectors.EVENT_READ, (stream, decoder)
+                    )
+            while selector.get_map():
+                timeout = self.check_running(prc, deadline)
+                for key, _ in selector.select(timeout):
+                    stream, decoder = key.data
+                    data = os.read(key.fd, PIPE_READ_SIZE)
+                    stream.write(decoder.decode(data, final=not data))
+                    if not data:
+                        selector.unregister(key.fileobj)
+                        key.fileobj.close()
+
+    async def pump_async(
+        self, pipe: asyncio.StreamReader, stream: typing.TextIO
+    ) -> None:
+        """pump(), for one pipe of an asyncio subprocess."""
+        decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        while True:
+            data = await pipe.read(PIPE_READ_SIZE)
+            stream.write(decoder.decode(data, final=not data))
+            if not data:
+                return
+
+    async def call_async(self, cmd_list: list, cwd: str = None) -> int:
+        """call(), using asyncio subprocesses. Returns return code."""
+        stderr = self.child_stream(self.stderr)
+        stdout = self.child_stream(self.command_output or self.stdout)
+
+        prc = await asyncio.create_subprocess_exec(
+            *cmd_list,
+            stdin=self.stdin,
+            stdout=stdout,
+            stderr=stderr,
+            cwd=cwd,
+            env=self.environ,
+            start_new_session=True
+        )
+        pumps = [
+            self.pump_async(pipe, stream)
+            for pipe, stream in [
+                (prc.stdout, self.command_output or self.stdout),
+                (prc.stderr, self.stderr)
+            ]
+            if pipe is not None
+        ]
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(*pumps, prc.wait()), self.subprocess_timeout
+            )
+        except BaseException:
+            # timed out or cancelled, don't leave terraform running
+            await self.stop_async(prc)
+            raise
+        finally:
+            signal_process_group(prc.pid, signal.SIGKILL)
+        return prc.returncode
+
+    async def stop_async(self, prc: asyncio.subprocess.Process) -> None:
+        """stop(), for an asyncio subprocess."""
+        for sig, grace in [
+            (signal.SIGINT, self.interrupt_grace),
+            (signal.SIGTERM, self.terminate_grace),
+            (signal.SIGKILL, None),
+        ]:
+            if prc.returncode is not None:
+                return
+            self.echo(f'Stopping process group {prc.pid} with {sig.name}')
+            signal_process_group(prc.pid, sig)
+            try:
+                await asyncio.wait_for(asyncio.shield(prc.wait()), grace)
+            except asyncio.TimeoutError:
+                continue
+
     def do_cmd(self, cmd_list: list, expected_rcs: list = [0]) -> int:
         """Executes any shell command, returns return code."""
-        print(' '.join(cmd_list))
+        self.echo(' '.join(cmd_list))
+        rc = 0
+        start = time.monotonic()
+        if self.dry_run:
+            self.echo()
+        else:
+            rc = self.call(cmd_list, cwd=self.tf_config_path)
+        self.record_step(cmd_list, rc, start)
+        if rc not in expected_rcs:
+            raise CommandError(rc)
+        return rc
+
+    async def do_cmd_async(
+        self, cmd_list: list, expected_rcs: list = [0]
+    ) -> int:
+        """do_cmd(), using asyncio subprocesses."""
+        self.echo(' '.join(cmd_list))
         rc = 0
+        start = time.monotonic()
         if self.dry_run:
-            print()
+            self.echo()
         else:
-            rc = self.call(cmd_list)
+            rc = await self.call_async(cmd_list, cwd=self.tf_config_path)
+        self.record_step(cmd_list, rc, start)
         if rc not in expected_rcs:
-            raise Exception(f'Command failed with rc {rc}')
+            raise CommandError(rc)
         return rc
 
+    def record_step(self, cmd_list: list, rc: int, start: float) -> None:
+        """Adds a StepResult for a command that just finished."""
+        result = StepResult(
+            name=self.step_name,
+            cmd_list=list(cmd_list),
+            cwd=self.tf_config_path,
+            rc=rc,
+            duration=time.monotonic() - start,
+        )
+        self.step_results.append(result)
+        if self.tracer is not None:
+            self.tracer.add(
+                result.name, start, result.duration,
+                rc=rc, **self.trace_args()
+            )
+
+    def trace_args(self) -> dict:
+        """What we know about the instance, to put on timing spans."""
+        instance = getattr(self, 'instance', None)
+        if instance is None:
+            return {}
+        return {'label': instance.label, 'backend_key': instance.backend_key}
+
+    @contextlib.contextmanager
+    def trace(self, name: str) -> collections.abc.Iterator[None]:
+        """Times the block as a span, if we have a tracer."""
+        if self.tracer is None:
+            yield
+            return
+        with self.tracer.span(name) as args:
+            try:
+                yield
+            finally:
+                args.update(self.trace_args())
+
     def process_default_flags(self) -> None:
         """Validate/process default flags."""
         self.dry_run = self.known_args.dry_run
@@ -100,6 +1075,27 @@ class Enviroform:
             self.root_path, tf_config_rel_path
         )
         self.check_dir(self.tf_config_path)
+        self.force_init = getattr(self.known_args, 'force_init', False)
+        self.plan_cache = getattr(self.known_args, 'plan_cache', False)
+        self.plan_cache_ttl = getattr(
+            self.known_args, 'plan_cache_ttl', None
+        ) or DEFAULT_PLAN_CACHE_TTL
+        self.refresh = getattr(self.known_args, 'refresh', False)
+        self.save_plan = getattr(self.known_args, 'save_plan', False)
+        self.parallelism = getattr(self.known_args, 'parallelism', None)
+        self.clone_data_dir = getattr(self.known_args, 'clone_data_dir', False)
+        self.summarize = getattr(self.known_args, 'summarize', False)
+        self.upstream_outputs = getattr(
+            self.known_args, 'upstream_outputs', False
+        )
+        self.outputs_ttl = getattr(self.known_args, 'outputs_ttl', None)
+        if self.outputs_ttl is None:
+            self.outputs_ttl = DEFAULT_OUTPUTS_TTL
+        if self.save_plan and self.plan_cache:
+            raise SystemExit(
+                'ERROR: --save-plan and --plan-cache can not be used together'
+            )
+        self.data_dir = os.path.join(self.tf_config_path, '.terraform')
 
     def process_user_args(self) -> None:
         """Validate/process default args."""
@@ -111,10 +1107,11 @@ class Enviroform:
         self.tf_command = other_args[0]
         self.tf_args = other_args[1:]
         self.special_commands = [
-            'plan', 'apply', 'refresh', 'destroy', 'import', 'init'
+            'plan', 'apply', 'refresh', 'destroy', 'import', 'init',
+            'apply-saved'
         ]
         if self.tf_command not in self.special_commands:
-            print(
+            self.echo(
                 f'\nWARNING:\nterraform {" ".join(other_args)}\n'
                 'will be run as provided after init. '
                 'It has no special processing. of tfvars files.'
@@ -165,7 +1162,19 @@ class Enviroform:
                 'ERROR: containing dir should match the config type: ' +
                 f'{config_type} but is: {tfvars_config_type}'
             )
-        backend_key = f'{config_type}/{config_name}/{instance_label}/state.tfstate'  # NOQA
+        # record what we inferred, e.g. to key per-instance directories
+        self.instance = Instance(
+            env=env,
+            region=region,
+            config_type=config_type,
+            config_name=config_name,
+            name=instance_label,
+            tfvars_file_path=os.path.relpath(
+                tfvars_file_path, self.root_path),
+            terraform_config_path=os.path.relpath(
+                self.tf_config_path, self.root_path),
+        )
+        self.backend_key = backend_key = self.instance.backend_key
         backend_args = [
             f'-backend-config={backend_tfvars_file_path}',
             f'-backend-config=key={backend_key}'
@@ -186,97 +1195,3826 @@ class Enviroform:
         # e.g. pulling .tfvars variables from cloud state, instead.
         # like AWS Parameter Store
         self.backend_args, self.var_file_args = self.process_tfvars(self.known_args.tfvars_file_path)  # NOQA
+        if getattr(self.known_args, 'merge_tfvars', False):
+            self.var_file_args = self.merge_var_files(self.var_file_args)
+        self.process_data_dir()
+        self.process_provider_mirror()
 
-    def run_tf_cmd(self) -> int:
+    def merge_var_files(self, var_file_args: list[str]) -> list[str]:
         """
-        Runs commands to execute various terraform commands,
-        providing inferential support where needed.
-        Returns: Integer, tf return code.
+        With --merge-tfvars: replaces the -var-file args with one of a
+        bundle, <state>/tfvars/<hash>.tfvars.json, holding the merged
+        variables. Bundles are named by a hash of their content, so
+        instances with the same effective inputs share one. The bundle
+        made from a set of var files is remembered by a hash of theirs,
+        and only made again when one of them changes. Var files which
+        aren't literal values (see TfvarsParser) are passed as they are.
         """
-        self.process_args()
-        if self.dry_run:
-            print('\n==== Executing in --dryrun mode ===\n')
-        # tf init
-        os.chdir(self.tf_config_path)
-        self.do_cmd(
-            ['rm', '-rf', '.terraform']
+        paths = [arg.split('=', 1)[1] for arg in var_file_args]
+        hasher = InputHasher()
+        for path in paths:
+            hasher.add('path', path.encode())
+            hasher.add_file('tfvars', path)
+        tfvars_dir = os.path.join(get_state_dir(self.root_path), 'tfvars')
+        sources_path = os.path.join(
+            tfvars_dir, 'sources', hasher.hexdigest()
         )
+        with contextlib.suppress(OSError):
+            with open(sources_path) as f:
+                bundle_path = os.path.join(tfvars_dir, f.read().strip())
+            if os.path.exists(bundle_path):
+                return [f'-var-file={bundle_path}']
+        try:
+            merged = merge_tfvars(paths)
+        except ValueError as e:
+            self.echo(f'Passing the var files as they are, they can\'t be '
+                      f'merged: {e}\n')
+            return var_file_args
+        content = json.dumps(merged, indent=2, sort_keys=True) + '\n'
+        bundle_name = hashlib.sha256(content.encode()).hexdigest() \
+            + '.tfvars.json'
+        bundle_path = os.path.join(tfvars_dir, bundle_name)
+        os.makedirs(os.path.dirname(sources_path), exist_ok=True)
+        for path, data in [
+            (bundle_path, content), (sources_path, bundle_name)
+        ]:
+            tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            with open(tmp_path, 'w') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        return [f'-var-file={bundle_path}']
 
-        init_cmd = [self.terraform_path, 'init']
-        init_cmd.extend(self.backend_args)
-        if self.tf_command == 'init':
-            # allow the user to run 'init' with their own args
-            init_cmd.extend(self.tf_args)
-            self.do_cmd(init_cmd)
-            raise SystemExit("You specified init, so we will stop here. exit.")
-
-        else:
-            self.do_cmd(init_cmd)
+    def process_provider_mirror(self) -> None:
+        """
+        Once `warm` has filled the provider mirror, init installs from
+        it, without network fetches, if it has every provider the
+        config's lock file locks. The rest of your CLI config (your
+        TF_CLI_CONFIG_FILE, or ~/.terraformrc) still applies, see
+        cli_config_with_mirror(), unless it installs providers its own
+        way, which wins.
+        """
+        state_dir = get_state_dir(self.root_path)
+        config_path = os.path.join(state_dir, PROVIDER_MIRROR_CONFIG)
+        if not os.path.exists(config_path) or not mirror_covers(
+            os.path.join(state_dir, PROVIDER_MIRROR_DIR),
+            os.path.join(self.tf_config_path, LOCK_FILE),
+            current_platform()
+        ):
+            return
+        user_config_path = self.environ.get('TF_CLI_CONFIG_FILE') or \
+            os.path.join(
+                self.environ.get('HOME') or os.path.expanduser('~'),
+                '.terraformrc'
+            )
+        config_path = cli_config_with_mirror(
+            config_path, user_config_path,
+            os.path.join(state_dir, PROVIDER_MIRROR_CONFIGS)
+        )
+        if config_path:
+            self.environ = dict(self.environ, TF_CLI_CONFIG_FILE=config_path)
 
-        # tf command
-        expected_rcs = [0]
-        if self.tf_command == 'plan':
-            # rc 0 means no diff was seen, rc 2 means diff
-            self.tf_args.append('-detailed-exitcode')
-            expected_rcs = [0, 2]
+    def process_data_dir(self) -> None:
+        """
+        With --isolate-data-dir, each instance gets its own TF_DATA_DIR,
+        keyed by environment, region and backend key, instead of sharing
+        <config>/.terraform. Providers come from a shared plugin cache.
+        """
+        self.isolate_data_dir = getattr(
+            self.known_args, 'isolate_data_dir', False)
+        if not self.isolate_data_dir:
+            return
+        state_dir = get_state_dir(self.root_path)
+        self.data_dir = os.path.join(
+            self.data_dir_base or os.path.join(state_dir, 'data'),
+            self.instance.env, self.instance.region,
+            os.path.dirname(self.backend_key)
+        )
+        self.plugin_cache_dir = self.environ.get(
+            'TF_PLUGIN_CACHE_DIR',
+            os.path.join(state_dir, 'plugin-cache')
+        )
+        self.plugin_cache_max_bytes = getattr(
+            self.known_args, 'plugin_cache_max_mb', None
+        ) or DEFAULT_PLUGIN_CACHE_MAX_MB
+        self.plugin_cache_max_bytes *= 1024 * 1024
+        self.environ = dict(
+            self.environ,
+            TF_DATA_DIR=self.data_dir,
+            TF_PLUGIN_CACHE_DIR=self.plugin_cache_dir,
+        )
 
-        cmd = [self.terraform_path, self.tf_command]
-        cmd.extend(self.var_file_args)
-        cmd.extend(self.tf_args)
-        # let the user do something special
-        if self.tf_command not in self.special_commands:
-            print(
-                f'Non-default command: "{self.tf_command}" '
-                'executing without modification.\n'
+    def process_upstream_outputs(self) -> None:
+        """
+        With --upstream-outputs: reads the outputs of each instance this
+        one depends on (see dependency_graph()), through the outputs
+        cache, and passes them in a var file as `upstream_outputs`: a map
+        of <config_type>/<config_name>/<instance_name> to output values.
+        A config declares `variable "upstream_outputs" {}` to use them.
+        """
+        if self.tf_command not in [
+                'plan', 'apply', 'refresh', 'destroy', 'import']:
+            return
+        instance = self.instance
+        keys = remote_state_keys(
+            self.root_path, instance.terraform_config_path
+        ) | declared_dependencies(self.root_path, instance.tfvars_file_path)
+        # <environments>/<env>/<region>/<config_type>/<config_name>/
+        environments_dir = os.sep.join(
+            instance.tfvars_file_path.split(os.sep)[:-5]
+        )
+        terraform_dir = os.path.dirname(
+            os.path.dirname(instance.terraform_config_path)
+        )
+        cache = OutputsCache(self.root_path, self.outputs_ttl)
+        outputs = {}
+        for key in sorted(keys):
+            name = os.path.dirname(key)
+            if name.count('/') != 2:
+                continue
+            config_type, config_name, instance_name = name.split('/')
+            upstream = Instance(
+                env=instance.env,
+                region=instance.region,
+                config_type=config_type,
+                config_name=config_name,
+                name=instance_name,
+                tfvars_file_path=os.path.join(
+                    environments_dir, instance.env, instance.region,
+                    config_type, config_name, instance_name + '.tfvars'
+                ),
+                terraform_config_path=os.path.join(
+                    terraform_dir, config_type, config_name
+                ),
             )
-            cmd = [
-                self.terraform_path,
-                self.tf_command
-            ] + self.tf_args
-        return self.do_cmd(cmd, expected_rcs)
+            if not os.path.isfile(
+                    os.path.join(self.root_path, upstream.tfvars_file_path)):
+                self.echo(f'No instance has the state key {key}, '
+                          f'its outputs are not passed.')
+                continue
+            if self.dry_run:
+                self.echo(f'Reading the outputs of {upstream.label}')
+                continue
+            fetched = cache.get(upstream, lambda: read_outputs(
+                self.terraform_path, self.root_path, self.known_args,
+                upstream, self.cancel_event
+            ), refresh=getattr(self.known_args, 'refresh', False))
+            outputs[name] = {
+                output: value['value'] for output, value in fetched.items()
+            }
+        path = cache.var_file_path(instance)
+        if not self.dry_run:
+            write_private_json(path, {'upstream_outputs': outputs})
+        self.var_file_args.append(f'-var-file={path}')
 
+    def invalidate_outputs(self) -> None:
+        """Drops our cached outputs, before and after changing state."""
+        if not self.dry_run:
+            OutputsCache(self.root_path).invalidate(self.instance)
 
-def parse_args() -> tuple[argparse.Namespace, list[str]]:
-    """
-    Parses command line args to be passed to Enviroform
-    Returns: a tuple of two objects:
-      - argparse object with processed/known flags
-      - list of strings containing remaining args
-    """
-    parser = argparse.ArgumentParser(
-        description='enviroform.py: a terraform wrapper script.'
-    )
-    parser.add_argument(
-        '--terraform-config-path',
-        '-t',
-        help='path to terraform config directory'
-    )
-    parser.add_argument(
-        '--tfvars-file-path',
-        '-z',
-        help='path to your primary .tfvars file'
-    )
-    parser.add_argument(
-        '--dry-run',
-        '-d',
-        action='store_true',
-        help='dry run'
-    )
-    return parser.parse_known_args()
+    def plugin_cache_lock(self) -> contextlib.AbstractContextManager:
+        """
+        Serializes inits which share the plugin cache, terraform does not
+        support concurrent installs into it.
+        """
+        if not self.isolate_data_dir or self.dry_run:
+            return contextlib.nullcontext()
+        return FileLock(os.path.join(self.plugin_cache_dir, '.lock'))
 
+    def maintain_plugin_cache(self) -> None:
+        """Marks our providers as recently used, evicts the oldest ones."""
+        if not self.isolate_data_dir or self.dry_run:
+            return
+        touch_plugin_cache_entries(self.data_dir, self.plugin_cache_dir)
+        with self.plugin_cache_lock():
+            for path in prune_plugin_cache(
+                self.plugin_cache_dir, self.plugin_cache_max_bytes
+            ):
+                self.echo(f'Evicted {path} from the plugin cache')
 
-def get_git_root_path() -> str:
-    """Returns the root path of the git repo that is."""
-    git_cmd = ["git", "rev-parse", "--show-toplevel"]
-    return subprocess.check_output(git_cmd).rstrip().decode('ascii')
+    def config_init_hasher(self, lock_file: bool = True) -> InputHasher:
+        """
+        Hashes what the config contributes to our tf init: the lock file,
+        the terraform and module blocks of its .tf files and the
+        terraform binary.
+        Without lock_file, leaves out the lock file, which init may write.
+        """
+        hasher = InputHasher()
+        if lock_file:
+            hasher.add_file(
+                'lock', os.path.join(self.tf_config_path, LOCK_FILE)
+            )
+        for name in sorted(os.listdir(self.tf_config_path)):
+            if not name.endswith('.tf'):
+                continue
+            with open(os.path.join(self.tf_config_path, name)) as f:
+                blocks = init_relevant_blocks(f.read())
+            hasher.add(name, '\n'.join(blocks).encode())
+        hasher.add('terraform', terraform_identity(self.terraform_path))
+        return hasher
 
+    def init_fingerprint(self) -> str:
+        """
+        Hashes everything that determines the result of our tf init:
+        the config's init inputs, plus the backend args and any files
+        they reference.
+        """
+        hasher = self.config_init_hasher()
+        hasher.add_args('backend', self.backend_args)
+        return hasher.hexdigest()
 
-def get_tf_cmd() -> str:
-    """Returns the terraform command path to use."""
-    # You can over-ride the default command 'terraform'
-    # by setting this env var
-    tf_cmd = os.environ.get('TERRAFORM_EXECUTABLE')
-    if not tf_cmd:
+    def template_dir(self) -> str:
+        """
+        The warmed data dir instances of this config are cloned from,
+        see --clone-data-dir. One per config and init inputs, other than
+        the lock file: the template's own init may write that, so it is
+        checked by template_is_ready() instead.
+        """
+        return os.path.join(
+            get_state_dir(self.root_path), 'templates',
+            self.instance.config_type, self.instance.config_name,
+            self.config_init_hasher(lock_file=False).hexdigest()
+        )
+
+    def lock_file_digest(self) -> str:
+        """Hashes the config's lock file, as it is now."""
+        hasher = InputHasher()
+        hasher.add_file(
+            'lock', os.path.join(self.tf_config_path, LOCK_FILE)
+        )
+        return hasher.hexdigest()
+
+    def template_is_ready(self, template_dir: str) -> bool:
+        """
+        True if the template's init completed with the lock file as it
+        is now, and the template is still whole.
+        """
+        try:
+            with open(os.path.join(template_dir, TEMPLATE_READY_FILE)) as f:
+                if f.read().strip() != self.lock_file_digest():
+                    return False
+        except OSError:
+            return False
+        return not broken_provider_links(template_dir)
+
+    def template_steps(self) -> collections.abc.Generator[Step, None, None]:
+        """
+        Warms the config's template data dir with an init that skips the
+        backend, unless it is ready already, then clones it into our data
+        dir. Only one process warms a template, the others wait for it.
+        """
+        template_dir = self.template_dir()
+        with FileLock(template_dir + '.lock') if not self.dry_run \
+                else contextlib.nullcontext():
+            if not self.template_is_ready(template_dir):
+                shutil.rmtree(template_dir, ignore_errors=True)
+                environ = self.environ
+                self.environ = dict(environ, TF_DATA_DIR=template_dir)
+                try:
+                    yield Step('template-init', [
+                        self.terraform_path, 'init', '-backend=false',
+                        '-input=false'
+                    ], lock=True)
+                finally:
+                    self.environ = environ
+                if not self.dry_run and os.path.isdir(template_dir):
+                    with open(os.path.join(
+                        template_dir, TEMPLATE_READY_FILE
+                    ), 'w') as f:
+                        f.write(self.lock_file_digest() + '\n')
+            self.echo(f'Cloning {template_dir} into {self.data_dir}')
+            if not self.dry_run:
+                clone_data_dir(template_dir, self.data_dir)
+
+    def plan_inputs_hasher(self) -> InputHasher:
+        """
+        Hashes what a plan is made from: the var files, backend, the
+        whole config dir (including the lock file) and terraform.
+        """
+        hasher = InputHasher()
+        hasher.add_args('vars', self.var_file_args)
+        hasher.add_args('backend', self.backend_args)
+        hasher.add_tree('config', self.tf_config_path)
+        hasher.add('terraform', terraform_identity(self.terraform_path))
+        return hasher
+
+    def plan_cache_key(self) -> str:
+        """Hashes every input of a plan, including the plan args."""
+        hasher = self.plan_inputs_hasher()
+        hasher.add('args', '\0'.join(self.tf_args).encode())
+        return hasher.hexdigest()
+
+    def saved_plan_dir(self, fingerprint: str = '') -> str:
+        """
+        Where --save-plan keeps the instance's plan made from inputs
+        with this fingerprint, or all of the instance's plans.
+        """
+        return os.path.join(
+            get_state_dir(self.root_path), 'plans',
+            *self.instance.label.split('/'), fingerprint
+        )
+
+    def store_saved_plan(self, plan_dir: str, rc: int) -> None:
+        """
+        Records the fingerprint next to a saved plan, and drops the
+        instance's plans made from other inputs.
+        """
+        if self.dry_run:
+            return
+        fingerprint = os.path.basename(plan_dir)
+        tmp_path = os.path.join(plan_dir, f'fingerprint.json.{os.getpid()}')
+        with open(tmp_path, 'w') as f:
+            json.dump({
+                'fingerprint': fingerprint,
+                'label': self.instance.label,
+                'rc': rc,
+                'created': time.time(),
+            }, f)
+        os.replace(tmp_path, os.path.join(plan_dir, 'fingerprint.json'))
+        instance_dir = os.path.dirname(plan_dir)
+        for name in os.listdir(instance_dir):
+            if name != fingerprint:
+                shutil.rmtree(
+                    os.path.join(instance_dir, name), ignore_errors=True
+                )
+
+    def load_saved_plan(self, plan_dir: str) -> dict:
+        """
+        Returns the record of the saved plan in plan_dir, after checking
+        it was made from the current inputs.
+        """
+        fingerprint = os.path.basename(plan_dir)
+        try:
+            with open(os.path.join(plan_dir, 'fingerprint.json')) as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            saved = None
+        if saved is None or saved['fingerprint'] != fingerprint:
+            if os.path.isdir(os.path.dirname(plan_dir)):
+                reason = 'its inputs have changed since it was planned'
+            else:
+                reason = 'it has no saved plan'
+            raise SystemExit(
+                f'ERROR: cannot apply a saved plan for '
+                f'{self.instance.label}: {reason}. '
+                'Run plan --save-plan again.'
+            )
+        if saved['rc'] == 2 and not os.path.isfile(
+                os.path.join(plan_dir, 'plan.tfplan')):
+            raise SystemExit(
+                f'ERROR: saved plan missing from {plan_dir}'
+            )
+        return saved
+
+    def load_cached_plan(self, entry_dir: str) -> dict:
+        """Returns a plan cache entry younger than the TTL, else None."""
+        try:
+            with open(os.path.join(entry_dir, 'result.json')) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if time.time() - entry['created'] > self.plan_cache_ttl:
+            return None
+        return entry
+
+    def store_cached_plan(
+        self, entry_dir: str, rc: int, output_path: str
+    ) -> None:
+        """Writes a plan cache entry, and drops expired ones."""
+        os.replace(output_path, os.path.join(entry_dir, 'output.log'))
+        tmp_path = os.path.join(entry_dir, f'result.json.{os.getpid()}.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump({
+                'rc': rc, 'created': time.time(), 'summary': self.summary
+            }, f)
+        os.replace(tmp_path, os.path.join(entry_dir, 'result.json'))
+        cache_dir = os.path.dirname(entry_dir)
+        for name in os.listdir(cache_dir):
+            path = os.path.join(cache_dir, name)
+            if path != entry_dir and self.load_cached_plan(path) is None:
+                shutil.rmtree(path, ignore_errors=True)
+
+    def init_is_current(self) -> bool:
+        """True if the last successful init had the same fingerprint."""
+        if self.force_init:
+            return False
+        fingerprint_path = os.path.join(self.data_dir, INIT_FINGERPRINT_FILE)
+        try:
+            with open(fingerprint_path) as f:
+                if f.read().strip() != self.init_fingerprint():
+                    return False
+        except OSError:
+            return False
+        # providers linked from the plugin cache may have been evicted
+        return not broken_provider_links(self.data_dir)
+
+    def save_init_fingerprint(self) -> None:
+        """Records a successful init, if terraform created the data dir."""
+        if self.dry_run or not os.path.isdir(self.data_dir):
+            return
+        fingerprint_path = os.path.join(self.data_dir, INIT_FINGERPRINT_FILE)
+        with open(fingerprint_path, 'w') as f:
+            f.write(self.init_fingerprint() + '\n')
+
+    def tf_steps(self) -> collections.abc.Generator[Step, None, None]:
+        """
+        Plans the commands to execute various terraform commands,
+        providing inferential support where needed. Yields each Step,
+        to be run by the caller before the next one is planned.
+        """
+        with self.trace('discovery'):
+            self.process_args()
+        if self.upstream_outputs:
+            with self.trace('upstream-outputs'):
+                self.process_upstream_outputs()
+        self.cached_rc = None
+        self.summary = None
+        if self.dry_run:
+            self.echo('\n==== Executing in --dryrun mode ===\n')
+
+        saved_plan_dir = None
+        if self.tf_command == 'apply-saved' or (
+                self.save_plan and self.tf_command == 'plan'):
+            saved_plan_dir = self.saved_plan_dir(
+                self.plan_inputs_hasher().hexdigest()
+            )
+        if self.tf_command == 'apply-saved':
+            saved = self.load_saved_plan(saved_plan_dir)
+            if saved['rc'] == 0:
+                self.echo('The saved plan has no changes, nothing to apply.')
+                self.cached_rc = 0
+                return
+
+        plan_cache_dir = None
+        if self.plan_cache and self.tf_command == 'plan' and not self.dry_run:
+            plan_cache_dir = os.path.join(
+                get_state_dir(self.root_path), 'plan-cache',
+                self.plan_cache_key()
+            )
+            cached = None
+            if not self.refresh:
+                with self.trace('plan-cache-lookup'):
+                    cached = self.load_cached_plan(plan_cache_dir)
+            if cached:
+                age = time.time() - cached['created']
+                self.echo(
+                    f'Plan inputs unchanged, using the result cached '
+                    f'{age:.0f}s ago (use --refresh to plan again).\n'
+                )
+                with open(os.path.join(plan_cache_dir, 'output.log')) as f:
+                    shutil.copyfileobj(f, self.stdout)
+                self.cached_rc = cached['rc']
+                self.summary = cached.get('summary')
+                if self.summarize and self.summary:
+                    self.echo(format_summary(self.summary))
+                return
+
+        # tf init
+        if self.tf_command != 'init' and self.init_is_current():
+            self.echo(
+                'Init inputs unchanged since the last init, '
+                'skipping it (use --force-init to override).\n'
+            )
+        else:
+            yield Step(
+                'rm',
+                ['rm', '-rf',
+                 self.data_dir if self.isolate_data_dir else '.terraform']
+            )
+
+            init_cmd = [self.terraform_path, 'init']
+            init_cmd.extend(self.backend_args)
+            if self.tf_command == 'init':
+                # allow the user to run 'init' with their own args
+                init_cmd.extend(self.tf_args)
+                yield Step('init', init_cmd, lock=True)
+                self.save_init_fingerprint()
+                self.maintain_plugin_cache()
+                raise SystemExit(INIT_ONLY_MESSAGE)
+
+            else:
+                if self.clone_data_dir and self.isolate_data_dir:
+                    yield from self.template_steps()
+                    # modules came with the clone, only the backend is new
+                    init_cmd.append('-get=false')
+                yield Step('init', init_cmd, lock=True)
+                self.save_init_fingerprint()
+        self.maintain_plugin_cache()
+
+        # tf command
+        expected_rcs = [0]
+        if self.tf_command == 'plan':
+            # rc 0 means no diff was seen, rc 2 means diff
+            self.tf_args.append('-detailed-exitcode')
+            expected_rcs = [0, 2]
+        # not part of tf_args: it doesn't change what is planned
+        parallelism_args = []
+        if (self.parallelism and self.tf_command in PARALLELISM_COMMANDS
+                and not any(
+                    a.startswith('-parallelism') for a in self.tf_args)):
+            parallelism_args = [f'-parallelism={self.parallelism}']
+
+        cmd = [self.terraform_path, self.tf_command]
+        cmd.extend(self.var_file_args)
+        cmd.extend(self.tf_args)
+        cmd.extend(parallelism_args)
+        # let the user do something special
+        if self.tf_command not in self.special_commands:
+            self.echo(
+                f'Non-default command: "{self.tf_command}" '
+                'executing without modification.\n'
+            )
+            cmd = [
+                self.terraform_path,
+                self.tf_command
+            ] + self.tf_args
+        if self.tf_command in ORDERED_COMMANDS:
+            # these change the state, so its outputs
+            self.invalidate_outputs()
+        if self.tf_command == 'apply-saved':
+            # the plan carries its vars, terraform refuses -var-file here
+            yield Step('apply', [
+                self.terraform_path, 'apply', *self.tf_args,
+                *parallelism_args,
+                os.path.join(saved_plan_dir, 'plan.tfplan')
+            ])
+            self.invalidate_outputs()
+            # terraform won't apply a plan twice
+            if not self.dry_run:
+                shutil.rmtree(saved_plan_dir, ignore_errors=True)
+                with contextlib.suppress(OSError):
+                    os.rmdir(os.path.dirname(saved_plan_dir))
+            return
+        if saved_plan_dir:
+            if not self.dry_run:
+                os.makedirs(saved_plan_dir, exist_ok=True)
+            cmd.append(
+                f'-out={os.path.join(saved_plan_dir, "plan.tfplan")}'
+            )
+            yield Step(self.tf_command, cmd, expected_rcs)
+            rc = self.step_results[-1].rc
+            yield from self.summary_steps(
+                os.path.join(saved_plan_dir, 'plan.tfplan')
+            )
+            self.store_saved_plan(saved_plan_dir, rc)
+            return
+        if not plan_cache_dir:
+            summarized_plan = os.path.join(self.data_dir, 'enviroform.tfplan')
+            if self.summarize and self.tf_command == 'plan':
+                cmd.append(f'-out={summarized_plan}')
+            yield Step(self.tf_command, cmd, expected_rcs)
+            if self.tf_command in ORDERED_COMMANDS:
+                self.invalidate_outputs()
+            yield from self.summary_steps(summarized_plan)
+            return
+
+        # keep a copy of the output and the saved plan for next time
+        os.makedirs(plan_cache_dir, exist_ok=True)
+        cmd.append(f'-out={os.path.join(plan_cache_dir, "plan.tfplan")}')
+        output_path = os.path.join(
+            plan_cache_dir, f'output.log.{os.getpid()}.{id(self)}.tmp'
+        )
+        stdout, stderr = self.stdout, self.stderr
+        with open(output_path, 'w') as output:
+            self.stdout = TeeStream(stdout, output)
+            self.stderr = TeeStream(stderr, output)
+            try:
+                yield Step(self.tf_command, cmd, expected_rcs)
+            except BaseException:
+                os.remove(output_path)
+                raise
+            finally:
+                self.stdout, self.stderr = stdout, stderr
+        rc = self.step_results[-1].rc
+        yield from self.summary_steps(
+            os.path.join(plan_cache_dir, 'plan.tfplan')
+        )
+        self.store_cached_plan(plan_cache_dir, rc, output_path)
+
+    def summary_steps(
+        self, plan_path: str
+    ) -> collections.abc.Generator[Step, None, None]:
+        """
+        With --summarize, after a plan: counts the planned changes by
+        streaming `terraform show -json` of the saved plan through a
+        PlanSummarizer, rather than loading the JSON.
+        """
+        if not self.summarize or self.tf_command != 'plan':
+            return
+        summarizer = PlanSummarizer()
+        # rc 0: no changes, nothing to show
+        if self.step_results[-1].rc == 2:
+            self.command_output = summarizer
+            try:
+                yield Step('show', [
+                    self.terraform_path, 'show', '-json', plan_path
+                ])
+            finally:
+                self.command_output = None
+        self.summary = summarizer.summary()
+        self.echo(format_summary(self.summary))
+
+    def run_tf_cmd(self) -> int:
+        """
+        Runs commands to execute various terraform commands,
+        providing inferential support where needed.
+        Returns: Integer, tf return code.
+        """
+        self.step_results = []
+        rc = 0
+        for step in self.tf_steps():
+            self.step_name = step.name
+            with self.plugin_cache_lock() if step.lock \
+                    else contextlib.nullcontext():
+                rc = self.do_cmd(step.cmd_list, step.expected_rcs)
+        if self.cached_rc is not None:
+            return self.cached_rc
+        return rc
+
+    async def run_tf_cmd_async(self) -> int:
+        """
+        run_tf_cmd(), using asyncio subprocesses. The file work between
+        commands (fingerprints, locks) happens in the default executor,
+        so the event loop is never blocked.
+        """
+        loop = asyncio.get_running_loop()
+        self.step_results = []
+        rc = 0
+        steps = self.tf_steps()
+        step = await loop.run_in_executor(None, next, steps, None)
+        while step is not None:
+            self.step_name = step.name
+            lock = self.plugin_cache_lock() if step.lock \
+                else contextlib.nullcontext()
+            await loop.run_in_executor(None, lock.__enter__)
+            try:
+                rc = await self.do_cmd_async(
+                    step.cmd_list, step.expected_rcs
+                )
+            finally:
+                lock.__exit__(None, None, None)
+            step = await loop.run_in_executor(None, next, steps, None)
+        if self.cached_rc is not None:
+            return self.cached_rc
+        return rc
+
+    def capture_output(self, output: typing.TextIO) -> io.StringIO:
+        """
+        Points our streams at output, or at a new buffer which is
+        returned so the caller can put it in the RunResult.
+        """
+        buffer = None
+        if output is None:
+            output = buffer = io.StringIO()
+        self.stdout = self.stderr = output
+        return buffer
+
+    def make_result(
+        self, rc: int, error: str, start: float, buffer: io.StringIO
+    ) -> RunResult:
+        """Builds the RunResult for run() and run_async()."""
+        return RunResult(
+            rc=rc,
+            duration=time.monotonic() - start,
+            steps=list(self.step_results),
+            output=buffer.getvalue() if buffer else '',
+            error=error,
+            summary=self.summary,
+        )
+
+    @staticmethod
+    def error_rc(err: BaseException) -> tuple[int, str]:
+        """Maps an exception from run_tf_cmd() to an rc and message."""
+        if isinstance(err, CommandError):
+            return err.rc, str(err)
+        if isinstance(err, SystemExit):
+            if err.code == INIT_ONLY_MESSAGE:
+                return 0, ''
+            return 1, str(err.code)
+        return 1, f'{type(err).__name__}: {err}'
+
+    def run(self, output: typing.TextIO = None) -> RunResult:
+        """
+        Library entry point for run_tf_cmd(). Safe to call from many
+        threads at once, with one Enviroform per run.
+        Output goes to output if given, else it is captured in the result.
+        """
+        buffer = self.capture_output(output)
+        start = time.monotonic()
+        try:
+            rc, error = self.run_tf_cmd(), ''
+        except RUN_ERRORS as err:
+            rc, error = self.error_rc(err)
+        return self.make_result(rc, error, start, buffer)
+
+    async def run_async(self, output: typing.TextIO = None) -> RunResult:
+        """run(), for use from an asyncio event loop."""
+        buffer = self.capture_output(output)
+        start = time.monotonic()
+        try:
+            rc, error = await self.run_tf_cmd_async(), ''
+        except RUN_ERRORS as err:
+            rc, error = self.error_rc(err)
+        return self.make_result(rc, error, start, buffer)
+
+
+@dataclasses.dataclass(frozen=True)
+class Instance:
+    """One <instance>.tfvars file and the terraform config it deploys."""
+
+    env: str
+    region: str
+    config_type: str
+    config_name: str
+    name: str
+    tfvars_file_path: str
+    terraform_config_path: str
+
+    @property
+    def label(self) -> str:
+        """e.g. example-account/us-east-1/apps/example-app/default"""
+        return '/'.join([
+            self.env, self.region, self.config_type,
+            self.config_name, self.name
+        ])
+
+    @property
+    def backend_key(self) -> str:
+        """The state key, unique within the region's backend."""
+        return f'{self.config_type}/{self.config_name}/{self.name}/state.tfstate'  # NOQA
+
+
+@dataclasses.dataclass
+class InstanceResult:
+    """Outcome of running a terraform command against one instance."""
+
+    label: str
+    rc: int
+    duration: float
+    log_path: str
+    error: str = ''
+    # the last lines of output
+    tail: list[str] = dataclasses.field(default_factory=list)
+    # watched strings which appeared in the output, see OutputSink
+    seen: set[str] = dataclasses.field(default_factory=set)
+    # counts of planned changes, with --summarize
+    summary: dict = None
+    # seconds spent in each step, e.g. init, plan
+    phases: dict = dataclasses.field(default_factory=dict)
+
+
+@dataclasses.dataclass
+class ExportJob:
+    """One command of one instance, compiled for an external scheduler."""
+
+    # <instance label>/<step name>, e.g. .../example-app/default/init
+    id: str
+    label: str
+    step: str
+    argv: list[str]
+    cwd: str
+    # what enviroform sets on top of the caller's environment
+    env: dict[str, str]
+    expected_rcs: list[int]
+    # ids of the jobs which must succeed first
+    deps: list[str]
+    # jobs of the same pool must not run at the same time
+    pool: str = None
+
+
+class TfvarsParser:
+    """
+    Parses the literal subset of HCL which .tfvars files are mostly
+    written in: `name = value` attributes, where values are strings,
+    heredocs, numbers, bools, null, lists and objects, with comments.
+    Anything else, e.g. interpolation, references or function calls,
+    raises ValueError: terraform has to evaluate those itself.
+    """
+
+    TOKEN = re.compile(r'''
+        (?P<skip>\s+|\#[^\n]*|//[^\n]*|/\*.*?\*/)
+      | <<(?P<indent>-?)(?P<heredoc>[A-Za-z_][A-Za-z0-9_]*)\n
+      | (?P<string>"(?:[^"\\\n]|\\.)*")
+      | (?P<number>-?\d+(?:\.\d+)?(?:[eE][+-]?\d+)?)
+      | (?P<name>[A-Za-z_][A-Za-z0-9_-]*)
+      | (?P<punct>[=:,\[\]{}])
+    ''', re.X | re.S)
+    ESCAPE = re.compile(r'\\(u[0-9a-fA-F]{4}|U[0-9a-fA-F]{8}|.)')
+    ESCAPES = {'n': '\n', 'r': '\r', 't': '\t', '"': '"', '\\': '\\'}
+    TEMPLATE = re.compile(r'(\$\$\{|%%\{)|[$%]\{')
+
+    def __init__(self, text: str) -> None:
+        self.tokens = list(self.tokenize(text))
+        self.pos = 0
+
+    def tokenize(self, text: str) -> collections.abc.Iterator[tuple]:
+        pos = 0
+        while pos < len(text):
+            match = self.TOKEN.match(text, pos)
+            if not match:
+                raise ValueError(f'unsupported syntax: {text[pos:pos + 20]!r}')  # NOQA
+            pos = match.end()
+            kind = match.lastgroup
+            if kind == 'skip':
+                continue
+            if kind == 'heredoc':
+                end = re.compile(
+                    rf'^[ \t]*{match.group("heredoc")}[ \t]*$', re.M
+                ).search(text, pos)
+                if not end:
+                    raise ValueError('unterminated heredoc')
+                lines = text[pos:end.start()].splitlines(keepends=True)
+                if match.group('indent'):
+                    margin = min(
+                        (len(line) - len(line.lstrip(' \t'))
+                         for line in lines if line.strip()), default=0
+                    )
+                    lines = [line[margin:] for line in lines]
+                pos = end.end()
+                yield 'value', self.literal(''.join(lines))
+            elif kind == 'string':
+                yield 'value', self.literal(self.ESCAPE.sub(
+                    self.unescape, match.group(kind)[1:-1]
+                ))
+            elif kind == 'number':
+                number = match.group(kind)
+                yield 'value', float(number) if any(
+                    c in number for c in '.eE') else int(number)
+            else:
+                yield kind, match.group(kind)
+
+    def unescape(self, match: re.Match) -> str:
+        escape = match.group(1)
+        if escape[0] in 'uU':
+            return chr(int(escape[1:], 16))
+        if escape not in self.ESCAPES:
+            raise ValueError(f'unsupported escape: \\{escape}')
+        return self.ESCAPES[escape]
+
+    def literal(self, string: str) -> str:
+        """A string without ${...} or %{...}, which we can't evaluate."""
+        def unescape(match: re.Match) -> str:
+            if not match.group(1):
+                raise ValueError(f'template in string: {string[:40]!r}')
+            return match.group(1)[1:]
+        return self.TEMPLATE.sub(unescape, string)
+
+    def next(self, *expected: str) -> tuple:
+        if self.pos >= len(self.tokens):
+            raise ValueError('unexpected end of file')
+        token = self.tokens[self.pos]
+        if expected and token[1] not in expected:
+            raise ValueError(f'expected {" or ".join(expected)}, '
+                             f'got {token[1]!r}')
+        self.pos += 1
+        return token
+
+    def peek(self) -> str:
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos][1]
+        return None
+
+    def parse(self) -> dict:
+        """The attributes of the file."""
+        attributes = {}
+        while self.pos < len(self.tokens):
+            kind, name = self.next()
+            if kind != 'name':
+                raise ValueError(f'expected a variable name, got {name!r}')
+            if name in attributes:
+                raise ValueError(f'{name} is set twice')
+            self.next('=')
+            attributes[name] = self.value()
+        return attributes
+
+    def value(self) -> typing.Any:
+        kind, value = self.next()
+        if kind == 'value':
+            return value
+        if kind == 'name' and value in ['true', 'false', 'null']:
+            return {'true': True, 'false': False, 'null': None}[value]
+        if value == '[':
+            items = []
+            while self.peek() != ']':
+                items.append(self.value())
+                if self.peek() != ']':
+                    self.next(',')
+            self.next(']')
+            return items
+        if value == '{':
+            items = {}
+            while self.peek() != '}':
+                key_kind, key = self.next()
+                if key_kind not in ['name', 'value'] \
+                        or not isinstance(key, str):
+                    raise ValueError(f'unsupported object key: {key!r}')
+                self.next('=', ':')
+                items[key] = self.value()
+                if self.peek() == ',':
+                    self.next(',')
+            self.next('}')
+            return items
+        raise ValueError(f'unsupported value: {value!r}')
+
+
+def merge_tfvars(paths: list[str]) -> dict:
+    """
+    The variables the .tfvars files set, as terraform would see them:
+    a variable set in a later file replaces its value from earlier ones.
+    """
+    merged = {}
+    for path in paths:
+        with open(path) as f:
+            merged.update(TfvarsParser(f.read()).parse())
+    return merged
+
+
+class OutputsCache:
+    """
+    Instances' outputs (`terraform output -json`) on disk, for a TTL,
+    under <state>/outputs/<env>/<region>/<backend key dir>.json, so the
+    instances reading an upstream's outputs pay one backend read.
+    Concurrent readers of a missing entry take turns, the first one
+    fetches. Commands which change an instance's state invalidate it.
+    """
+
+    def __init__(
+        self, root_path: str, ttl: float = DEFAULT_OUTPUTS_TTL
+    ) -> None:
+        self.cache_dir = os.path.join(get_state_dir(root_path), 'outputs')
+        self.ttl = ttl
+
+    def path(self, instance: Instance) -> str:
+        return os.path.join(
+            self.cache_dir, instance.env, instance.region,
+            os.path.dirname(instance.backend_key) + '.json'
+        )
+
+    def var_file_path(self, instance: Instance) -> str:
+        """Where the instance's upstream_outputs var file goes."""
+        return os.path.join(
+            self.cache_dir, 'vars', instance.env, instance.region,
+            os.path.dirname(instance.backend_key) + '.tfvars.json'
+        )
+
+    def load(self, instance: Instance) -> dict:
+        """The cached outputs, or None if missing or expired."""
+        try:
+            with open(self.path(instance)) as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if time.time() - cached['fetched'] > self.ttl:
+            return None
+        return cached['outputs']
+
+    def get(
+        self,
+        instance: Instance,
+        fetch: typing.Callable[[], dict],
+        refresh: bool = False
+    ) -> dict:
+        """The cached outputs, or what fetch() returns, cached."""
+        if not refresh:
+            outputs = self.load(instance)
+            if outputs is not None:
+                return outputs
+        path = self.path(instance)
+        with FileLock(path + '.lock'):
+            # someone else may have fetched it while we waited
+            outputs = None if refresh else self.load(instance)
+            if outputs is None:
+                outputs = fetch()
+                write_private_json(
+                    path, {'fetched': time.time(), 'outputs': outputs}
+                )
+        return outputs
+
+    def invalidate(self, instance: Instance) -> None:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self.path(instance))
+
+
+def write_private_file(path: str, content: str) -> None:
+    """Writes a file readable by us alone, atomically."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+
+def write_private_json(path: str, data: dict) -> None:
+    """Writes JSON readable by us alone, atomically: outputs may be secret."""
+    write_private_file(path, json.dumps(data, sort_keys=True))
+
+
+def read_outputs(
+    terraform_path: str,
+    root_path: str,
+    known_args: argparse.Namespace,
+    instance: Instance,
+    cancel_event: threading.Event = None
+) -> dict:
+    """
+    Runs init and `terraform output -json` for an instance, in a data
+    dir of its own under <state>/outputs/data, so it doesn't disturb
+    other runs of the instance. Returns the outputs.
+    """
+    known_args = argparse.Namespace(**vars(known_args))
+    known_args.terraform_config_path = instance.terraform_config_path
+    known_args.tfvars_file_path = instance.tfvars_file_path
+    known_args.isolate_data_dir = True
+    known_args.upstream_outputs = False
+    known_args.dry_run = False
+    tf = Enviroform(
+        terraform_path, root_path, known_args, ['output', '-json']
+    )
+    tf.data_dir_base = os.path.join(get_state_dir(root_path), 'outputs', 'data')  # NOQA
+    tf.stdout = io.StringIO()
+    if cancel_event is not None:
+        tf.cancel_event = cancel_event
+    output = io.StringIO()
+    try:
+        for step in tf.tf_steps():
+            tf.step_name = step.name
+            tf.command_output = output if step.name == 'output' else None
+            with tf.plugin_cache_lock() if step.lock \
+                    else contextlib.nullcontext():
+                tf.do_cmd(step.cmd_list, step.expected_rcs)
+        return json.loads(output.getvalue())
+    except (*RUN_ERRORS, ValueError) as e:
+        tail = tf.stdout.getvalue().splitlines()[-DEFAULT_TAIL_LINES:]
+        raise SystemExit('\n'.join([
+            f'ERROR: could not read the outputs of {instance.label}: {e}',
+            *tail
+        ]))
+
+
+class TreeIndex:
+    """
+    A cached listing of the environments and terraform trees, so instances
+    can be found, and their files resolved, without walking the trees.
+
+    Every directory's listing is stored with its mtime and is rescanned
+    only when that mtime changes, i.e. when entries are added, removed or
+    renamed in it. Each directory's mtime is checked once, on its first
+    lookup, until invalidate(). The index is kept in
+    <state dir>/index.json.
+    """
+
+    VERSION = 1
+
+    def __init__(
+        self,
+        root_path: str,
+        environments_dir: str = None,
+        terraform_dir: str = None,
+        cache_path: str = None
+    ) -> None:
+
+        self.root_path = root_path
+        self.environments_dir = environments_dir
+        self.terraform_dir = terraform_dir
+        self.cache_path = cache_path or os.path.join(
+            get_state_dir(root_path), 'index.json'
+        )
+        # relative dir path -> {'mtime_ns': int, 'files': [], 'dirs': []}
+        self.dirs = {}
+        self.dirty = False
+        # dirs whose mtime has been checked, see invalidate()
+        self.validated = set()
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self) -> None:
+        """Reads the cache file, if there is a usable one."""
+        try:
+            with open(self.cache_path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if data.get('version') == self.VERSION:
+            self.dirs = data['dirs']
+
+    def save(self) -> None:
+        """Writes the cache file, if anything changed."""
+        if not self.dirty:
+            return
+        os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+        tmp_path = f'{self.cache_path}.{os.getpid()}.tmp'
+        with self.lock:
+            with open(tmp_path, 'w') as f:
+                json.dump({'version': self.VERSION, 'dirs': self.dirs}, f)
+            os.replace(tmp_path, self.cache_path)
+            self.dirty = False
+
+    def invalidate(self) -> None:
+        """
+        Has the next lookup of each directory check its mtime again,
+        e.g. for each request a long running process serves.
+        """
+        self.validated = set()
+
+    def listing(self, rel_dir: str) -> dict:
+        """
+        Returns the up to date listing of a directory relative to the
+        root, or None if it is not a directory.
+        """
+        rel_dir = os.path.normpath(rel_dir)
+        if rel_dir in self.validated:
+            return self.dirs.get(rel_dir)
+        self.validated.add(rel_dir)
+        try:
+            mtime_ns = os.stat(os.path.join(self.root_path, rel_dir)).st_mtime_ns  # NOQA
+        except OSError:
+            mtime_ns = None
+        entry = self.dirs.get(rel_dir)
+        if entry is not None and entry['mtime_ns'] == mtime_ns:
+            return entry
+        entry = None
+        if mtime_ns is not None:
+            files, dirs = [], []
+            try:
+                with os.scandir(os.path.join(self.root_path, rel_dir)) as it:
+                    for dir_entry in it:
+                        if dir_entry.is_dir():
+                            dirs.append(dir_entry.name)
+                        else:
+                            files.append(dir_entry.name)
+            except NotADirectoryError:
+                mtime_ns = None
+            else:
+                entry = {
+                    'mtime_ns': mtime_ns,
+                    'files': sorted(files),
+                    'dirs': sorted(dirs),
+                }
+        with self.lock:
+            if entry is None:
+                self.dirs.pop(rel_dir, None)
+            else:
+                self.dirs[rel_dir] = entry
+            self.dirty = True
+        return entry
+
+    def walk(
+        self, rel_dir: str, depth: int, validate: bool = True
+    ) -> collections.abc.Iterator[tuple[str, dict]]:
+        """
+        Yields (dir, listing) for rel_dir and its subdirs, depth levels
+        down. Without validate, the cached listings are trusted.
+        """
+        rel_dir = os.path.normpath(rel_dir)
+        if validate:
+            entry = self.listing(rel_dir)
+        else:
+            entry = self.dirs.get(rel_dir)
+        if entry is None:
+            return
+        yield rel_dir, entry
+        if depth > 0:
+            for name in entry['dirs']:
+                yield from self.walk(
+                    os.path.join(rel_dir, name), depth - 1, validate
+                )
+
+    def scan_roots(self) -> list[tuple[str, int]]:
+        """The trees we index, and how many levels of dirs they have."""
+        roots = []
+        if self.environments_dir:
+            # <env>/<region>/<config_type>/<config_name>
+            roots.append((self.environments_dir, 4))
+        if self.terraform_dir:
+            # <config_type>/<config_name>
+            roots.append((self.terraform_dir, 2))
+        return roots
+
+    def refresh(self) -> 'TreeIndex':
+        """Brings the whole index up to date, one stat per directory."""
+        seen = set()
+        for rel_dir, depth in self.scan_roots():
+            seen.update(d for d, _ in self.walk(rel_dir, depth))
+        stale = set(self.dirs) - seen
+        if stale:
+            with self.lock:
+                for rel_dir in stale:
+                    del self.dirs[rel_dir]
+                self.dirty = True
+        return self
+
+    def rel_path(self, path: str) -> str:
+        """path relative to the root."""
+        return os.path.relpath(os.path.join(self.root_path, path),
+                               self.root_path)
+
+    def has_file(self, path: str) -> bool:
+        """os.path.isfile(), answered from the index."""
+        rel_dir, name = os.path.split(self.rel_path(path))
+        entry = self.listing(rel_dir or '.')
+        return entry is not None and name in entry['files']
+
+    def has_dir(self, path: str) -> bool:
+        """os.path.isdir(), answered from the index."""
+        return self.listing(self.rel_path(path)) is not None
+
+    def instances(self) -> list[Instance]:
+        """
+        Every <env>/<region>/<config_type>/<config_name>/<instance>.tfvars,
+        as of the last refresh(). Sorted by label.
+        """
+        instances = []
+        base = os.path.normpath(self.environments_dir)
+        for rel_dir, entry in self.walk(base, 4, validate=False):
+            components = os.path.relpath(rel_dir, base).split(os.sep)
+            if len(components) != 4:
+                continue
+            env, region, config_type, config_name = components
+            for filename in entry['files']:
+                if not filename.endswith('.tfvars'):
+                    continue
+                instances.append(Instance(
+                    env=env,
+                    region=region,
+                    config_type=config_type,
+                    config_name=config_name,
+                    name=filename.split('.')[0],
+                    tfvars_file_path=os.path.join(rel_dir, filename),
+                    terraform_config_path=os.path.join(
+                        self.terraform_dir or '', config_type, config_name
+                    ),
+                ))
+        return sorted(instances, key=lambda i: i.label)
+
+
+def discover_instances(
+    root_path: str, environments_dir: str, terraform_dir: str
+) -> list[Instance]:
+    """
+    Finds every <env>/<region>/<config_type>/<config_name>/<instance>.tfvars
+    file in environments_dir, via the cached TreeIndex.
+    Paths are returned relative to root_path, sorted by label.
+    """
+    index = TreeIndex(root_path, environments_dir, terraform_dir).refresh()
+    index.save()
+    return index.instances()
+
+
+def filter_instances(
+    instances: list[Instance], patterns: list[str]
+) -> list[Instance]:
+    """Instances whose label matches any of the glob patterns."""
+    if not patterns:
+        return instances
+    return [
+        i for i in instances
+        if any(fnmatch.fnmatch(i.label, p) for p in patterns)
+    ]
+
+
+def query_instances(
+    instances: list[Instance], terms: list[str]
+) -> list[Instance]:
+    """
+    Instances matching every field=glob term, where field is one of
+    env, region, config_type, config_name, name, backend_key.
+    """
+    fields = [
+        'env', 'region', 'config_type', 'config_name', 'name', 'backend_key'
+    ]
+    matchers = []
+    for term in terms:
+        field, sep, pattern = term.partition('=')
+        if not sep or field not in fields:
+            raise SystemExit(
+                f'ERROR: query terms look like <field>=<glob>, '
+                f'with field one of: {", ".join(fields)}. Got: {term}'
+            )
+        matchers.append((field, pattern))
+    return [
+        i for i in instances
+        if all(fnmatch.fnmatch(getattr(i, f), p) for f, p in matchers)
+    ]
+
+
+def get_changed_files(root_path: str, since: str) -> list[str]:
+    """
+    Files changed since the merge base of since and HEAD, including
+    uncommitted and untracked ones. Relative to root_path.
+    Renames are listed as a deletion and an addition.
+    """
+    def git(*args: str) -> list[str]:
+        return subprocess.check_output(
+            ['git', *args], cwd=root_path, text=True
+        ).splitlines()
+
+    try:
+        base = git('merge-base', since, 'HEAD')[0]
+        changed = git('diff', '--name-only', '--no-renames', base)
+        changed += git('ls-files', '--others', '--exclude-standard')
+    except subprocess.CalledProcessError as err:
+        raise SystemExit(f'ERROR: could not diff against {since}: {err}')
+    return sorted(set(changed))
+
+
+# module "x" { source = "../../modules/x" }
+LOCAL_MODULE_SOURCE = re.compile(
+    r'^\s*source\s*=\s*"(\.\.?/[^"]*)"', re.M
+)
+
+
+def local_module_dirs(root_path: str, config_dir: str) -> set[str]:
+    """
+    The local module dirs a config uses, directly or through other
+    local modules. Relative to root_path.
+    """
+    found = set()
+    todo = [config_dir]
+    while todo:
+        rel_dir = todo.pop()
+        try:
+            names = os.listdir(os.path.join(root_path, rel_dir))
+        except OSError:
+            continue
+        for name in names:
+            if not name.endswith('.tf'):
+                continue
+            with open(os.path.join(root_path, rel_dir, name)) as f:
+                sources = LOCAL_MODULE_SOURCE.findall(f.read())
+            for source in sources:
+                module_dir = os.path.normpath(os.path.join(rel_dir, source))
+                if module_dir not in found:
+                    found.add(module_dir)
+                    todo.append(module_dir)
+    return found
+
+
+def affected_instances(
+    root_path: str,
+    instances: list[Instance],
+    changed_files: list[str],
+    environments_dir: str,
+    terraform_dir: str
+) -> list[Instance]:
+    """
+    The instances whose inputs include one of changed_files, following
+    the .tfvars hierarchy of Enviroform.process_tfvars():
+      <env>/environment.tfvars: every instance in the environment
+      <env>/<region>/backend.tfvars, region.tfvars: every instance
+        in the region
+      <env>/<region>/<type>/<config>/<instance>.tfvars: that instance
+      <terraform_dir>/<type>/<config>/**, and any local module it uses:
+        every instance of the config
+    """
+    environments_dir = os.path.normpath(environments_dir)
+    terraform_dir = os.path.normpath(terraform_dir)
+    envs, regions, configs, tfvars_files = set(), set(), set(), set()
+    other_files = []
+    for path in map(os.path.normpath, changed_files):
+        if path.startswith(environments_dir + os.sep):
+            components = os.path.relpath(path, environments_dir).split(os.sep)
+            if components[1:] == ['environment.tfvars']:
+                envs.add(components[0])
+            elif components[2:] in [['backend.tfvars'], ['region.tfvars']]:
+                regions.add(tuple(components[:2]))
+            elif len(components) == 5 and path.endswith('.tfvars'):
+                tfvars_files.add(path)
+        elif path.startswith(terraform_dir + os.sep):
+            components = os.path.relpath(path, terraform_dir).split(os.sep)
+            if len(components) > 2:
+                configs.add(os.path.join(terraform_dir, *components[:2]))
+            other_files.append(path)
+        else:
+            other_files.append(path)
+
+    # changes to local modules affect the configs using them
+    for config_dir in {i.terraform_config_path for i in instances} - configs:
+        for module_dir in local_module_dirs(root_path, config_dir):
+            if any(f.startswith(module_dir + os.sep) for f in other_files):
+                configs.add(config_dir)
+                break
+
+    return [
+        i for i in instances
+        if i.env in envs
+        or (i.env, i.region) in regions
+        or os.path.normpath(i.terraform_config_path) in configs
+        or os.path.normpath(i.tfvars_file_path) in tfvars_files
+    ]
+
+
+# data "terraform_remote_state" "<name>" { ... } blocks in a config
+REMOTE_STATE_BLOCK = re.compile(
+    r'^\s*data\s+"terraform_remote_state"\s+"[^"]*"\s*\{(.*?)^\}', re.M | re.S
+)
+
+# a literal state key inside such a block
+REMOTE_STATE_KEY = re.compile(r'^\s*key\s*=\s*"([^"$]+)"', re.M)
+
+# e.g. # enviroform: depends_on infra/example-networking/default
+DEPENDS_ON_DIRECTIVE = re.compile(
+    r'^\s*#\s*enviroform:\s*depends_on\s+(\S+)\s*$', re.M
+)
+
+# fleet commands run in dependency order, see dependency_graph()
+ORDERED_COMMANDS = ['apply', 'apply-saved', 'destroy', 'import', 'refresh']
+
+
+def remote_state_keys(root_path: str, config_dir: str) -> set[str]:
+    """
+    The literal state keys a config reads through terraform_remote_state,
+    directly or through its local modules.
+    """
+    keys = set()
+    for rel_dir in [config_dir] + sorted(
+        local_module_dirs(root_path, config_dir)
+    ):
+        for path in glob.glob(os.path.join(root_path, rel_dir, '*.tf')):
+            with open(path) as f:
+                for block in REMOTE_STATE_BLOCK.findall(f.read()):
+                    keys.update(REMOTE_STATE_KEY.findall(block))
+    return keys
+
+
+def declared_dependencies(root_path: str, tfvars_file_path: str) -> set[str]:
+    """
+    State keys named by '# enviroform: depends_on <type>/<config>/<instance>'
+    comments in an instance .tfvars file.
+    """
+    with open(os.path.join(root_path, tfvars_file_path)) as f:
+        names = DEPENDS_ON_DIRECTIVE.findall(f.read())
+    return {
+        n if n.endswith('.tfstate') else n.strip('/') + '/state.tfstate'
+        for n in names
+    }
+
+
+def dependency_graph(
+    root_path: str, instances: list[Instance]
+) -> dict[str, set[str]]:
+    """
+    Maps each instance label to the labels of the instances it depends
+    on. Keys are unique within a region's backend, so a dependency is
+    looked for in the instance's own env/region. Keys matching no
+    instance in `instances` are ignored.
+    """
+    by_key = {
+        (i.env, i.region, i.backend_key): i.label for i in instances
+    }
+    config_keys = {}
+    graph = {}
+    for i in instances:
+        if i.terraform_config_path not in config_keys:
+            config_keys[i.terraform_config_path] = remote_state_keys(
+                root_path, i.terraform_config_path
+            )
+        keys = config_keys[i.terraform_config_path] | declared_dependencies(
+            root_path, i.tfvars_file_path
+        )
+        graph[i.label] = {
+            by_key[(i.env, i.region, key)] for key in keys
+            if (i.env, i.region, key) in by_key
+        } - {i.label}
+    return graph
+
+
+def reverse_graph(graph: dict[str, set[str]]) -> dict[str, set[str]]:
+    """Swaps the direction of every edge, e.g. for destroy."""
+    reversed_graph = {label: set() for label in graph}
+    for label, deps in graph.items():
+        for dep in deps:
+            reversed_graph[dep].add(label)
+    return reversed_graph
+
+
+def dependency_levels(graph: dict[str, set[str]]) -> list[list[str]]:
+    """
+    Groups labels into levels: each only depends on earlier levels.
+    Raises SystemExit if the graph has a cycle.
+    """
+    remaining = {label: set(deps) for label, deps in graph.items()}
+    levels = []
+    while remaining:
+        level = sorted(label for label, deps in remaining.items() if not deps)
+        if not level:
+            raise SystemExit(
+                'ERROR: dependency cycle between: '
+                + ', '.join(sorted(remaining))
+            )
+        for label in level:
+            del remaining[label]
+        for deps in remaining.values():
+            deps.difference_update(level)
+        levels.append(level)
+    return levels
+
+
+def critical_path_lengths(graph: dict[str, set[str]]) -> dict[str, int]:
+    """
+    Maps each label to the length of the longest chain of instances
+    waiting on it, itself included. Assumes no cycles.
+    """
+    dependents = reverse_graph(graph)
+    lengths = {}
+    # dependents come first in these levels
+    for level in dependency_levels(dependents):
+        for label in level:
+            lengths[label] = 1 + max(
+                [lengths[d] for d in dependents[label]], default=0
+            )
+    return lengths
+
+
+def shard_instances(
+    instances: list[Instance],
+    shard: int,
+    shards: int,
+    durations: dict[str, float],
+    graph: dict[str, set[str]] = None
+) -> list[Instance]:
+    """
+    The instances of shard number `shard` (1 to `shards`), balanced by
+    expected run time rather than count. The same inputs give the same
+    shards on every node.
+    Instances of a config stay together where they can, so one node
+    reuses its data dirs and plugin cache for them. A config expected
+    to take longer than a shard's fair share is split. With a
+    dependency graph, instances which depend on one another, and their
+    configs, are never split. Groups are assigned longest first, each
+    to the least loaded shard.
+    Instances missing from `durations` are expected to take the mean.
+    """
+    known = [durations[i.label] for i in instances
+             if durations.get(i.label)]
+    default = statistics.mean(known) if known else 1.0
+    cost = {i.label: durations.get(i.label) or default for i in instances}
+
+    parent = {}
+
+    def find(key: str) -> str:
+        while parent.setdefault(key, key) != key:
+            parent[key] = parent[parent[key]]
+            key = parent[key]
+        return key
+
+    config = {i.label: i.terraform_config_path for i in instances}
+    for label, deps in (graph or {}).items():
+        for dep in deps:
+            parent[find(config[label])] = find(config[dep])
+    groups = collections.defaultdict(list)
+    for instance in sorted(instances, key=lambda i: i.label):
+        groups[find(instance.terraform_config_path)].append(instance)
+
+    # groups holding a dependency, which must stay whole
+    linked = {
+        find(config[label]) for label, deps in (graph or {}).items() if deps
+    }
+    fair_share = sum(cost.values()) / shards
+    pieces = []
+    for key in sorted(groups):
+        piece = []
+        for instance in groups[key]:
+            if (key not in linked and piece and sum(
+                    cost[i.label] for i in piece
+            ) + cost[instance.label] > fair_share):
+                pieces.append(piece)
+                piece = []
+            piece.append(instance)
+        pieces.append(piece)
+    pieces.sort(key=lambda p: (-sum(cost[i.label] for i in p), p[0].label))
+
+    loads = [0.0] * shards
+    assigned = [set() for _ in range(shards)]
+    for piece in pieces:
+        n = min(range(shards), key=lambda n: (loads[n], n))
+        loads[n] += sum(cost[i.label] for i in piece)
+        assigned[n].update(i.label for i in piece)
+    return [i for i in instances if i.label in assigned[shard - 1]]
+
+
+def broken_provider_links(data_dir: str) -> list[str]:
+    """Returns provider links in data_dir whose target no longer exists."""
+    broken = []
+    for dirpath, dirnames, filenames in os.walk(
+        os.path.join(data_dir, 'providers')
+    ):
+        for name in dirnames + filenames:
+            path = os.path.join(dirpath, name)
+            if os.path.islink(path) and not os.path.exists(path):
+                broken.append(path)
+    return broken
+
+
+def touch_plugin_cache_entries(data_dir: str, cache_dir: str) -> None:
+    """
+    Terraform links providers from data_dir/providers into the plugin
+    cache. Bump the mtime of every cache entry we link to, so
+    prune_plugin_cache() evicts the least recently used ones.
+    """
+    cache_dir = os.path.realpath(cache_dir) + os.sep
+    for dirpath, dirnames, filenames in os.walk(
+        os.path.join(data_dir, 'providers')
+    ):
+        for name in dirnames + filenames:
+            path = os.path.join(dirpath, name)
+            if not os.path.islink(path):
+                continue
+            target = os.path.realpath(path)
+            if target.startswith(cache_dir) and os.path.exists(target):
+                os.utime(target)
+
+
+def prune_plugin_cache(cache_dir: str, max_bytes: int) -> list[str]:
+    """
+    Removes the least recently used provider builds
+    (<host>/<namespace>/<type>/<version>/<platform>) from the plugin cache
+    until it is no larger than max_bytes. Returns the removed paths.
+    """
+    entries = []
+    pattern = os.path.join(cache_dir, *['*'] * 5)
+    for path in glob.glob(pattern):
+        if not os.path.isdir(path):
+            continue
+        size = 0
+        for dirpath, _, filenames in os.walk(path):
+            for name in filenames:
+                size += os.lstat(os.path.join(dirpath, name)).st_size
+        entries.append((os.stat(path).st_mtime, path, size))
+    total = sum(size for _, _, size in entries)
+    removed = []
+    for _, path, size in sorted(entries):
+        if total <= max_bytes:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+        removed.append(path)
+    return removed
+
+
+def find_lock_files(root_path: str, terraform_dir: str) -> list[str]:
+    """The .terraform.lock.hcl of every config under terraform_dir."""
+    paths = []
+    for dirpath, dirnames, filenames in os.walk(
+        os.path.join(root_path, terraform_dir)
+    ):
+        dirnames[:] = sorted(d for d in dirnames if not d.startswith('.'))
+        if LOCK_FILE in filenames:
+            paths.append(os.path.join(dirpath, LOCK_FILE))
+    return paths
+
+
+def locked_providers(lock_paths: list[str]) -> dict[tuple, set[str]]:
+    """
+    Maps each (source, version) locked by any of the lock files to the
+    zh: (zip sha256) hashes recorded for it, across all of them.
+    """
+    providers = collections.defaultdict(set)
+    for path in lock_paths:
+        with open(path) as f:
+            content = f.read()
+        for match in LOCK_PROVIDER_BLOCK.finditer(content):
+            version = LOCK_VERSION.search(match.group(2))
+            if not version:
+                continue
+            source = match.group(1)
+            if source.count('/') == 1:
+                source = f'{DEFAULT_REGISTRY_HOST}/{source}'
+            providers[(source, version.group(1))].update(
+                LOCK_ZIP_HASH.findall(match.group(2))
+            )
+    return dict(providers)
+
+
+def current_platform() -> str:
+    """terraform's name for this platform, e.g. linux_amd64."""
+    machine = os.uname().machine.lower()
+    arch = {
+        'x86_64': 'amd64', 'aarch64': 'arm64', 'i386': '386',
+        'i686': '386', 'armv7l': 'arm',
+    }.get(machine, machine)
+    return f'{sys.platform.rstrip("0123456789")}_{arch}'
+
+
+def mirror_package_path(
+    mirror_dir: str, source: str, version: str, platform: str
+) -> str:
+    """Where a provider package goes in a packed filesystem mirror."""
+    provider_type = source.rsplit('/', 1)[1]
+    return os.path.join(
+        mirror_dir, *source.split('/'),
+        f'terraform-provider-{provider_type}_{version}_{platform}.zip'
+    )
+
+
+def mirror_covers(mirror_dir: str, lock_path: str, platform: str) -> bool:
+    """True if the mirror has every provider the lock file locks."""
+    if not os.path.exists(lock_path):
+        return False
+    return all(
+        os.path.exists(mirror_package_path(mirror_dir, *key, platform))
+        for key in locked_providers([lock_path])
+    )
+
+
+class ProviderRegistry:
+    """
+    Finds provider packages through the provider registry protocol:
+    service discovery at /.well-known/terraform.json, then the download
+    endpoint of each provider version and platform.
+    With a base_url, every host is looked up there instead, e.g. a
+    local stand-in registry.
+    """
+
+    def __init__(self, base_url: str = None, timeout: float = 60) -> None:
+        self.base_url = base_url
+        self.timeout = timeout
+        self.services = {}
+        self.lock = threading.Lock()
+
+    def get(self, url: str) -> bytes:
+        with urllib.request.urlopen(url, timeout=self.timeout) as response:
+            return response.read()
+
+    def providers_url(self, host: str) -> str:
+        """The providers.v1 service URL of a registry host."""
+        with self.lock:
+            if host not in self.services:
+                base = self.base_url or f'https://{host}'
+                discovery = urllib.parse.urljoin(
+                    base + '/', '.well-known/terraform.json'
+                )
+                services = json.loads(self.get(discovery))
+                if 'providers.v1' not in services:
+                    raise ValueError(f'{host} serves no providers')
+                self.services[host] = urllib.parse.urljoin(
+                    discovery, services['providers.v1']
+                )
+            return self.services[host]
+
+    def download(self, source: str, version: str, platform: str) -> tuple:
+        """Returns (package bytes, their expected sha256 hex)."""
+        host, namespace, provider_type = source.split('/')
+        url = urllib.parse.urljoin(
+            self.providers_url(host),
+            f'{namespace}/{provider_type}/{version}/download/'
+            f'{platform.replace("_", "/")}'
+        )
+        info = json.loads(self.get(url))
+        data = self.get(urllib.parse.urljoin(url, info['download_url']))
+        return data, info['shasum']
+
+
+def warm_provider(
+    registry: ProviderRegistry,
+    mirror_dir: str,
+    source: str,
+    version: str,
+    platform: str,
+    hashes: set[str]
+) -> bool:
+    """
+    Puts one provider package in the mirror, unless it is there already.
+    The package must match the registry's shasum and, if the lock files
+    recorded any zh: hashes for the version, one of those.
+    Returns: True if it was downloaded.
+    """
+    path = mirror_package_path(mirror_dir, source, version, platform)
+    if os.path.exists(path):
+        return False
+    data, shasum = registry.download(source, version, platform)
+    digest = hashlib.sha256(data).hexdigest()
+    if digest != shasum:
+        raise ValueError(f'checksum mismatch, got {digest}, '
+                         f'the registry says {shasum}')
+    if hashes and f'zh:{digest}' not in hashes:
+        raise ValueError(f'zh:{digest} is not in the lock files')
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+    return True
+
+
+def write_mirror_config(
+    path: str, mirror_dir: str, hosts: list[str]
+) -> None:
+    """
+    Writes a terraform CLI config which installs providers of the given
+    registry hosts from the mirror only, and any others directly.
+    """
+    include = ', '.join(f'"{host}/*/*"' for host in sorted(hosts))
+    with open(path, 'w') as f:
+        f.write(
+            '# written by enviroform.py warm\n'
+            'provider_installation {\n'
+            '  filesystem_mirror {\n'
+            f'    path    = "{os.path.abspath(mirror_dir)}"\n'
+            f'    include = [{include}]\n'
+            '  }\n'
+            '  direct {\n'
+            f'    exclude = [{include}]\n'
+            '  }\n'
+            '}\n'
+        )
+
+
+def cli_config_with_mirror(
+    mirror_config_path: str, user_config_path: str, configs_dir: str
+) -> str:
+    """
+    The mirror's CLI config, with the user's own CLI config, e.g. its
+    credentials and plugin_cache_dir, copied in ahead of it. Written
+    to configs_dir, named by a hash of its content and readable by us
+    alone, since credentials are secret.
+    Returns: its path, or None if the user's config chooses its own
+    provider_installation, or is JSON, which can't be combined.
+    """
+    try:
+        with open(user_config_path) as f:
+            user_config = f.read()
+    except OSError:
+        return mirror_config_path
+    if (user_config_path.endswith('.json')
+            or PROVIDER_INSTALLATION.search(user_config)):
+        return None
+    with open(mirror_config_path) as f:
+        content = (f'# from {user_config_path}\n{user_config.rstrip()}\n\n'
+                   f'{f.read()}')
+    path = os.path.join(
+        configs_dir, hashlib.sha256(content.encode()).hexdigest() + '.tfrc'
+    )
+    if not os.path.exists(path):
+        write_private_file(path, content)
+    return path
+
+
+def clone_data_dir(template_dir: str, data_dir: str) -> None:
+    """
+    Copies a template data dir. Provider binaries, the bulk of it, are
+    hardlinked (or stay symlinks into the plugin cache), everything
+    else is copied, since terraform may rewrite it.
+    """
+    def link_or_copy(src: str, dst: str) -> None:
+        try:
+            os.link(src, dst)
+        except OSError:
+            # e.g. across filesystems
+            shutil.copy2(src, dst)
+
+    os.makedirs(data_dir, exist_ok=True)
+    for entry in os.scandir(template_dir):
+        if entry.name == TEMPLATE_READY_FILE:
+            continue
+        dst = os.path.join(data_dir, entry.name)
+        if entry.is_dir(follow_symlinks=False):
+            shutil.copytree(
+                entry.path, dst, symlinks=True,
+                copy_function=link_or_copy if entry.name == 'providers'
+                else shutil.copy2
+            )
+        else:
+            shutil.copy2(entry.path, dst, follow_symlinks=False)
+
+
+def get_log_path(log_dir: str, instance: Instance) -> str:
+    """Returns the log file path for an instance."""
+    return os.path.join(log_dir, instance.label.replace('/', '__') + '.log')
+
+
+class ResourceBudget:
+    """
+    Decides whether the machine has room for one more terraform run:
+    enough memory left for another run as big as the biggest so far,
+    and, optionally, a load average below max_load.
+    """
+
+    def __init__(self, min_free_mb: int, max_load: float = None) -> None:
+        self.min_free_bytes = min_free_mb * 1024 * 1024
+        self.max_load = max_load
+        # the biggest run sampled so far, providers included, in bytes
+        self.peak_rss = 0
+
+    @staticmethod
+    def available_memory() -> int:
+        """MemAvailable in bytes, None where /proc/meminfo is missing."""
+        try:
+            with open('/proc/meminfo') as f:
+                for line in f:
+                    if line.startswith('MemAvailable:'):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            pass
+        return None
+
+    @staticmethod
+    def runs_rss() -> dict[int, int]:
+        """
+        The RSS of each of our running commands, in bytes, by pid:
+        terraform leads a session of its own (see Enviroform.call()),
+        which the provider plugins it starts are in too.
+        Empty where /proc is missing.
+        """
+        our_pid = os.getpid()
+        page_size = resource.getpagesize()
+        leaders = set()
+        sessions = collections.Counter()
+        try:
+            pids = [name for name in os.listdir('/proc') if name.isdigit()]
+        except OSError:
+            return {}
+        for pid in pids:
+            try:
+                with open(f'/proc/{pid}/stat') as f:
+                    stat = f.read()
+            except OSError:
+                continue
+            # after the command name, in parens as it may hold spaces
+            fields = stat[stat.rindex(')') + 2:].split()
+            ppid, session = int(fields[1]), int(fields[3])
+            rss = int(fields[21])
+            if ppid == our_pid and session == int(pid):
+                leaders.add(session)
+            sessions[session] += rss * page_size
+        return {pid: sessions[pid] for pid in leaders}
+
+    def expected_rss(self) -> int:
+        """
+        The memory one more run is expected to take, in bytes: the
+        biggest run sampled so far, terraform and its providers
+        together, sampled from /proc each time we're asked. Until a run
+        has been sampled, or without /proc, it is the peak RSS of the
+        biggest finished child times RSS_SAFETY_FACTOR: that RSS is of
+        terraform alone, without its providers, so is too low.
+        """
+        runs = self.runs_rss()
+        if runs:
+            self.peak_rss = max(self.peak_rss, *runs.values())
+        rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        # kB on Linux, bytes on macOS
+        rss = rss if sys.platform == 'darwin' else rss * 1024
+        if self.peak_rss:
+            return max(self.peak_rss, rss)
+        return rss * RSS_SAFETY_FACTOR
+
+    def room(self, starting: int = 0) -> str:
+        """
+        Returns '' if one more run fits, after the `starting` runs
+        which haven't grown yet, else what is short.
+        """
+        available = self.available_memory()
+        if available is not None:
+            needed = self.min_free_bytes + self.expected_rss() * (starting + 1)
+            if available < needed:
+                return f'{available // 2 ** 20} MB of memory available'
+        if self.max_load is not None:
+            load = os.getloadavg()[0]
+            if load > self.max_load:
+                return f'load average {load:.1f}'
+        return ''
+
+
+def get_journal_path(root_path: str, run_id: str) -> str:
+    """Returns the journal file path for a fleet run."""
+    return os.path.join(get_state_dir(root_path), 'runs', run_id + '.jsonl')
+
+
+class Journal:
+    """
+    An append-only record of a fleet run, one JSON object per line:
+    a 'run' record with the command, then 'start' and 'finish'
+    records for each instance as the run progresses. Each line is
+    flushed as it is written, so the journal survives the run dying.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = None
+
+    def open(self) -> 'Journal':
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.file = open(self.path, 'a')
+        return self
+
+    def close(self) -> None:
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def record(self, event: str, **fields) -> None:
+        """Appends one record."""
+        line = json.dumps(dict(event=event, time=time.time(), **fields))
+        with self.lock:
+            self.file.write(line + '\n')
+            self.file.flush()
+
+    def load(self) -> tuple[dict, dict[str, dict]]:
+        """
+        Returns the run record and each instance's last record.
+        A torn last line, from the run dying mid write, is ignored.
+        """
+        run, instances = None, {}
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    if record['event'] == 'run':
+                        run = run or record
+                    elif 'label' in record:
+                        instances[record['label']] = record
+        except OSError:
+            pass
+        if run is None:
+            raise SystemExit(f'ERROR: no fleet run journal at {self.path}')
+        return run, instances
+
+
+def get_history_path(root_path: str) -> str:
+    """Returns the path of the run history database."""
+    return os.path.join(get_state_dir(root_path), 'history.sqlite')
+
+
+@dataclasses.dataclass
+class InstanceHistory:
+    """What past runs of one command say about an instance."""
+
+    # mean duration of recent successful runs, in seconds
+    expected: float
+    # how many of the latest plans in a row found no changes
+    stable_runs: int
+    # when it last ran
+    last_run: float
+
+
+class HistoryStore:
+    """
+    Every fleet run of every instance, in SQLite: rc, duration, time
+    spent in each phase and, with --summarize, the planned changes.
+    Read back to order and budget drift runs, see Fleet.drift_order().
+    """
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS runs (
+            run_id TEXT NOT NULL,
+            label TEXT NOT NULL,
+            backend_key TEXT NOT NULL,
+            command TEXT NOT NULL,
+            rc INTEGER NOT NULL,
+            started REAL NOT NULL,
+            duration REAL NOT NULL,
+            phases TEXT NOT NULL,
+            creates INTEGER,
+            updates INTEGER,
+            replaces INTEGER,
+            deletes INTEGER
+        );
+        CREATE INDEX IF NOT EXISTS runs_by_label
+            ON runs (command, label, started);
+    '''
+    # runs of an instance that make up its history
+    RECENT_RUNS = 10
+
+    def __init__(self, path: str) -> None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.executescript(self.SCHEMA)
+
+    def close(self) -> None:
+        self.db.close()
+
+    def record(
+        self,
+        run_id: str,
+        command: str,
+        instance: Instance,
+        result: InstanceResult
+    ) -> None:
+        """Adds one instance's run."""
+        summary = result.summary or {}
+        with self.db:
+            self.db.execute(
+                'INSERT INTO runs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (
+                    run_id, instance.label, instance.backend_key, command,
+                    result.rc, time.time() - result.duration,
+                    result.duration, json.dumps(result.phases),
+                    summary.get('create'), summary.get('update'),
+                    summary.get('replace'), summary.get('delete'),
+                )
+            )
+
+    def instances(self, command: str) -> dict[str, InstanceHistory]:
+        """The history of each instance that has run command."""
+        rows = self.db.execute('''
+            SELECT label, rc, duration, started FROM (
+                SELECT *, ROW_NUMBER() OVER (
+                    PARTITION BY label ORDER BY started DESC
+                ) AS n
+                FROM runs WHERE command = ?
+            ) WHERE n <= ? ORDER BY label, started DESC
+        ''', (command, self.RECENT_RUNS))
+        history = {}
+        for label, group in itertools.groupby(rows, key=lambda r: r[0]):
+            group = list(group)
+            durations = [r[2] for r in group if r[1] in [0, 2]]
+            stable_runs = 0
+            for row in group:
+                if row[1] != 0:
+                    break
+                stable_runs += 1
+            history[label] = InstanceHistory(
+                expected=statistics.mean(durations) if durations else 0.0,
+                stable_runs=stable_runs,
+                last_run=group[0][3],
+            )
+        return history
+
+    def slowest(self, limit: int, patterns: list[str] = None) -> list[tuple]:
+        """
+        (label, runs, mean, max, last run) of the slowest instances,
+        narrowed by label globs.
+        """
+        return [
+            row for row in self.db.execute('''
+                SELECT label, COUNT(*), AVG(duration), MAX(duration),
+                       MAX(started)
+                FROM runs GROUP BY label ORDER BY AVG(duration) DESC
+            ''')
+            if not patterns
+            or any(fnmatch.fnmatch(row[0], p) for p in patterns)
+        ][:limit]
+
+    def trend(self, patterns: list[str] = None) -> list[tuple]:
+        """
+        (day, runs, mean, max, planned changes) of each day's runs,
+        narrowed by label globs.
+        """
+        rows = self.db.execute('''
+            SELECT DATE(started, 'unixepoch') AS day, label, duration,
+                   COALESCE(creates + updates + replaces + deletes, 0)
+            FROM runs ORDER BY day
+        ''')
+        trend = []
+        for day, group in itertools.groupby(rows, key=lambda r: r[0]):
+            group = [
+                r for r in group if not patterns
+                or any(fnmatch.fnmatch(r[1], p) for p in patterns)
+            ]
+            if group:
+                durations = [r[2] for r in group]
+                trend.append((
+                    day, len(group), statistics.mean(durations),
+                    max(durations), sum(r[3] for r in group)
+                ))
+        return trend
+
+
+class Fleet:
+    """
+    Runs a terraform command against every discovered instance
+    using a bounded pool of workers. Each instance gets its own
+    TF_DATA_DIR, so instances of one config can run at once.
+    Workers are threads: a run is just waiting on terraform processes.
+    """
+
+    def __init__(
+        self,
+        terraform_path: str,
+        root_path: str,
+        known_args: argparse.Namespace,
+        other_args: list
+    ) -> None:
+
+        self.terraform_path = terraform_path
+        self.root_path = root_path
+        self.known_args = known_args
+        # drop the leading 'fleet'
+        self.other_args = other_args[1:]
+
+    def process_args(self) -> None:
+        """Validate/process fleet flags and args."""
+        if len(self.other_args) == 0:
+            raise SystemExit(
+                'ERROR: You must provide a terraform command e.g. plan'
+            )
+        # drift: a plan of every instance, ordered and budgeted by history
+        self.drift = self.other_args[0] == 'drift'
+        if self.drift:
+            self.other_args = ['plan'] + self.other_args[1:]
+        self.time_budget = getattr(self.known_args, 'time_budget', None)
+        if self.time_budget and not self.drift:
+            raise SystemExit('ERROR: --time-budget is only for fleet drift')
+        self.tf_command = self.other_args[0]
+        self.shard = getattr(self.known_args, 'shard', None)
+        if self.shard:
+            shard, sep, shards = self.shard.partition('/')
+            if not (sep and shard.isdigit() and shards.isdigit()
+                    and 1 <= int(shard) <= int(shards)):
+                raise SystemExit(
+                    f'ERROR: --shard must be i/N with 1 <= i <= N, '
+                    f'not {self.shard}'
+                )
+            self.shard = (int(shard), int(shards))
+        # how many instances were selected before sharding
+        self.sharded_from = None
+        self.dry_run = self.known_args.dry_run
+        self.tracer = Tracer() if self.known_args.trace_out else None
+        self.jobs = self.known_args.jobs or os.cpu_count() or 1
+        self.backend_jobs = getattr(self.known_args, 'backend_jobs', None)
+        self.backend_rate = getattr(self.known_args, 'backend_rate', None)
+        self.lock_retries = getattr(self.known_args, 'lock_retries', None)
+        if self.lock_retries is None:
+            self.lock_retries = DEFAULT_LOCK_RETRIES
+        self.retries = getattr(self.known_args, 'retries', None) or 0
+        self.fail_fast = getattr(self.known_args, 'fail_fast', False)
+        # shared by every instance's Enviroform, see Enviroform.call()
+        self.cancel_event = threading.Event()
+        min_free_mb = getattr(self.known_args, 'min_free_mb', None)
+        self.budget = ResourceBudget(
+            DEFAULT_MIN_FREE_MB if min_free_mb is None else min_free_mb,
+            getattr(self.known_args, 'max_load', None),
+        )
+        # split the budget between the instances which can run at once
+        self.parallelism = getattr(self.known_args, 'parallelism', None)
+        if not self.parallelism:
+            budget = getattr(self.known_args, 'parallelism_budget', None) \
+                or DEFAULT_PARALLELISM_PER_CPU * (os.cpu_count() or 1)
+            self.parallelism = max(1, budget // self.jobs)
+        self.backend_groups = {}
+        self.journal = None
+        self.history = None
+        self.resume_id = getattr(self.known_args, 'resume', None)
+        self.run_id = self.resume_id or (
+            time.strftime('%Y%m%d-%H%M%S-') + os.urandom(3).hex()
+        )
+        for flag in ['environments_dir', 'terraform_dir']:
+            value = getattr(self.known_args, flag)
+            if not value:
+                raise SystemExit(
+                    f'ERROR: --{flag.replace("_", "-")} is required for fleet'
+                )
+            if not os.path.isdir(os.path.join(self.root_path, value)):
+                raise SystemExit(
+                    f'ERROR: dir not found at: {value}. '
+                    f'Your root is {self.root_path}'
+                )
+        self.log_dir = os.path.join(
+            self.root_path,
+            self.known_args.log_dir or os.path.join(
+                get_state_dir(self.root_path), 'logs', self.run_id
+            )
+        )
+
+    def discover_instances(self) -> list[Instance]:
+        """Every instance, from the tree index brought up to date."""
+        self.index = TreeIndex(
+            self.root_path,
+            self.known_args.environments_dir,
+            self.known_args.terraform_dir,
+        )
+        with self.tracer.span('fleet-discovery') if self.tracer \
+                else contextlib.nullcontext():
+            self.index.refresh()
+        self.index.save()
+        return self.index.instances()
+
+    def select_instances(self) -> list[Instance]:
+        """Discovered instances, narrowed by --filter globs."""
+        instances = filter_instances(
+            self.discover_instances(), self.known_args.filter
+        )
+        if self.known_args.since:
+            instances = affected_instances(
+                self.root_path,
+                instances,
+                get_changed_files(self.root_path, self.known_args.since),
+                self.known_args.environments_dir,
+                self.known_args.terraform_dir,
+            )
+        if self.shard:
+            instances = self.select_shard(instances)
+        return instances
+
+    def select_shard(self, instances: list[Instance]) -> list[Instance]:
+        """
+        For --shard i/N: this node's share of the instances, balanced by
+        the expected run times in the --durations file, or else by count.
+        Every node must get the same times, so local history isn't used.
+        See shard_instances().
+        """
+        durations_path = getattr(self.known_args, 'durations', None)
+        if durations_path:
+            try:
+                with open(durations_path) as f:
+                    durations = json.load(f)
+            except (OSError, ValueError) as e:
+                raise SystemExit(
+                    f'ERROR: cannot read durations from {durations_path}: {e}'
+                )
+            if not isinstance(durations, dict):
+                raise SystemExit(
+                    f'ERROR: {durations_path} must map instance labels to '
+                    f'seconds, see "history export"'
+                )
+        else:
+            durations = {}
+        graph = None
+        if self.tf_command in ORDERED_COMMANDS:
+            graph = dependency_graph(self.root_path, instances)
+        self.sharded_from = len(instances)
+        shard, shards = self.shard
+        return shard_instances(instances, shard, shards, durations, graph)
+
+    def backend_group(self, instance: Instance) -> str:
+        """
+        Instances sharing a backend, by the content of their region's
+        backend.tfvars: regions pointing at the same bucket and lock
+        table share a group.
+        """
+        path = os.path.join(
+            self.root_path, self.known_args.environments_dir,
+            instance.env, instance.region, 'backend.tfvars'
+        )
+        if path not in self.backend_groups:
+            try:
+                with open(path) as f:
+                    lines = [line.strip() for line in f]
+            except OSError:
+                lines = [path]
+            self.backend_groups[path] = '\n'.join(sorted(
+                line for line in lines
+                if line and not line.startswith(('#', '//'))
+            ))
+        return self.backend_groups[path]
+
+    def run_instance(
+        self, instance: Instance, attempt: int = 0
+    ) -> InstanceResult:
+        """
+        Runs one instance, with all output going to its log file and,
+        unless --quiet, to the console prefixed by the instance label.
+        Retries (attempt > 0) and resumed runs append to the log.
+        """
+        known_args = argparse.Namespace(**vars(self.known_args))
+        known_args.terraform_config_path = instance.terraform_config_path
+        known_args.tfvars_file_path = instance.tfvars_file_path
+        known_args.isolate_data_dir = True
+        known_args.parallelism = self.parallelism
+        log_path = get_log_path(self.log_dir, instance)
+        console = None if self.known_args.quiet else sys.stdout
+        with contextlib.ExitStack() as stack:
+            log = stack.enter_context(
+                open(log_path, 'a' if attempt or self.resume_id else 'w')
+            )
+            span = {}
+            if self.tracer is not None:
+                span = stack.enter_context(self.tracer.span(
+                    'instance',
+                    label=instance.label,
+                    backend_key=instance.backend_key,
+                ))
+            output = OutputSink(
+                instance.label, console, log,
+                watch=[STATE_LOCK_ERROR] + TRANSIENT_ERRORS
+            )
+            tf = Enviroform(
+                self.terraform_path,
+                self.root_path,
+                known_args,
+                list(self.other_args)
+            )
+            tf.index = self.index
+            tf.tracer = self.tracer
+            tf.cancel_event = self.cancel_event
+            # instances run at once can't share our terminal: terraform
+            # fails rather than prompts, e.g. apply without -auto-approve
+            tf.stdin = subprocess.DEVNULL
+            tf.environ = dict(tf.environ, TF_INPUT='0')
+            result = tf.run(output=output)
+            span['rc'] = result.rc
+            if result.error:
+                output.write(result.error + '\n')
+            output.finish()
+        phases = collections.Counter()
+        for step in result.steps:
+            phases[step.name] += round(step.duration, 3)
+        return InstanceResult(
+            label=instance.label,
+            rc=result.rc,
+            duration=result.duration,
+            log_path=log_path,
+            error=result.error,
+            tail=list(output.tail),
+            seen=output.seen,
+            summary=result.summary,
+            phases=phases,
+        )
+
+    def compile_jobs(
+        self,
+        instances: list[Instance],
+        graph: dict[str, set[str]] = None
+    ) -> list[ExportJob]:
+        """
+        Resolves every instance's steps, like a --dry-run with a fresh
+        init, in this one process. Each step becomes a job depending on
+        the step before it. With a dependency graph, an instance's
+        command also depends on the commands of the instances it
+        depends on. Inits share the plugin cache, so they share a pool.
+        """
+        jobs = []
+        last_job = {}
+        for instance in instances:
+            known_args = argparse.Namespace(**vars(self.known_args))
+            known_args.terraform_config_path = instance.terraform_config_path
+            known_args.tfvars_file_path = instance.tfvars_file_path
+            known_args.isolate_data_dir = True
+            known_args.parallelism = self.parallelism
+            known_args.dry_run = True
+            known_args.force_init = True
+            tf = Enviroform(
+                self.terraform_path,
+                self.root_path,
+                known_args,
+                list(self.other_args)
+            )
+            tf.index = self.index
+            tf.stdout = io.StringIO()
+            instance_jobs = []
+            try:
+                for step in tf.tf_steps():
+                    instance_jobs.append(ExportJob(
+                        id=f'{instance.label}/{step.name}',
+                        label=instance.label,
+                        step=step.name,
+                        argv=list(step.cmd_list),
+                        cwd=tf.tf_config_path,
+                        env={
+                            key: value for key, value in tf.environ.items()
+                            if os.environ.get(key) != value
+                        },
+                        expected_rcs=list(step.expected_rcs),
+                        deps=[instance_jobs[-1].id] if instance_jobs else [],
+                        pool='plugin-cache' if step.lock else None,
+                    ))
+            except SystemExit as e:
+                if e.code != INIT_ONLY_MESSAGE:
+                    raise SystemExit(f'{e.code} (instance {instance.label})')
+            jobs.extend(instance_jobs)
+            last_job[instance.label] = instance_jobs[-1]
+        for label, deps in (graph or {}).items():
+            last_job[label].deps.extend(
+                last_job[dep].id for dep in sorted(deps)
+            )
+        return jobs
+
+    def schedule(
+        self,
+        instances: list[Instance],
+        graph: dict[str, set[str]] = None
+    ) -> list[InstanceResult]:
+        """
+        Runs instances across the pool, returns their results.
+        With a dependency graph (label: labels it depends on), an
+        instance starts once all its dependencies have succeeded, and
+        is skipped if one of them failed. Ready instances heading the
+        longest chains start first.
+        Instances sharing a backend (see backend_group()) are limited to
+        --backend-jobs at once and --backend-rate starts per second. An
+        instance which failed waiting for a state lock is run again
+        later, up to --lock-retries times, and one which failed with a
+        transient error up to --retries times, backing off exponentially.
+        Starts and finishes are recorded in the journal, if any, and
+        finished runs in the history store, if any.
+        With --fail-fast, the first failure cancels everything else:
+        running commands are stopped and the rest reported as skipped.
+        """
+        labels = {i.label for i in instances}
+        graph = {
+            label: set((graph or {}).get(label, ())) & labels
+            for label in labels
+        }
+        dependents = reverse_graph(graph)
+        priority = critical_path_lengths(graph)
+        by_label = {i.label: i for i in instances}
+        waiting = {label: len(deps) for label, deps in graph.items()}
+        ready = [
+            (-priority[i.label], n, i.label)
+            for n, i in enumerate(instances) if not waiting[i.label]
+        ]
+        heapq.heapify(ready)
+        order = {i.label: n for n, i in enumerate(instances)}
+        running = {}
+        results = []
+
+        def skip_dependents(label: str) -> None:
+            todo = [label]
+            while todo:
+                failed = todo.pop()
+                for dependent in sorted(dependents[failed]):
+                    if waiting[dependent] < 0:
+                        continue
+                    # never runs, nor is skipped twice
+                    waiting[dependent] = -1
+                    results.append(InstanceResult(
+                        label=dependent,
+                        rc=SKIPPED_RC,
+                        duration=0.0,
+                        log_path='',
+                        error=f'skipped, dependency {failed} failed',
+                    ))
+                    record('finish', label=dependent, rc=SKIPPED_RC)
+                    todo.append(dependent)
+
+        groups = {i.label: self.backend_group(i) for i in instances}
+        group_running = collections.Counter()
+        group_started = {}
+        attempts = collections.Counter()
+        lock_attempts = collections.Counter()
+        # (not before, ready entry) of instances requeued after an error
+        delayed = []
+        # why new starts are held back by the resource budget, if they are
+        held_back = []
+
+        def record(event: str, **fields) -> None:
+            if self.journal is not None:
+                self.journal.record(event, **fields)
+
+        def retry_delay(result: InstanceResult) -> float:
+            """Seconds to wait before running again, None for never."""
+            label = result.label
+            if (STATE_LOCK_ERROR in result.seen
+                    and lock_attempts[label] < self.lock_retries):
+                lock_attempts[label] += 1
+                return LOCK_RETRY_DELAY * lock_attempts[label]
+            transient = result.seen & set(TRANSIENT_ERRORS)
+            if transient and attempts[label] - lock_attempts[label] \
+                    < self.retries:
+                return RETRY_DELAY * 2 ** (
+                    attempts[label] - lock_attempts[label]
+                )
+            return None
+
+        def start_ready(pool: concurrent.futures.Executor) -> float:
+            """
+            Starts ready instances within the job and backend limits.
+            Returns when an instance held back by a limit may start.
+            """
+            if self.cancel_event.is_set():
+                return None
+            now = time.monotonic()
+            while delayed and delayed[0][0] <= now:
+                heapq.heappush(ready, heapq.heappop(delayed)[1])
+            wake = delayed[0][0] if delayed else None
+            held = []
+            starting = 0
+            while ready and len(running) < self.jobs:
+                # one run at a time always goes ahead
+                short = running and self.budget.room(starting)
+                if short:
+                    if not held_back:
+                        with OutputSink.console_lock:
+                            print(f'Holding new instances, {short}',
+                                  flush=True)
+                    held_back.append(short)
+                    wake = now + BUDGET_POLL_INTERVAL if wake is None \
+                        else min(wake, now + BUDGET_POLL_INTERVAL)
+                    break
+                held_back.clear()
+                entry = heapq.heappop(ready)
+                label = entry[2]
+                group = groups[label]
+                if (self.backend_jobs
+                        and group_running[group] >= self.backend_jobs):
+                    held.append(entry)
+                    continue
+                if self.backend_rate and group in group_started:
+                    next_start = group_started[group] + 1 / self.backend_rate
+                    if next_start > now:
+                        held.append(entry)
+                        wake = next_start if wake is None \
+                            else min(wake, next_start)
+                        continue
+                group_running[group] += 1
+                group_started[group] = now
+                starting += 1
+                record('start', label=label, attempt=attempts[label])
+                future = pool.submit(
+                    self.run_instance, by_label[label], attempts[label]
+                )
+                running[future] = entry
+            for entry in held:
+                heapq.heappush(ready, entry)
+            return wake
+
+        with concurrent.futures.ThreadPoolExecutor(self.jobs) as pool:
+            try:
+                while running or (
+                        not self.cancel_event.is_set() and (ready or delayed)):
+                    wake = start_ready(pool)
+                    timeout = None if wake is None else max(
+                        0, wake - time.monotonic()
+                    )
+                    if not running:
+                        time.sleep(timeout or 0)
+                        continue
+                    done, _ = concurrent.futures.wait(
+                        running, timeout,
+                        return_when=concurrent.futures.FIRST_COMPLETED
+                    )
+                    for future in done:
+                        entry = running.pop(future)
+                        result = future.result()
+                        group_running[groups[result.label]] -= 1
+                        delay = None
+                        if (result.rc not in self.expected_rcs()
+                                and not self.cancel_event.is_set()):
+                            delay = retry_delay(result)
+                        if delay is not None:
+                            reason = ', '.join(sorted(result.seen))
+                            attempts[result.label] += 1
+                            with OutputSink.console_lock:
+                                print(f'[{result.label}] rc={result.rc} after '
+                                      f'"{reason}", retrying in {delay:.0f}s',
+                                      flush=True)
+                            heapq.heappush(
+                                delayed, (time.monotonic() + delay, entry)
+                            )
+                            continue
+                        with OutputSink.console_lock:
+                            print(f'[{result.label}] rc={result.rc} '
+                                  f'({result.duration:.1f}s)', flush=True)
+                        record(
+                            'finish', label=result.label, rc=result.rc,
+                            duration=round(result.duration, 3),
+                            **({'summary': result.summary}
+                               if result.summary else {})
+                        )
+                        if self.history is not None:
+                            self.history.record(
+                                self.run_id, self.tf_command,
+                                by_label[result.label], result
+                            )
+                        results.append(result)
+                        if result.rc not in self.expected_rcs():
+                            skip_dependents(result.label)
+                            if (self.fail_fast
+                                    and not self.cancel_event.is_set()):
+                                self.cancel_event.set()
+                                with OutputSink.console_lock:
+                                    print(f'Failing fast after {result.label}'
+                                          ' failed, stopping the rest',
+                                          flush=True)
+                            continue
+                        for dependent in dependents[result.label]:
+                            if waiting[dependent] > 0:
+                                waiting[dependent] -= 1
+                                if waiting[dependent] == 0:
+                                    heapq.heappush(ready, (
+                                        -priority[dependent],
+                                        order[dependent],
+                                        dependent
+                                    ))
+            except KeyboardInterrupt:
+                self.cancel_event.set()
+                print('Interrupted, stopping running instances', flush=True)
+                concurrent.futures.wait(running)
+                raise
+        if self.cancel_event.is_set():
+            finished = {r.label for r in results}
+            for label in sorted(set(by_label) - finished):
+                results.append(InstanceResult(
+                    label=label,
+                    rc=SKIPPED_RC,
+                    duration=0.0,
+                    log_path='',
+                    error='cancelled',
+                ))
+                record('finish', label=label, rc=SKIPPED_RC)
+        return sorted(results, key=lambda r: r.label)
+
+    def expected_rcs(self) -> list[int]:
+        """rcs which count as success for the fleet command."""
+        if self.tf_command == 'plan':
+            return [0, 2]
+        return [0]
+
+    def print_results(self, results: list[InstanceResult]) -> None:
+        """Prints the per-instance result table."""
+        width = max([len('INSTANCE')] + [len(r.label) for r in results])
+        print(f'\n{"INSTANCE":<{width}}  {"RC":>3}  {"DURATION":>9}  LOG')
+        for r in results:
+            rc = 'skip' if r.rc == SKIPPED_RC else r.rc
+            print(
+                f'{r.label:<{width}}  {rc:>3}  '
+                f'{r.duration:>8.1f}s  {r.log_path}'
+            )
+
+    def print_summary(self, summary: dict, instances: int) -> None:
+        """Prints the planned changes of the fleet by resource type."""
+        print(f'\n{format_summary(summary)} across {instances} instances')
+        if not summary['by_type']:
+            return
+        width = max(len('TYPE'), *map(len, summary['by_type']))
+        print(f'\n{"TYPE":<{width}}' + ''.join(
+            f'  {action.upper():>7}' for action in PLAN_ACTIONS
+        ))
+        for resource_type, counts in summary['by_type'].items():
+            print(f'{resource_type:<{width}}' + ''.join(
+                f'  {counts.get(action, 0):>7}' for action in PLAN_ACTIONS
+            ))
+
+    def run_fleet(self) -> int:
+        """
+        Runs the terraform command against all selected instances.
+        Returns: 0 if every instance returned an expected rc, else 1.
+        """
+        self.process_args()
+        self.journal = Journal(get_journal_path(self.root_path, self.run_id))
+        if self.resume_id:
+            instances = self.unfinished_instances()
+            if not instances:
+                print(f'Every instance of run {self.run_id} has finished')
+                return 0
+        else:
+            instances = self.select_instances()
+        if not instances and self.known_args.since:
+            print(f'No instances are affected by changes since '
+                  f'{self.known_args.since}')
+            return 0
+        if not instances:
+            raise SystemExit('ERROR: no instances found')
+        history = HistoryStore(get_history_path(self.root_path))
+        if not self.dry_run:
+            self.history = history
+        if self.drift:
+            instances, stable = self.drift_order(
+                instances, history.instances(self.tf_command)
+            )
+            if stable:
+                print(f'Skipping {len(stable)} stable instances to keep '
+                      f'within the {self.time_budget:.0f}s time budget')
+        if self.sharded_from is not None:
+            print(f'Shard {self.shard[0]}/{self.shard[1]}: {len(instances)} '
+                  f'of {self.sharded_from} instances')
+        print(
+            f'Run {self.run_id}: "{self.tf_command}" on {len(instances)} '
+            f'instances with {self.jobs} jobs, logs in {self.log_dir}'
+        )
+        graph = None
+        if self.tf_command in ORDERED_COMMANDS:
+            graph = dependency_graph(self.root_path, instances)
+            if self.tf_command == 'destroy':
+                graph = reverse_graph(graph)
+            levels = dependency_levels(graph)
+            print(
+                f'{sum(map(len, graph.values()))} dependencies, '
+                f'{len(levels)} levels'
+            )
+        os.makedirs(self.log_dir, exist_ok=True)
+        with contextlib.closing(self.journal.open()), \
+                contextlib.closing(history):
+            self.journal.record(
+                'resume' if self.resume_id else 'run',
+                run_id=self.run_id,
+                args=self.other_args,
+                argv=sys.argv[1:],
+                log_dir=self.log_dir,
+                instances=len(instances),
+                labels=[i.label for i in instances],
+            )
+            results = self.schedule(instances, graph)
+        self.print_results(results)
+        summaries = [r.summary for r in results if r.summary]
+        if summaries:
+            self.print_summary(merge_summaries(summaries), len(summaries))
+        if self.tracer is not None:
+            self.tracer.write(self.known_args.trace_out)
+            print(f'\nTrace written to {self.known_args.trace_out}')
+        failed = [r for r in results if r.rc not in self.expected_rcs()]
+        if failed:
+            for r in failed:
+                if r.rc == SKIPPED_RC:
+                    print(f'\n==== {r.label}: {r.error}')
+                    continue
+                print(f'\n==== {r.label} (rc {r.rc}), last lines of '
+                      f'{r.log_path}:')
+                print('\n'.join(r.tail))
+            print(f'\n{len(failed)} of {len(results)} instances failed. '
+                  f'To run them again: --resume {self.run_id}')
+            return 1
+        return 0
+
+    def drift_order(
+        self,
+        instances: list[Instance],
+        history: dict[str, InstanceHistory]
+    ) -> tuple[list[Instance], list[Instance]]:
+        """
+        Orders instances longest expected plan first, which keeps the
+        pool busy to the end (longest-processing-time scheduling).
+        Instances never planned before have no expected time, so go
+        first. With --time-budget, instances are picked least stable,
+        then least recently planned, first, until their expected time
+        spread over the jobs fills the budget.
+        Returns: (instances to run, stable instances left out).
+        """
+        known = [h.expected for h in history.values() if h.expected]
+        default = max(known) if known else 0.0
+
+        def expected(instance: Instance) -> float:
+            if instance.label not in history:
+                return float('inf')
+            return history[instance.label].expected or default
+
+        stable = []
+        if self.time_budget:
+            picked = []
+            total = 0.0
+            for instance in sorted(instances, key=lambda i: (
+                history[i.label].stable_runs, history[i.label].last_run
+            ) if i.label in history else (-1, 0)):
+                cost = expected(instance)
+                cost = default if cost == float('inf') else cost
+                if picked and (total + cost) / self.jobs > self.time_budget:
+                    stable.append(instance)
+                    continue
+                picked.append(instance)
+                total += cost
+            instances = picked
+        return sorted(instances, key=expected, reverse=True), stable
+
+    def unfinished_instances(self) -> list[Instance]:
+        """
+        For --resume: the instances of the journaled run which it
+        didn't finish with an expected rc. They are the run's own,
+        whatever --filter, --since or --shard select now. Logs go on
+        in the run's log dir.
+        """
+        run, last = self.journal.load()
+        if run['args'] != self.other_args:
+            raise SystemExit(
+                f'ERROR: run {self.run_id} was "{" ".join(run["args"])}", '
+                f'not "{" ".join(self.other_args)}"'
+            )
+        if not self.known_args.log_dir:
+            self.log_dir = run['log_dir']
+        finished = {
+            label for label, record in last.items()
+            if record['event'] == 'finish'
+            and record['rc'] in self.expected_rcs()
+        }
+        by_label = {i.label: i for i in self.discover_instances()}
+        labels = run['labels']
+        missing = [
+            label for label in labels
+            if label not in by_label and label not in finished
+        ]
+        if missing:
+            raise SystemExit(
+                f'ERROR: {len(missing)} instances of run {self.run_id} no '
+                f'longer exist: {", ".join(missing)}'
+            )
+        print(f'Resuming run {self.run_id}: {len(finished)} instances '
+              f'already finished')
+        return [by_label[label] for label in labels if label not in finished]
+
+
+def affected_main(
+    terraform_path: str,
+    root_path: str,
+    known_args: argparse.Namespace,
+    other_args: list
+) -> int:
+    """
+    enviroform.py --since <ref> affected [<tf_command> [<options>]]
+    Prints the instances affected by changes since <ref>, or runs the
+    terraform command against them in fleet mode.
+    """
+    if not known_args.since:
+        raise SystemExit('ERROR: affected requires --since <git ref>')
+    fleet = Fleet(terraform_path, root_path, known_args, other_args)
+    if len(other_args) > 1:
+        return fleet.run_fleet()
+    # nothing to run, but the fleet validates and selects for us
+    fleet.other_args = ['affected']
+    fleet.process_args()
+    for instance in fleet.select_instances():
+        print(instance.label)
+    return 0
+
+
+def job_shell_command(job: ExportJob) -> str:
+    """A job as one sh command line, succeeding on its expected rcs."""
+    command = ' '.join(
+        ['cd', shlex.quote(job.cwd), '&&']
+        + (['env'] + [
+            shlex.quote(f'{key}={value}')
+            for key, value in sorted(job.env.items())
+        ] if job.env else [])
+        + [shlex.quote(arg) for arg in job.argv]
+    )
+    other_rcs = [str(rc) for rc in job.expected_rcs if rc != 0]
+    if other_rcs:
+        command += (
+            f' || {{ rc=$?; case $rc in {"|".join(other_rcs)}) ;; '
+            f'*) exit $rc;; esac; }}'
+        )
+    return command
+
+
+def format_makefile(jobs: list[ExportJob], header: str) -> str:
+    """
+    Jobs as phony Makefile targets, for make -jN. make has no pools,
+    so the jobs of a pool are chained with order-only prerequisites.
+    """
+    lines = [f'# {header}', '']
+    # the last step of each instance
+    finals = {job.label: job.id for job in jobs}
+    lines.append('.PHONY: all ' + ' '.join(job.id for job in jobs))
+    lines.append('all: ' + ' '.join(finals.values()))
+    pool_last = {}
+    for job in jobs:
+        order_only = ''
+        if job.pool:
+            if job.pool in pool_last:
+                order_only = f' | {pool_last[job.pool]}'
+            pool_last[job.pool] = job.id
+        lines.append('')
+        lines.append(f'{job.id}: {" ".join(job.deps)}{order_only}'.rstrip())
+        lines.append('\t' + job_shell_command(job).replace('$', '$$'))
+    return '\n'.join(lines) + '\n'
+
+
+def format_ninja(jobs: list[ExportJob], header: str) -> str:
+    """Jobs as ninja build edges, with a depth 1 pool per job pool."""
+    def escape(path: str) -> str:
+        return re.sub(r'([$ :])', r'$\1', path)
+
+    lines = [f'# {header}', '']
+    for pool in sorted({job.pool for job in jobs if job.pool}):
+        lines.extend([f'pool {pool}', '  depth = 1', ''])
+    lines.extend([
+        'rule run', '  command = $cmd', '  description = $desc', ''
+    ])
+    for job in jobs:
+        deps = ' '.join(escape(dep) for dep in job.deps)
+        lines.append(f'build {escape(job.id)}: run' +
+                     (f' | {deps}' if deps else ''))
+        lines.append(f'  cmd = {job_shell_command(job).replace("$", "$$")}')
+        lines.append(f'  desc = {job.id}')
+        if job.pool:
+            lines.append(f'  pool = {job.pool}')
+    return '\n'.join(lines) + '\n'
+
+
+def export_main(
+    terraform_path: str,
+    root_path: str,
+    known_args: argparse.Namespace,
+    other_args: list
+) -> int:
+    """
+    enviroform.py export <tf_command> [<options>]
+    Compiles the tf_command of every instance fleet mode would select
+    into jobs, with the exact argv, cwd and env of each step, and writes
+    them as --format json (default), make or ninja, to stdout or
+    --output. The jobs then run without enviroform.
+    """
+    for flag in [
+        'plan_cache', 'save_plan', 'summarize', 'clone_data_dir',
+        'upstream_outputs',
+    ]:
+        if getattr(known_args, flag, False):
+            raise SystemExit(
+                f'ERROR: --{flag.replace("_", "-")} works between '
+                f'commands, it can not be exported'
+            )
+    fleet = Fleet(terraform_path, root_path, known_args, other_args)
+    fleet.process_args()
+    instances = fleet.select_instances()
+    if not instances:
+        raise SystemExit('ERROR: no instances found')
+    graph = None
+    if fleet.tf_command in ORDERED_COMMANDS:
+        graph = dependency_graph(root_path, instances)
+        if fleet.tf_command == 'destroy':
+            graph = reverse_graph(graph)
+    jobs = fleet.compile_jobs(instances, graph)
+    header = (
+        f'written by enviroform.py export {" ".join(fleet.other_args)}: '
+        f'{len(jobs)} jobs for {len(instances)} instances'
+    )
+    export_format = getattr(known_args, 'format', None) or 'json'
+    if export_format == 'make':
+        content = format_makefile(jobs, header)
+    elif export_format == 'ninja':
+        content = format_ninja(jobs, header)
+    else:
+        content = json.dumps({
+            'command': fleet.other_args,
+            'jobs': [dataclasses.asdict(job) for job in jobs],
+        }, indent=2) + '\n'
+    output = getattr(known_args, 'output', None)
+    if output:
+        with open(output, 'w') as f:
+            f.write(content)
+        print(f'Wrote {len(jobs)} jobs for {len(instances)} instances '
+              f'to {output}')
+    else:
+        sys.stdout.write(content)
+    return 0
+
+
+def index_main(
+    root_path: str, known_args: argparse.Namespace, other_args: list
+) -> int:
+    """
+    enviroform.py index build|list|query [<field>=<glob> ...]
+      build: brings the cached index up to date
+      list:  prints instances, narrowed by --filter globs
+      query: prints details of instances matching every field=glob term
+    """
+    usage = 'ERROR: usage: index build|list|query [<field>=<glob> ...]'
+    if len(other_args) < 2 or other_args[1] not in ['build', 'list', 'query']:
+        raise SystemExit(usage)
+    if not known_args.environments_dir or not known_args.terraform_dir:
+        raise SystemExit(
+            'ERROR: --environments-dir and --terraform-dir are required'
+        )
+    start = time.monotonic()
+    index = TreeIndex(
+        root_path, known_args.environments_dir, known_args.terraform_dir
+    ).refresh()
+    index.save()
+    instances = filter_instances(index.instances(), known_args.filter)
+    if other_args[1] == 'build':
+        print(
+            f'Indexed {len(index.dirs)} dirs and {len(instances)} '
+            f'instances in {time.monotonic() - start:.3f}s: '
+            f'{index.cache_path}'
+        )
+    elif other_args[1] == 'list':
+        for instance in instances:
+            print(instance.label)
+    else:
+        for instance in query_instances(instances, other_args[2:]):
+            print(json.dumps(
+                dict(
+                    dataclasses.asdict(instance),
+                    label=instance.label,
+                    backend_key=instance.backend_key,
+                ),
+                sort_keys=True
+            ))
+    return 0
+
+
+def outputs_main(
+    terraform_path: str,
+    root_path: str,
+    known_args: argparse.Namespace,
+    other_args: list
+) -> int:
+    """
+    enviroform.py outputs [<output_name>]
+    Prints the outputs of every instance fleet mode would select, as
+    JSON: {label: {output_name: value}}, or {label: value} of just the
+    named output. They come from the outputs cache, and are read with
+    `terraform output -json` when missing, older than --outputs-ttl,
+    or with --refresh.
+    """
+    if len(other_args) > 2:
+        raise SystemExit('ERROR: usage: outputs [<output_name>]')
+    fleet = Fleet(terraform_path, root_path, known_args, other_args)
+    # nothing to run, but the fleet validates and selects for us
+    fleet.other_args = ['outputs']
+    fleet.process_args()
+    instances = fleet.select_instances()
+    if not instances:
+        raise SystemExit('ERROR: no instances found')
+    ttl = getattr(known_args, 'outputs_ttl', None)
+    cache = OutputsCache(
+        root_path, DEFAULT_OUTPUTS_TTL if ttl is None else ttl
+    )
+    outputs = {}
+    failed = 0
+    with concurrent.futures.ThreadPoolExecutor(fleet.jobs) as pool:
+        futures = {
+            pool.submit(
+                cache.get,
+                instance,
+                lambda instance=instance: read_outputs(
+                    terraform_path, root_path, known_args, instance,
+                    fleet.cancel_event
+                ),
+                refresh=getattr(known_args, 'refresh', False),
+            ): instance.label
+            for instance in instances
+        }
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                fetched = future.result()
+            except SystemExit as e:
+                failed += 1
+                print(e.code, file=sys.stderr)
+                continue
+            values = {name: o['value'] for name, o in fetched.items()}
+            if len(other_args) == 1:
+                outputs[futures[future]] = values
+            elif other_args[1] in values:
+                outputs[futures[future]] = values[other_args[1]]
+    print(json.dumps(outputs, indent=2, sort_keys=True))
+    return 1 if failed else 0
+
+
+def warm_main(
+    root_path: str, known_args: argparse.Namespace, other_args: list
+) -> int:
+    """
+    enviroform.py --terraform-dir <tf_path> warm
+    Fills the provider mirror with every provider version locked by a
+    .terraform.lock.hcl under <tf_path>, once each, for each --platform,
+    downloading in parallel. Then writes the CLI config which points
+    init at the mirror, see Enviroform.process_provider_mirror().
+    """
+    if len(other_args) != 1:
+        raise SystemExit('ERROR: usage: warm')
+    if not known_args.terraform_dir:
+        raise SystemExit('ERROR: --terraform-dir is required for warm')
+    state_dir = get_state_dir(root_path)
+    mirror_dir = os.path.join(state_dir, PROVIDER_MIRROR_DIR)
+    platforms = getattr(known_args, 'platform', None) or [current_platform()]
+    lock_paths = find_lock_files(root_path, known_args.terraform_dir)
+    providers = locked_providers(lock_paths)
+    packages = [
+        (source, version, platform, hashes)
+        for (source, version), hashes in sorted(providers.items())
+        for platform in platforms
+    ]
+    print(f'{len(lock_paths)} lock files lock {len(providers)} provider '
+          f'versions, {len(packages)} packages for {", ".join(platforms)}')
+    registry = ProviderRegistry(getattr(known_args, 'registry_url', None))
+    start = time.monotonic()
+    downloaded = 0
+    failed = 0
+    jobs = known_args.jobs or os.cpu_count() or 1
+    with concurrent.futures.ThreadPoolExecutor(jobs) as pool:
+        futures = {}
+        for package in packages:
+            future = pool.submit(warm_provider, registry, mirror_dir, *package)
+            futures[future] = package
+        for future in concurrent.futures.as_completed(futures):
+            source, version, platform, _ = futures[future]
+            try:
+                downloaded += future.result()
+            except (OSError, ValueError, KeyError) as e:
+                failed += 1
+                print(f'ERROR: {source} {version} {platform}: {e}')
+    print(f'Downloaded {downloaded} packages, '
+          f'{len(packages) - downloaded - failed} were mirrored already '
+          f'({time.monotonic() - start:.1f}s): {mirror_dir}')
+    if failed:
+        print(f'{failed} packages failed, init will fetch providers itself')
+        return 1
+    os.makedirs(state_dir, exist_ok=True)
+    config_path = os.path.join(state_dir, PROVIDER_MIRROR_CONFIG)
+    write_mirror_config(
+        config_path, mirror_dir,
+        sorted({source.split('/')[0] for source, _ in providers})
+    )
+    print(f'init will install providers from the mirror, see {config_path}')
+    return 0
+
+
+def history_main(
+    root_path: str, known_args: argparse.Namespace, other_args: list
+) -> int:
+    """
+    enviroform.py history slowest|trend|export [<tf_command>]
+      slowest: prints the instances with the longest mean run time
+      trend:   prints run times and planned changes per day
+      export:  prints the expected run time of each instance for
+               <tf_command> (default: plan) as JSON, for --durations
+    All are narrowed by --filter globs.
+    """
+    usage = 'ERROR: usage: history slowest|trend|export [<tf_command>]'
+    if len(other_args) < 2 \
+            or other_args[1] not in ['slowest', 'trend', 'export'] \
+            or len(other_args) > (3 if other_args[1] == 'export' else 2):
+        raise SystemExit(usage)
+    path = get_history_path(root_path)
+    if not os.path.exists(path):
+        raise SystemExit(f'ERROR: no run history at {path}, run fleet first')
+    with contextlib.closing(HistoryStore(path)) as history:
+        if other_args[1] == 'export':
+            command = other_args[2] if len(other_args) > 2 else 'plan'
+            print(json.dumps({
+                label: round(h.expected, 3)
+                for label, h in history.instances(command).items()
+                if not known_args.filter or any(
+                    fnmatch.fnmatch(label, p) for p in known_args.filter
+                )
+            }, indent=2, sort_keys=True))
+        elif other_args[1] == 'slowest':
+            rows = history.slowest(known_args.limit, known_args.filter)
+            width = max([len('INSTANCE')] + [len(r[0]) for r in rows])
+            print(f'{"INSTANCE":<{width}}  {"RUNS":>5}  {"MEAN":>8}  '
+                  f'{"MAX":>8}  LAST RUN')
+            for label, runs, mean, longest, last in rows:
+                print(f'{label:<{width}}  {runs:>5}  {mean:>7.1f}s  '
+                      f'{longest:>7.1f}s  '
+                      f'{time.strftime("%Y-%m-%d %H:%M", time.localtime(last))}')  # NOQA
+        else:
+            print(f'{"DAY":<10}  {"RUNS":>5}  {"MEAN":>8}  {"MAX":>8}  '
+                  f'CHANGES')
+            for day, runs, mean, longest, changes in history.trend(
+                    known_args.filter):
+                print(f'{day:<10}  {runs:>5}  {mean:>7.1f}s  '
+                      f'{longest:>7.1f}s  {changes}')
+    return 0
+
+
+def get_daemon_socket(root_path: str) -> str:
+    """Returns the path of the daemon's Unix socket."""
+    # You can over-ride the default <state dir>/daemon.sock
+    # by setting this env var
+    return os.environ.get('ENVIROFORM_SOCKET') or os.path.join(
+        get_state_dir(root_path), DAEMON_SOCKET
+    )
+
+
+def needs_approval(other_args: list) -> bool:
+    """
+    Whether terraform would ask to approve the command: destroy, and
+    apply other than of a saved plan, without -auto-approve. Where a
+    last arg could be a flag's value rather than a plan file, e.g.
+    `apply -target x`, it counts as asking.
+    """
+    command, args = other_args[0], other_args[1:]
+    if command not in ['apply', 'destroy']:
+        return False
+    if '-auto-approve' in args or '-auto-approve=true' in args:
+        return False
+    if command == 'apply' and args and not args[-1].startswith('-'):
+        return len(args) > 1 and '=' not in args[-2]
+    return True
+
+
+class DaemonJob(io.TextIOBase):
+    """
+    One run in the daemon, and its output so far, which every client
+    asking for the same run follows. Output every following client has
+    been sent is dropped, beyond the last DAEMON_OUTPUT_KEEP characters,
+    so memory stays flat however much a run prints. A client joining
+    late is told how much it missed.
+    """
+
+    def __init__(self) -> None:
+        self.chunks = collections.deque()
+        # the number of the first chunk kept, and the characters dropped
+        self.first = 0
+        self.dropped = 0
+        self.kept = 0
+        # following clients' next chunk numbers
+        self.positions = {}
+        self.rc = None
+        self.clients = 0
+        self.cancel_event = threading.Event()
+        self.condition = threading.Condition()
+
+    def write(self, text: str) -> int:
+        with self.condition:
+            self.chunks.append(text)
+            self.kept += len(text)
+            self.trim()
+            self.condition.notify_all()
+        return len(text)
+
+    def finish(self, rc: int) -> None:
+        with self.condition:
+            self.rc = rc
+            self.condition.notify_all()
+
+    def trim(self) -> None:
+        """Drops chunks sent to every follower, beyond those kept."""
+        sent = min(
+            self.positions.values(), default=self.first + len(self.chunks)
+        )
+        while (self.chunks and self.first < sent
+               and self.kept > DAEMON_OUTPUT_KEEP):
+            text = self.chunks.popleft()
+            self.first += 1
+            self.kept -= len(text)
+            self.dropped += len(text)
+
+    def follow(self) -> collections.abc.Iterator[str]:
+        """Yields the output kept, then the rest as it comes, to the end."""
+        token = object()
+        with self.condition:
+            sent = self.positions[token] = self.first
+            dropped = self.dropped
+        try:
+            if dropped:
+                yield f'[{dropped} characters of earlier output dropped]\n'
+            while True:
+                with self.condition:
+                    self.condition.wait_for(
+                        lambda: self.first + len(self.chunks) > sent
+                        or self.rc is not None
+                    )
+                    text = ''.join(itertools.islice(
+                        self.chunks, sent - self.first, None
+                    ))
+                    sent = self.positions[token] = \
+                        self.first + len(self.chunks)
+                    self.trim()
+                    done = self.rc is not None
+                if text:
+                    yield text
+                if done:
+                    return
+        finally:
+            with self.condition:
+                del self.positions[token]
+                self.trim()
+
+    def detach(self) -> None:
+        """A client went away. Once all have, the run is stopped."""
+        with self.condition:
+            self.clients -= 1
+            if self.clients == 0 and self.rc is None:
+                self.cancel_event.set()
+
+
+class Daemon:
+    """
+    Runs single instance commands for enviroform_client.py, sent over
+    a Unix socket, so they pay no Python startup, git rev-parse or
+    directory walks: the root path and a TreeIndex stay in memory, the
+    index revalidating a directory with one stat. Identical requests
+    arriving while one runs get that run's output and rc, rather than
+    running terraform again. Each run gets its own data dir, as in
+    fleet, since runs of one config can overlap. Anything else, e.g.
+    fleet, or an apply waiting for approval, is sent back to the client
+    to run itself.
+
+    Requests and replies are JSON lines. A request is {"argv": [...],
+    "env": {...}}, or {"stop": true}. The replies are {"output": text}
+    as it comes, then {"rc": rc, "shared": bool}, or {"fallback": why}.
+    """
+
+    def __init__(self, root_path: str, socket_path: str) -> None:
+        self.root_path = root_path
+        self.socket_path = socket_path
+        self.index = TreeIndex(root_path)
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.server = None
+
+    def serve(self) -> None:
+        """Serves requests until stopped."""
+        with contextlib.suppress(OSError):
+            with socket.socket(socket.AF_UNIX) as probe:
+                probe.connect(self.socket_path)
+                raise SystemExit(
+                    f'ERROR: a daemon is listening on {self.socket_path}'
+                )
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self.socket_path)
+        os.makedirs(os.path.dirname(self.socket_path), exist_ok=True)
+        daemon = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self) -> None:
+                daemon.handle(self.rfile, self.wfile)
+
+        # it runs commands with our credentials: only we may connect
+        umask = os.umask(0o177)
+        try:
+            self.server = socketserver.ThreadingUnixStreamServer(
+                self.socket_path, Handler
+            )
+        finally:
+            os.umask(umask)
+        self.server.daemon_threads = True
+        try:
+            self.server.serve_forever()
+        finally:
+            self.server.server_close()
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self.socket_path)
+            self.index.save()
+
+    def handle(
+        self, rfile: typing.BinaryIO, wfile: typing.BinaryIO
+    ) -> None:
+        def send(**message) -> None:
+            wfile.write(json.dumps(message).encode() + b'\n')
+            wfile.flush()
+
+        request = json.loads(rfile.readline() or '{}')
+        if request.get('stop'):
+            send(rc=0, shared=False)
+            threading.Thread(target=self.server.shutdown).start()
+            return
+        argv, env = request.get('argv', []), request.get('env', {})
+        try:
+            # argparse reports bad args itself, in the client
+            with contextlib.redirect_stderr(io.StringIO()):
+                known_args, other_args = parse_args(argv)
+        except SystemExit:
+            send(fallback='invalid args')
+            return
+        if not other_args or other_args[0] in DAEMON_LOCAL_COMMANDS:
+            send(fallback=f'{other_args[0] if other_args else argv} '
+                          f'runs in the client')
+            return
+        if known_args.trace_out:
+            send(fallback='--trace-out runs in the client')
+            return
+        if needs_approval(other_args):
+            send(fallback='approving changes runs in the client')
+            return
+
+        key = hashlib.sha256(json.dumps([argv, {
+            name: value for name, value in env.items()
+            if name not in DAEMON_IGNORED_ENV
+        }], sort_keys=True).encode()).hexdigest()
+        with self.lock:
+            job = self.jobs.get(key)
+            shared = job is not None
+            if job is None:
+                job = self.jobs[key] = DaemonJob()
+                threading.Thread(
+                    target=self.run_job,
+                    args=(key, job, known_args, other_args, env),
+                    daemon=True
+                ).start()
+            with job.condition:
+                job.clients += 1
+        try:
+            for text in job.follow():
+                send(output=text)
+            send(rc=job.rc, shared=shared)
+        except OSError:
+            job.detach()
+
+    def run_job(
+        self,
+        key: str,
+        job: DaemonJob,
+        known_args: argparse.Namespace,
+        other_args: list,
+        env: dict
+    ) -> None:
+        """Runs the command as `enviroform.py` would, in the client's env."""
+        # other jobs may be running instances of the same config
+        known_args.isolate_data_dir = True
+        try:
+            tf = Enviroform(
+                env.get('TERRAFORM_EXECUTABLE') or 'terraform',
+                self.root_path,
+                known_args,
+                other_args
+            )
+            # nobody is at a terminal to answer terraform's questions
+            tf.environ = dict(env, TF_INPUT='0')
+            if not known_args.no_index:
+                # files may have changed since the last request
+                self.index.invalidate()
+                tf.index = self.index
+            tf.cancel_event = job.cancel_event
+            result = tf.run(output=job)
+            if result.error:
+                job.write(result.error + '\n')
+            rc = result.rc
+        except Exception as e:
+            # the clients must hear of it, or they would wait forever
+            job.write(f'ERROR: {type(e).__name__}: {e}\n')
+            rc = 1
+        with self.lock:
+            del self.jobs[key]
+        job.finish(rc)
+        self.index.save()
+
+
+def daemon_main(
+    root_path: str, known_args: argparse.Namespace, other_args: list
+) -> int:
+    """
+    enviroform.py daemon [stop]
+    Serves single instance runs from enviroform_client.py on a Unix
+    socket, see Daemon, until stopped by `daemon stop` or a signal.
+    """
+    if other_args[1:] not in [[], ['stop']]:
+        raise SystemExit('ERROR: usage: daemon [stop]')
+    socket_path = get_daemon_socket(root_path)
+    if other_args[1:] == ['stop']:
+        with socket.socket(socket.AF_UNIX) as client:
+            try:
+                client.connect(socket_path)
+            except OSError:
+                raise SystemExit(f'ERROR: no daemon on {socket_path}')
+            client.sendall(b'{"stop": true}\n')
+            client.makefile().readline()
+        print(f'Stopped the daemon on {socket_path}')
+        return 0
+    # terraform must never wait on our terminal
+    devnull = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(devnull, 0)
+    os.close(devnull)
+    print(f'Serving {root_path} on {socket_path}', flush=True)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    Daemon(root_path, socket_path).serve()
+    return 0
+
+
+def parse_args(
+    argv: list[str] = None
+) -> tuple[argparse.Namespace, list[str]]:
+    """
+    Parses command line args (default: sys.argv) to be passed to Enviroform
+    Returns: a tuple of two objects:
+      - argparse object with processed/known flags
+      - list of strings containing remaining args
+    """
+    parser = argparse.ArgumentParser(
+        description='enviroform.py: a terraform wrapper script.'
+    )
+    parser.add_argument(
+        '--terraform-config-path',
+        '-t',
+        help='path to terraform config directory'
+    )
+    parser.add_argument(
+        '--tfvars-file-path',
+        '-z',
+        help='path to your primary .tfvars file'
+    )
+    parser.add_argument(
+        '--dry-run',
+        '-d',
+        action='store_true',
+        help='dry run'
+    )
+    parser.add_argument(
+        '--force-init',
+        action='store_true',
+        help='always wipe .terraform and init, even if nothing changed'
+    )
+    parser.add_argument(
+        '--isolate-data-dir',
+        action='store_true',
+        help='use a per-instance TF_DATA_DIR and a shared plugin cache'
+             ' (always on for fleet)'
+    )
+    parser.add_argument(
+        '--clone-data-dir',
+        action='store_true',
+        help='with isolated data dirs: clone providers and modules from a'
+             ' warmed per-config template, then only configure the backend'
+    )
+    parser.add_argument(
+        '--plugin-cache-max-mb',
+        type=int,
+        help='evict least recently used providers from the plugin cache'
+             f' above this size (default: {DEFAULT_PLUGIN_CACHE_MAX_MB})'
+    )
+    parser.add_argument(
+        '--plan-cache',
+        action='store_true',
+        help='reuse the result of a plan whose inputs have not changed'
+    )
+    parser.add_argument(
+        '--plan-cache-ttl',
+        type=int,
+        help='seconds a cached plan result is reused'
+             f' (default: {DEFAULT_PLAN_CACHE_TTL})'
+    )
+    parser.add_argument(
+        '--refresh',
+        action='store_true',
+        help='ignore cached plan results and outputs, plan or read again'
+    )
+    parser.add_argument(
+        '--save-plan',
+        action='store_true',
+        help='keep the plan, for a later "apply-saved" of the same inputs'
+    )
+    parser.add_argument(
+        '--summarize',
+        action='store_true',
+        help='after plan, count the planned changes by resource type'
+    )
+    parser.add_argument(
+        '--trace-out',
+        help='write timing spans of each phase as Chrome trace JSON to this'
+             ' path, and a summary to <path>.summary.json'
+    )
+    parser.add_argument(
+        '--parallelism',
+        type=int,
+        help='pass -parallelism to commands which walk the resource graph'
+             ' (fleet default: the --parallelism-budget split over --jobs)'
+    )
+    parser.add_argument(
+        '--parallelism-budget',
+        type=int,
+        help='fleet: total terraform -parallelism across running instances'
+             f' (default: {DEFAULT_PARALLELISM_PER_CPU} per cpu)'
+    )
+    parser.add_argument(
+        '--min-free-mb',
+        type=int,
+        help='fleet: only start an instance while this much memory, plus'
+             ' the biggest run so far, is available'
+             f' (default: {DEFAULT_MIN_FREE_MB})'
+    )
+    parser.add_argument(
+        '--max-load',
+        type=float,
+        help='fleet: only start an instance while the 1 minute load'
+             ' average is below this'
+    )
+    parser.add_argument(
+        '--environments-dir',
+        help='fleet: path to the environments directory'
+    )
+    parser.add_argument(
+        '--terraform-dir',
+        help='fleet: path to the terraform config_type directories'
+    )
+    parser.add_argument(
+        '--jobs',
+        type=int,
+        help='fleet: max instances to run at once (default: cpu count)'
+    )
+    parser.add_argument(
+        '--backend-jobs',
+        type=int,
+        help='fleet: max instances to run at once against one backend'
+    )
+    parser.add_argument(
+        '--backend-rate',
+        type=float,
+        help='fleet: max instances to start per second against one backend'
+    )
+    parser.add_argument(
+        '--lock-retries',
+        type=int,
+        help='fleet: times to requeue an instance that failed to acquire'
+             f' the state lock (default: {DEFAULT_LOCK_RETRIES})'
+    )
+    parser.add_argument(
+        '--retries',
+        type=int,
+        help='fleet: times to retry an instance that failed with a'
+             ' transient error, e.g. throttling (default: 0)'
+    )
+    parser.add_argument(
+        '--resume',
+        metavar='RUN_ID',
+        help='fleet: run only the instances a previous run did not finish'
+    )
+    parser.add_argument(
+        '--time-budget',
+        type=float,
+        metavar='SECONDS',
+        help='fleet drift: leave out the most stable instances so the run'
+             ' is expected to take about this long'
+    )
+    parser.add_argument(
+        '--merge-tfvars',
+        action='store_true',
+        help='pass the environment, region and instance .tfvars merged'
+             ' into one cached .tfvars.json'
+    )
+    parser.add_argument(
+        '--upstream-outputs',
+        action='store_true',
+        help='pass the outputs of the instances this one depends on in'
+             ' the upstream_outputs variable'
+    )
+    parser.add_argument(
+        '--outputs-ttl',
+        type=float,
+        help='seconds cached instance outputs are used for'
+             f' (default: {DEFAULT_OUTPUTS_TTL})'
+    )
+    parser.add_argument(
+        '--format',
+        choices=['json', 'make', 'ninja'],
+        help='export: what to write the jobs as (default: json)'
+    )
+    parser.add_argument(
+        '--output',
+        metavar='PATH',
+        help='export: write the jobs here instead of to stdout'
+    )
+    parser.add_argument(
+        '--platform',
+        action='append',
+        help='warm: mirror providers for this platform e.g. linux_amd64'
+             ' (repeatable, default: this machine\'s)'
+    )
+    parser.add_argument(
+        '--registry-url',
+        help='warm: look up every provider at this registry instead of'
+             ' its own host'
+    )
+    parser.add_argument(
+        '--shard',
+        metavar='i/N',
+        help='fleet: run only shard i of N, balanced by expected run time'
+             ' e.g. one shard per CI node'
+    )
+    parser.add_argument(
+        '--durations',
+        metavar='PATH',
+        help='fleet --shard: JSON of expected seconds per instance label,'
+             ' from "history export" (default: balance by count)'
+    )
+    parser.add_argument(
+        '--limit',
+        type=int,
+        default=20,
+        help='history slowest: instances to print (default: 20)'
+    )
+    parser.add_argument(
+        '--fail-fast',
+        action='store_true',
+        help='fleet: on the first failure, stop running instances and'
+             ' start no more'
+    )
+    parser.add_argument(
+        '--interrupt-grace',
+        type=float,
+        help='seconds terraform gets to stop after SIGINT, before SIGTERM'
+             f' (default: {DEFAULT_INTERRUPT_GRACE:.0f})'
+    )
+    parser.add_argument(
+        '--terminate-grace',
+        type=float,
+        help='seconds terraform gets to stop after SIGTERM, before SIGKILL'
+             f' (default: {DEFAULT_TERMINATE_GRACE:.0f})'
+    )
+    parser.add_argument(
+        '--filter',
+        action='append',
+        help='fleet: only run instances whose label matches this glob'
+             ' e.g. "*/us-east-1/apps/*" (repeatable)'
+    )
+    parser.add_argument(
+        '--since',
+        help='fleet: only run instances affected by changes since this'
+             ' git ref (see "affected")'
+    )
+    parser.add_argument(
+        '--no-index',
+        action='store_true',
+        help='stat each file, rather than resolving files from the cached'
+             ' tree index (see "index")'
+    )
+    parser.add_argument(
+        '--log-dir',
+        help='fleet: directory for per-instance logs'
+    )
+    parser.add_argument(
+        '--quiet',
+        action='store_true',
+        help='fleet: only write output to the logs, not the console'
+    )
+    return parser.parse_known_args(argv)
+
+
+def get_git_root_path() -> str:
+    """Returns the root path of the git repo that is."""
+    git_cmd = ["git", "rev-parse", "--show-toplevel"]
+    return subprocess.check_output(git_cmd).rstrip().decode('ascii')
+
+
+def get_state_dir(root_path: str) -> str:
+    """Returns the directory enviroform keeps its own files in."""
+    # You can over-ride the default <root>/.enviroform
+    # by setting this env var
+    state_dir = os.environ.get('ENVIROFORM_STATE_DIR')
+    if not state_dir:
+        state_dir = os.path.join(root_path, '.enviroform')
+    return state_dir
+
+
+def get_tf_cmd() -> str:
+    """Returns the terraform command path to use."""
+    # You can over-ride the default command 'terraform'
+    # by setting this env var
+    tf_cmd = os.environ.get('TERRAFORM_EXECUTABLE')
+    if not tf_cmd:
         tf_cmd = 'terraform'
     return tf_cmd
 
@@ -284,14 +5022,68 @@ def get_tf_cmd() -> str:
 def main() -> int:
     """Implement Enviroform as a script. Returns return code."""
     known_args, other_args = parse_args()
-    sys.exit(
-        Enviroform(
-            get_tf_cmd(),
-            get_git_root_path(),
-            known_args,
-            other_args
-        ).run_tf_cmd())
+    if other_args and other_args[0] == 'fleet':
+        sys.exit(
+            Fleet(
+                get_tf_cmd(),
+                get_git_root_path(),
+                known_args,
+                other_args
+            ).run_fleet())
+    if other_args and other_args[0] == 'affected':
+        sys.exit(
+            affected_main(
+                get_tf_cmd(),
+                get_git_root_path(),
+                known_args,
+                other_args
+            ))
+    if other_args and other_args[0] == 'index':
+        sys.exit(index_main(get_git_root_path(), known_args, other_args))
+    if other_args and other_args[0] == 'outputs':
+        sys.exit(
+            outputs_main(
+                get_tf_cmd(),
+                get_git_root_path(),
+                known_args,
+                other_args
+            ))
+    if other_args and other_args[0] == 'export':
+        sys.exit(
+            export_main(
+                get_tf_cmd(),
+                get_git_root_path(),
+                known_args,
+                other_args
+            ))
+    if other_args and other_args[0] == 'daemon':
+        sys.exit(daemon_main(get_git_root_path(), known_args, other_args))
+    if other_args and other_args[0] == 'warm':
+        sys.exit(warm_main(get_git_root_path(), known_args, other_args))
+    if other_args and other_args[0] == 'history':
+        sys.exit(history_main(get_git_root_path(), known_args, other_args))
+    tf = Enviroform(
+        get_tf_cmd(),
+        get_git_root_path(),
+        known_args,
+        other_args
+    )
+    if not known_args.no_index:
+        tf.index = TreeIndex(tf.root_path)
+    if known_args.trace_out:
+        tf.tracer = Tracer()
+    try:
+        sys.exit(tf.run_tf_cmd())
+    finally:
+        if tf.index is not None:
+            tf.index.save()
+        if tf.tracer is not None:
+            tf.tracer.write(known_args.trace_out)
 
 
 if __name__ == '__main__':
-    main()
+    try:
+        main()
+    except KeyboardInterrupt:
+        # the running command has been stopped by then, see Enviroform.stop()
+        sys.exit(130)
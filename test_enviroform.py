@@ -3,8 +3,19 @@
 
 import argparse
 import copy
+import hashlib
+import http.server
+import io
+import json
 import os
+import shutil
+import socket
+import subprocess
+import threading
+import time
 import enviroform
+import enviroform_client
+import pytest
 import unittest.mock as mock
 
 patch = mock.patch
@@ -19,6 +30,30 @@ def get_test_root_path():
 os.chdir(get_test_root_path())
 
 
+@pytest.fixture(autouse=True)
+def state_dir(tmp_path, monkeypatch):
+    """Keeps enviroform's own files out of the repo."""
+    path = tmp_path / 'state'
+    monkeypatch.setenv('ENVIROFORM_STATE_DIR', str(path))
+    return path
+
+
+def copy_example(tmp_path):
+    """Copies example/ under tmp_path, to be used as a root path."""
+    shutil.copytree(
+        os.path.join(get_test_root_path(), 'example'),
+        tmp_path / 'example'
+    )
+    return str(tmp_path)
+
+
+def fake_init(cmd_list, cwd):
+    """Call side effect which creates .terraform like init would."""
+    if cmd_list[1:2] == ['init']:
+        os.makedirs(os.path.join(cwd, '.terraform'), exist_ok=True)
+    return 0
+
+
 basic_args = argparse.Namespace()
 basic_args.terraform_config_path = 'example/terraform/apps/example-app'
 basic_args.tfvars_file_path = 'example/environments/example-account/us-east-1/apps/example-app/default.tfvars'  # NOQA
@@ -329,3 +364,1363 @@ def test_instance(subprocess_mock):
             f'-var-file={root_path}/example/environments/example-account/us-east-1/region.tfvars',  # NOQA
             f'-var-file={root_path}/example/environments/example-account/us-east-1/apps/example-app/experiment.tfvars',  # NOQA
         ]
+
+
+fleet_flags = [
+    '--environments-dir', 'example/environments',
+    '--terraform-dir', 'example/terraform',
+]
+
+
+def test_discover_instances():
+    """All <instance>.tfvars files in the example tree are found."""
+    instances = enviroform.discover_instances(
+        get_test_root_path(), 'example/environments', 'example/terraform'
+    )
+    assert [i.label for i in instances] == [
+        'example-account/us-east-1/apps/example-app/default',
+        'example-account/us-east-1/apps/example-app/experiment',
+        'example-account/us-east-1/infra/example-networking/default',
+    ]
+    assert instances[0].terraform_config_path == 'example/terraform/apps/example-app'  # NOQA
+    assert instances[0].tfvars_file_path == basic_args.tfvars_file_path
+
+
+def test_fleet_dry(tmp_path):
+    """fleet --dry-run logs every instance's commands."""
+    known_args, other_args = enviroform.parse_args(fleet_flags + [
+        '--log-dir', str(tmp_path), '--jobs', '2', '--dry-run',
+        'fleet', 'plan',
+    ])
+    fleet = enviroform.Fleet(
+        enviroform.get_tf_cmd(),
+        get_test_root_path(),
+        known_args,
+        other_args
+    )
+    assert fleet.run_fleet() == 0
+    log_path = tmp_path / 'example-account__us-east-1__apps__example-app__experiment.log'  # NOQA
+    assert '-backend-config=key=apps/example-app/experiment/state.tfstate' in log_path.read_text()  # NOQA
+
+
+def test_fleet_failure(tmp_path):
+    """A failing instance is reported and fails the fleet."""
+    fake_tf = tmp_path / 'terraform'
+    fake_tf.write_text('#!/bin/sh\n[ "$1" = plan ] && exit 1\nexit 0\n')
+    fake_tf.chmod(0o755)
+    known_args, other_args = enviroform.parse_args(fleet_flags + [
+        '--log-dir', str(tmp_path), '--filter', '*/infra/*',
+        'fleet', 'plan',
+    ])
+    fleet = enviroform.Fleet(
+        str(fake_tf),
+        get_test_root_path(),
+        known_args,
+        other_args
+    )
+    fleet.process_args()
+    results = fleet.schedule(fleet.select_instances())
+    assert [(r.label, r.rc) for r in results] == [
+        ('example-account/us-east-1/infra/example-networking/default', 1)
+    ]
+    assert 'Command failed with rc 1' in results[0].error
+
+
+def test_fleet_no_input(tmp_path):
+    """Fleet instances never read our stdin, so they can't race for it."""
+    fake_tf = write_fake_tf(tmp_path, '''
+[ "$1" = apply ] || exit 0
+echo "TF_INPUT=$TF_INPUT"
+read answer && echo "answered $answer" && exit 0
+echo "no answer"
+exit 1
+''')
+    known_args, other_args = enviroform.parse_args(fleet_flags + [
+        '--log-dir', str(tmp_path), '--filter', '*/apps/*',
+        'fleet', 'apply',
+    ])
+    fleet = enviroform.Fleet(
+        fake_tf, get_test_root_path(), known_args, other_args
+    )
+    fleet.process_args()
+    read_fd, write_fd = os.pipe()
+    os.write(write_fd, b'yes\nyes\n')
+    os.close(write_fd)
+    stdin = os.dup(0)
+    os.dup2(read_fd, 0)
+    try:
+        results = fleet.schedule(fleet.select_instances())
+    finally:
+        os.dup2(stdin, 0)
+        os.close(stdin)
+        os.close(read_fd)
+    assert [r.rc for r in results] == [1, 1]
+    for r in results:
+        assert r.tail[-3:-1] == ['TF_INPUT=0', 'no answer']
+
+
+@patch('enviroform.Enviroform.call')
+def test_incremental_init(subprocess_mock, tmp_path):
+    """init is skipped until one of its inputs changes."""
+    subprocess_mock.side_effect = fake_init
+    root_path = copy_example(tmp_path)
+
+    def run(known_args):
+        subprocess_mock.reset_mock()
+        enviroform.Enviroform(
+            enviroform.get_tf_cmd(),
+            root_path,
+            known_args,
+            ['plan'],
+        ).run_tf_cmd()
+        return [c.args[0][1] for c in subprocess_mock.mock_calls]
+
+    assert run(basic_args) == ['-rf', 'init', 'plan']
+    assert run(basic_args) == ['plan']
+    # another instance has another backend key
+    assert run(instance_args) == ['-rf', 'init', 'plan']
+    assert run(instance_args) == ['plan']
+    force_args = copy.deepcopy(instance_args)
+    force_args.force_init = True
+    assert run(force_args) == ['-rf', 'init', 'plan']
+    with open(tmp_path / 'example/environments/example-account/us-east-1/backend.tfvars', 'a') as f:  # NOQA
+        f.write('bucket = "another"\n')
+    assert run(instance_args) == ['-rf', 'init', 'plan']
+    with open(tmp_path / 'example/terraform/apps/example-app/.terraform.lock.hcl', 'w') as f:  # NOQA
+        f.write('# lock\n')
+    assert run(instance_args) == ['-rf', 'init', 'plan']
+    assert run(instance_args) == ['plan']
+    # anything in the terraform block counts, however it is laid out
+    main_tf = tmp_path / 'example/terraform/apps/example-app/main.tf'
+    main_tf.write_text(main_tf.read_text().replace(
+        'required_version = ">= 1.0, < 2.0"',
+        'required_version = ">= 1.5, < 2.0"'
+    ))
+    assert run(instance_args) == ['-rf', 'init', 'plan']
+    with open(main_tf, 'a') as f:
+        f.write('output "other" {\n  value = "thing"\n}\n')
+    assert run(instance_args) == ['plan']
+
+
+@patch('enviroform.Enviroform.call')
+def test_isolated_data_dir(subprocess_mock, state_dir):
+    """--isolate-data-dir sets TF_DATA_DIR and a shared plugin cache."""
+    subprocess_mock.return_value = 0
+    known_args = copy.deepcopy(instance_args)
+    known_args.isolate_data_dir = True
+    tf = enviroform.Enviroform(
+        enviroform.get_tf_cmd(),
+        get_test_root_path(),
+        known_args,
+        ['plan'],
+    )
+    tf.run_tf_cmd()
+    data_dir = str(state_dir / 'data/example-account/us-east-1/apps/example-app/experiment')  # NOQA
+    assert subprocess_mock.mock_calls[0].args[0] == ['rm', '-rf', data_dir]
+    assert tf.environ['TF_DATA_DIR'] == data_dir
+    assert tf.environ['TF_PLUGIN_CACHE_DIR'] == str(state_dir / 'plugin-cache')  # NOQA
+
+
+def test_prune_plugin_cache(tmp_path):
+    """Least recently used providers are evicted down to the size bound."""
+    for age, version in enumerate(['3.2.1', '3.2.0', '3.1.0']):
+        path = tmp_path / 'registry.terraform.io/hashicorp/null' / version / 'linux_amd64'  # NOQA
+        path.mkdir(parents=True)
+        (path / 'terraform-provider-null').write_bytes(b'x' * 100)
+        os.utime(path, (1000 - age, 1000 - age))
+    removed = enviroform.prune_plugin_cache(str(tmp_path), 150)
+    assert [p.split(os.sep)[-2] for p in removed] == ['3.1.0', '3.2.0']
+    assert (tmp_path / 'registry.terraform.io/hashicorp/null/3.2.1').is_dir()
+
+
+def write_fake_tf(tmp_path, script='echo "$@"\n'):
+    """Writes a fake terraform executable, returns its path."""
+    fake_tf = tmp_path / 'terraform'
+    fake_tf.write_text('#!/bin/sh\n' + script)
+    fake_tf.chmod(0o755)
+    return str(fake_tf)
+
+
+def test_run_result(tmp_path):
+    """run() captures output and reports errors in its result."""
+    cwd = os.getcwd()
+    tf = enviroform.Enviroform(
+        write_fake_tf(tmp_path),
+        get_test_root_path(),
+        basic_args,
+        ['apply', '-auto-approve'],
+    )
+    result = tf.run()
+    assert result.rc == 0
+    assert result.error == ''
+    assert [s.name for s in result.steps] == ['rm', 'init', 'apply']
+    assert result.commands[2][-1] == '-auto-approve'
+    assert result.steps[2].cwd == f'{get_test_root_path()}/example/terraform/apps/example-app'  # NOQA
+    assert 'apply -var-file=' in result.output
+    assert os.getcwd() == cwd
+
+    result = enviroform.Enviroform(
+        enviroform.get_tf_cmd(),
+        get_test_root_path(),
+        no_deployable_args,
+        ['apply'],
+    ).run()
+    assert result.rc == 1
+    assert 'dir not found' in result.error
+
+
+def test_run_async(tmp_path):
+    """Many run_async() calls can share one event loop."""
+    fake_tf = write_fake_tf(tmp_path, 'sleep 0.05\necho "$@"\n')
+
+    async def run_all():
+        runs = []
+        for args in [basic_args, instance_args] * 3:
+            known_args = copy.deepcopy(args)
+            known_args.isolate_data_dir = True
+            runs.append(enviroform.Enviroform(
+                fake_tf, get_test_root_path(), known_args, ['plan']
+            ).run_async())
+        return await enviroform.asyncio.gather(*runs)
+
+    results = enviroform.asyncio.run(run_all())
+    assert [r.rc for r in results] == [0] * 6
+    assert 'key=apps/example-app/experiment/state.tfstate' in results[1].output  # NOQA
+    assert results[0].steps[-1].cmd_list[-1] == '-detailed-exitcode'
+
+
+def test_tree_index(tmp_path):
+    """The index is persisted, and only changed dirs are rescanned."""
+    root_path = copy_example(tmp_path)
+    index = enviroform.TreeIndex(
+        root_path, 'example/environments', 'example/terraform'
+    ).refresh()
+    index.save()
+    assert len(index.instances()) == 3
+
+    app_dir = tmp_path / 'example/environments/example-account/us-east-1/apps/example-app'  # NOQA
+    (app_dir / 'canary.tfvars').write_text('app_name = "canary"\n')
+    os.utime(app_dir, ns=(0, 10**18))
+    index = enviroform.TreeIndex(
+        root_path, 'example/environments', 'example/terraform'
+    )
+    with patch('os.scandir', wraps=os.scandir) as scandir:
+        index.refresh()
+        assert [c.args[0] for c in scandir.mock_calls if c.args] == [
+            str(app_dir)
+        ]
+    assert [i.label for i in enviroform.query_instances(
+        index.instances(), ['config_name=example-app', 'name=c*']
+    )] == ['example-account/us-east-1/apps/example-app/canary']
+    assert not index.has_dir('example/terraform/apps/example-foo')
+    # each dir's mtime is checked once, until invalidated
+    for stats in [0, 1]:
+        with patch('os.stat', wraps=os.stat) as stat:
+            assert index.has_file(str(app_dir / 'canary.tfvars'))
+            assert not index.has_file(str(app_dir / 'other.tfvars'))
+            assert stat.call_count == stats
+        index.invalidate()
+
+
+@patch('enviroform.Enviroform.call')
+def test_index_resolves_files(subprocess_mock):
+    """With an index, process_tfvars doesn't stat files itself."""
+    subprocess_mock.return_value = 0
+    tf = enviroform.Enviroform(
+        enviroform.get_tf_cmd(),
+        get_test_root_path(),
+        basic_args,
+        ['plan'],
+    )
+    tf.index = enviroform.TreeIndex(get_test_root_path())
+    with patch('os.path.isfile') as isfile:
+        tf.process_args()
+        assert isfile.call_count == 0
+    assert tf.backend_args[1] == '-backend-config=key=apps/example-app/default/state.tfstate'  # NOQA
+
+
+def test_affected_instances(tmp_path):
+    """Changed files map onto the instances whose inputs they are."""
+    root_path = copy_example(tmp_path)
+    modules_dir = tmp_path / 'example/terraform/modules/vpc'
+    modules_dir.mkdir(parents=True)
+    (modules_dir / 'main.tf').write_text('# a local module\n')
+    with open(tmp_path / 'example/terraform/infra/example-networking/main.tf', 'a') as f:  # NOQA
+        f.write('module "vpc" {\n  source = "../../modules/vpc"\n}\n')
+    instances = enviroform.discover_instances(
+        root_path, 'example/environments', 'example/terraform'
+    )
+
+    def affected(*changed):
+        return [i.name + '@' + i.config_name for i in enviroform.affected_instances(  # NOQA
+            root_path, instances, list(changed),
+            'example/environments', 'example/terraform'
+        )]
+
+    env = 'example/environments/example-account'
+    everything = [
+        'default@example-app',
+        'experiment@example-app',
+        'default@example-networking',
+    ]
+    assert affected(f'{env}/environment.tfvars') == everything
+    assert affected(f'{env}/us-east-1/backend.tfvars') == everything
+    assert affected(f'{env}/us-west-2/region.tfvars') == []
+    assert affected(f'{env}/us-east-1/apps/example-app/experiment.tfvars') == [  # NOQA
+        'experiment@example-app'
+    ]
+    assert affected('example/terraform/apps/example-app/variables.tf') == [
+        'default@example-app', 'experiment@example-app'
+    ]
+    assert affected('example/terraform/modules/vpc/main.tf') == [
+        'default@example-networking'
+    ]
+    assert affected('README.md', 'example/terraform/README.md') == []
+
+
+def test_get_changed_files(tmp_path):
+    """Committed, uncommitted and untracked changes since a ref."""
+    def git(*args):
+        enviroform.subprocess.check_output(['git', *args], cwd=tmp_path)
+
+    git('init', '-q')
+    git('config', 'user.email', 'test@example.com')
+    git('config', 'user.name', 'test')
+    (tmp_path / 'a.tfvars').write_text('a = 1\n')
+    (tmp_path / 'b.tfvars').write_text('b = 1\n')
+    git('add', '.')
+    git('commit', '-qm', 'base')
+    git('tag', 'base')
+    (tmp_path / 'a.tfvars').write_text('a = 2\n')
+    git('commit', '-qam', 'change a')
+    git('mv', 'b.tfvars', 'c.tfvars')
+    (tmp_path / 'd.tfvars').write_text('d = 1\n')
+    assert enviroform.get_changed_files(str(tmp_path), 'base') == [
+        'a.tfvars', 'b.tfvars', 'c.tfvars', 'd.tfvars'
+    ]
+
+
+def test_plan_cache(tmp_path):
+    """A plan with unchanged inputs returns the cached rc and output."""
+    root_path = copy_example(tmp_path)
+    fake_tf = write_fake_tf(
+        tmp_path,
+        '[ "$1" = plan ] && echo "planned at $(date +%s%N)" && exit 2\n'
+        'exit 0\n'
+    )
+
+    def plan(**flags):
+        known_args = copy.deepcopy(basic_args)
+        known_args.plan_cache = True
+        vars(known_args).update(flags)
+        return enviroform.Enviroform(
+            fake_tf, root_path, known_args, ['plan']
+        ).run()
+
+    first = plan()
+    assert first.rc == 2
+    assert first.commands[-1][-1].startswith('-out=')
+    assert first.commands[-1][-1].endswith('/plan.tfplan')
+    cached = plan()
+    assert cached.rc == 2
+    assert cached.steps == []
+    assert first.output.split('\n')[-2] in cached.output
+    assert plan(refresh=True).steps != []
+    with open(tmp_path / basic_args.tfvars_file_path, 'a') as f:
+        f.write('task_count = 2\n')
+    assert plan().steps != []
+    assert plan().steps == []
+    assert plan(plan_cache_ttl=-1).steps != []
+
+
+def test_output_sink(tmp_path):
+    """Lines are prefixed on the console, logged in full, tailed."""
+    console = io.StringIO()
+    with open(tmp_path / 'log', 'w') as log:
+        sink = enviroform.OutputSink('env/app', console, log, tail_lines=2)
+        sink.write('one\ntw')
+        assert console.getvalue() == '[env/app] one\n'
+        sink.write('o\nthree\nfour')
+        sink.finish()
+    assert console.getvalue().splitlines() == [
+        '[env/app] one', '[env/app] two', '[env/app] three', '[env/app] four'
+    ]
+    assert list(sink.tail) == ['three', 'four']
+    assert (tmp_path / 'log').read_text() == 'one\ntwo\nthree\nfour'
+
+
+def test_pump_large_output(tmp_path):
+    """A child's output is streamed through, not buffered in memory."""
+    fake_tf = write_fake_tf(
+        tmp_path,
+        '[ "$1" = output ] || exit 0\n'
+        'yes "resource changed" | head -n 200000\necho done >&2\n'
+    )
+    log_path = tmp_path / 'log'
+    with open(log_path, 'w') as log:
+        sink = enviroform.OutputSink(log=log, tail_lines=3)
+        tf = enviroform.Enviroform(
+            fake_tf, get_test_root_path(), basic_args, ['output']
+        )
+        with patch.object(sink, 'write', wraps=sink.write) as write:
+            result = tf.run(output=sink)
+            biggest = max(len(c.args[0]) for c in write.mock_calls)
+        sink.finish()
+    assert result.rc == 0
+    assert biggest <= enviroform.PIPE_READ_SIZE
+    assert log_path.read_text().count('resource changed\n') == 200000
+    assert list(sink.tail)[-1] == 'done'
+
+
+def test_trace(tmp_path):
+    """Each phase of a run is recorded as a span and can be exported."""
+    tf = enviroform.Enviroform(
+        write_fake_tf(tmp_path), get_test_root_path(), basic_args, ['plan']
+    )
+    tf.tracer = enviroform.Tracer()
+    assert tf.run().rc == 0
+    trace_path = str(tmp_path / 'trace.json')
+    tf.tracer.write(trace_path)
+
+    with open(trace_path) as f:
+        events = [e for e in json.load(f)['traceEvents'] if e['ph'] == 'X']
+    assert [e['name'] for e in events] == ['discovery', 'rm', 'init', 'plan']
+    assert events[3]['args'] == {
+        'label': 'example-account/us-east-1/apps/example-app/default',
+        'backend_key': 'apps/example-app/default/state.tfstate',
+        'rc': 0,
+    }
+    assert all(e['dur'] >= 0 for e in events)
+    with open(tmp_path / 'trace.summary.json') as f:
+        summary = json.load(f)
+    assert summary['phases']['init']['count'] == 1
+    assert set(summary['instances'][events[3]['args']['label']]['phases']) == {  # NOQA
+        'discovery', 'rm', 'init', 'plan'
+    }
+
+
+def test_benchmark_tree(tmp_path):
+    """The benchmark's synthetic tree is discovered like a real one."""
+    import benchmark
+    written = benchmark.generate_tree(str(tmp_path), 2, 2, 3, 24)
+    instances = enviroform.discover_instances(
+        str(tmp_path), 'environments', 'terraform'
+    )
+    assert written == len(instances) == 24
+    assert len({i.backend_key for i in instances}) == 6
+
+
+def test_dependency_order(tmp_path):
+    """apply runs upstream instances first, skipping dependents of failures."""
+    root_path = copy_example(tmp_path)
+    with open(tmp_path / 'example/terraform/apps/example-app/main.tf', 'a') as f:  # NOQA
+        f.write(
+            'data "terraform_remote_state" "net" {\n'
+            '  backend = "s3"\n'
+            '  config = {\n'
+            '    key = "infra/example-networking/default/state.tfstate"\n'
+            '  }\n'
+            '}\n'
+        )
+    with open(tmp_path / 'example/environments/example-account/us-east-1/apps/example-app/experiment.tfvars', 'a') as f:  # NOQA
+        f.write('\n# enviroform: depends_on apps/example-app/default\n')
+    instances = enviroform.discover_instances(
+        root_path, 'example/environments', 'example/terraform'
+    )
+    graph = enviroform.dependency_graph(root_path, instances)
+    net, app, experiment = (
+        'example-account/us-east-1/infra/example-networking/default',
+        'example-account/us-east-1/apps/example-app/default',
+        'example-account/us-east-1/apps/example-app/experiment',
+    )
+    assert graph == {net: set(), app: {net}, experiment: {net, app}}
+    assert enviroform.dependency_levels(graph) == [[net], [app], [experiment]]
+    assert enviroform.critical_path_lengths(graph) == {
+        net: 3, app: 2, experiment: 1
+    }
+
+    order_path = tmp_path / 'order.txt'
+    fake_tf = write_fake_tf(
+        tmp_path,
+        f'[ "$1" = apply ] || exit 0\nbasename "$PWD" >> {order_path}\n'
+        '[ "$(basename "$PWD")" != "$FAIL_CONFIG" ]\n'
+    )
+    known_args, other_args = enviroform.parse_args(fleet_flags + [
+        '--log-dir', str(tmp_path / 'logs'), '--jobs', '3', '--quiet',
+        'fleet', 'apply',
+    ])
+    fleet = enviroform.Fleet(fake_tf, root_path, known_args, other_args)
+    fleet.process_args()
+    os.makedirs(fleet.log_dir)
+    assert fleet.select_instances() == instances
+    results = fleet.schedule(instances, graph)
+    assert [r.rc for r in results] == [0, 0, 0]
+    assert order_path.read_text().split() == [
+        'example-networking', 'example-app', 'example-app'
+    ]
+
+    order_path.unlink()
+    with patch.dict(os.environ, {'FAIL_CONFIG': 'example-networking'}):
+        results = fleet.schedule(instances, graph)
+    assert [(r.label, r.rc) for r in results] == [
+        (app, enviroform.SKIPPED_RC),
+        (experiment, enviroform.SKIPPED_RC),
+        (net, 1),
+    ]
+    assert order_path.read_text().split() == ['example-networking']
+    assert results[0].error == f'skipped, dependency {net} failed'
+
+
+def test_backend_limits(tmp_path):
+    """Instances sharing a backend are limited, and lock errors requeued."""
+    mutex, overlaps = tmp_path / 'backend-busy', tmp_path / 'overlaps'
+    fake_tf = write_fake_tf(tmp_path, f'''
+[ "$1" = plan ] || exit 0
+if [ "$(basename "$PWD")" = example-networking ] && \\
+        [ ! -e {tmp_path}/locked-once ]; then
+    touch {tmp_path}/locked-once
+    echo "Error: {enviroform.STATE_LOCK_ERROR}"
+    exit 1
+fi
+mkdir {mutex} 2>/dev/null || echo overlap >> {overlaps}
+sleep 0.2
+rmdir {mutex}
+''')
+    known_args, other_args = enviroform.parse_args(fleet_flags + [
+        '--log-dir', str(tmp_path), '--jobs', '3', '--quiet',
+        '--backend-jobs', '1',
+        'fleet', 'plan',
+    ])
+    fleet = enviroform.Fleet(
+        fake_tf, get_test_root_path(), known_args, other_args
+    )
+    fleet.process_args()
+    with patch('enviroform.LOCK_RETRY_DELAY', 0):
+        results = fleet.schedule(fleet.select_instances())
+    assert [r.rc for r in results] == [0, 0, 0]
+    assert not overlaps.exists()
+    log_path = tmp_path / 'example-account__us-east-1__infra__example-networking__default.log'  # NOQA
+    assert enviroform.STATE_LOCK_ERROR in log_path.read_text()
+
+
+def test_saved_plan(tmp_path):
+    """apply-saved applies the plan saved from the same inputs."""
+    root_path = copy_example(tmp_path)
+    fake_tf = write_fake_tf(tmp_path, '''
+for arg; do
+    case "$arg" in -out=*) echo saved > "${arg#-out=}";; esac
+done
+[ "$1" = plan ] && exit 2
+exit 0
+''')
+
+    def run(command, **flags):
+        known_args = copy.deepcopy(basic_args)
+        vars(known_args).update(flags)
+        return enviroform.Enviroform(
+            fake_tf, root_path, known_args, [command]
+        ).run()
+
+    assert 'has no saved plan' in run('apply-saved').error
+    assert run('plan', save_plan=True).rc == 2
+    applied = run('apply-saved')
+    assert applied.rc == 0
+    plan_path = applied.commands[-1][-1]
+    assert applied.commands[-1] == [fake_tf, 'apply', plan_path]
+    assert not os.path.exists(plan_path)
+    assert 'has no saved plan' in run('apply-saved').error
+
+    assert run('plan', save_plan=True).rc == 2
+    with open(tmp_path / basic_args.tfvars_file_path, 'a') as f:
+        f.write('task_count = 2\n')
+    assert 'inputs have changed' in run('apply-saved').error
+
+
+def test_resume(tmp_path, state_dir):
+    """A resumed run only runs what failed, retrying transient errors."""
+    fake_tf = write_fake_tf(tmp_path, f'''
+[ "$1" = plan ] || exit 0
+if [ "$(basename "$PWD")" = "$FAIL_CONFIG" ]; then
+    echo "Error: TooManyRequestsException: Rate exceeded"
+    [ -e {tmp_path}/failed-once ] && exit 0
+    touch {tmp_path}/failed-once
+    exit 1
+fi
+echo "planned $(basename "$PWD")"
+''')
+
+    def fleet(*flags):
+        known_args, other_args = enviroform.parse_args(fleet_flags + [
+            '--log-dir', str(tmp_path), '--quiet', *flags, 'fleet', 'plan',
+        ])
+        return enviroform.Fleet(
+            fake_tf, get_test_root_path(), known_args, other_args
+        )
+
+    with patch.dict(os.environ, {'FAIL_CONFIG': 'example-networking'}):
+        failing = fleet()
+        assert failing.run_fleet() == 1
+        os.remove(tmp_path / 'failed-once')
+        with patch('enviroform.RETRY_DELAY', 0):
+            assert fleet('--retries', '1').run_fleet() == 0
+        resumed = fleet('--resume', failing.run_id)
+        assert resumed.run_fleet() == 0
+
+    journal = enviroform.Journal(
+        enviroform.get_journal_path(get_test_root_path(), failing.run_id)
+    )
+    run, last = journal.load()
+    assert run['args'] == ['plan']
+    assert {label: r['rc'] for label, r in last.items()} == {
+        'example-account/us-east-1/apps/example-app/default': 0,
+        'example-account/us-east-1/apps/example-app/experiment': 0,
+        'example-account/us-east-1/infra/example-networking/default': 0,
+    }
+    with open(journal.path) as f:
+        events = [json.loads(line)['event'] for line in f]
+    assert events.count('start') == 4
+    assert events.index('resume') == 7
+    log = (tmp_path / 'example-account__us-east-1__apps__example-app__default.log').read_text()  # NOQA
+    assert log.count('planned example-app') == 1
+    with pytest.raises(SystemExit, match='was "plan", not "apply"'):
+        known_args, other_args = enviroform.parse_args(fleet_flags + [
+            '--resume', failing.run_id, 'fleet', 'apply',
+        ])
+        enviroform.Fleet(
+            fake_tf, get_test_root_path(), known_args, other_args
+        ).run_fleet()
+
+    # a resumed run is the run's own instances, whatever the flags now
+    os.remove(tmp_path / 'failed-once')
+    with patch.dict(os.environ, {'FAIL_CONFIG': 'example-app'}):
+        filtered = fleet('--filter', '*/apps/*/default')
+        assert filtered.run_fleet() == 1
+        assert fleet('--resume', filtered.run_id).run_fleet() == 0
+    run, last = enviroform.Journal(
+        enviroform.get_journal_path(get_test_root_path(), filtered.run_id)
+    ).load()
+    assert run['labels'] == [
+        'example-account/us-east-1/apps/example-app/default'
+    ]
+    assert list(last) == run['labels']
+    assert last[run['labels'][0]]['rc'] == 0
+
+
+def test_resource_budget(tmp_path):
+    """Fleet splits -parallelism over its jobs and holds starts on memory."""
+    budget = enviroform.ResourceBudget(min_free_mb=100, max_load=None)
+    mb = 1024 * 1024
+    with patch.object(budget, 'available_memory', return_value=500 * mb), \
+            patch.object(budget, 'expected_rss', return_value=150 * mb):
+        assert budget.room() == ''
+        assert budget.room(starting=1) == ''
+        assert budget.room(starting=2) == '500 MB of memory available'
+
+    # a run's memory is that of its whole session, providers included
+    run = subprocess.Popen(
+        ['sh', '-c', 'sleep 5 & sleep 5'], start_new_session=True
+    )
+    try:
+        time.sleep(0.2)
+        with open(f'/proc/{run.pid}/statm') as f:
+            leader_rss = int(f.read().split()[1]) * enviroform.resource.getpagesize()  # NOQA
+        runs = budget.runs_rss()
+        assert list(runs) == [run.pid]
+        assert runs[run.pid] > leader_rss
+        assert budget.expected_rss() >= runs[run.pid]
+    finally:
+        os.killpg(run.pid, enviroform.signal.SIGKILL)
+        run.wait()
+
+    known_args, other_args = enviroform.parse_args(fleet_flags + [
+        '--log-dir', str(tmp_path), '--jobs', '2', '--dry-run', '--quiet',
+        '--parallelism-budget', '7',
+        'fleet', 'plan',
+    ])
+    fleet = enviroform.Fleet(
+        enviroform.get_tf_cmd(), get_test_root_path(), known_args, other_args
+    )
+    with patch.object(enviroform.ResourceBudget, 'room', return_value=''):
+        assert fleet.run_fleet() == 0
+    log = (tmp_path / 'example-account__us-east-1__apps__example-app__default.log').read_text()  # NOQA
+    assert '-detailed-exitcode -parallelism=3\n' in log
+
+    # with no room, instances run one at a time
+    mutex, overlaps = tmp_path / 'busy', tmp_path / 'overlaps'
+    fake_tf = write_fake_tf(tmp_path, f'''
+[ "$1" = plan ] || exit 0
+mkdir {mutex} 2>/dev/null || echo overlap >> {overlaps}
+sleep 0.1
+rmdir {mutex}
+''')
+    known_args.dry_run = False
+    known_args.jobs = 3
+    fleet = enviroform.Fleet(
+        fake_tf, get_test_root_path(), known_args, other_args
+    )
+    fleet.process_args()
+    with patch.object(enviroform.ResourceBudget, 'room', return_value='low'), \
+            patch('enviroform.BUDGET_POLL_INTERVAL', 0.01):
+        results = fleet.schedule(fleet.select_instances())
+    assert [r.rc for r in results] == [0, 0, 0]
+    assert not overlaps.exists()
+
+
+def test_fail_fast(tmp_path):
+    """The first failure stops every running process group, orphans too."""
+    pids = tmp_path / 'pids'
+    fake_tf = write_fake_tf(tmp_path, f'''
+[ "$1" = plan ] || exit 0
+if [ "$(basename "$PWD")" = example-networking ]; then
+    sleep 0.5
+    exit 1
+fi
+trap '' INT
+sleep 30 &
+echo $! >> {pids}
+wait
+''')
+    known_args, other_args = enviroform.parse_args(fleet_flags + [
+        '--log-dir', str(tmp_path), '--jobs', '3', '--quiet', '--fail-fast',
+        '--interrupt-grace', '0.2', '--terminate-grace', '0.2',
+        'fleet', 'plan',
+    ])
+    fleet = enviroform.Fleet(
+        fake_tf, get_test_root_path(), known_args, other_args
+    )
+    fleet.process_args()
+    start = time.monotonic()
+    results = fleet.schedule(fleet.select_instances())
+    assert time.monotonic() - start < 10
+    assert [(r.rc, r.error.split(':')[0]) for r in results] == [
+        (1, 'Cancelled'), (1, 'Cancelled'), (1, 'Command failed with rc 1')
+    ]
+
+    def alive(pid):
+        try:
+            with open(f'/proc/{pid}/stat') as f:
+                return f.read().split()[2] != 'Z'
+        except OSError:
+            return False
+
+    assert len(pids.read_text().split()) == 2
+    assert not any(alive(pid) for pid in pids.read_text().split())
+
+
+def test_clone_data_dir(tmp_path, state_dir):
+    """Instances of a config are cloned from one warmed template."""
+    root_path = copy_example(tmp_path)
+    calls = tmp_path / 'calls'
+    fake_tf = write_fake_tf(tmp_path, f'''
+echo "$*" >> {calls}
+[ "$1" = init ] || exit 0
+mkdir -p "$TF_DATA_DIR/providers/null"
+if [ "$2" = -backend=false ]; then
+    [ -e .terraform.lock.hcl ] || echo lock > .terraform.lock.hcl
+    echo provider > "$TF_DATA_DIR/providers/null/terraform-provider-null"
+    echo '{{}}' > "$TF_DATA_DIR/modules.json"
+else
+    echo backend > "$TF_DATA_DIR/terraform.tfstate"
+fi
+''')
+
+    def run(tfvars):
+        known_args = copy.deepcopy(basic_args)
+        known_args.tfvars_file_path = known_args.tfvars_file_path.replace(
+            'default.tfvars', tfvars
+        )
+        known_args.isolate_data_dir = True
+        known_args.clone_data_dir = True
+        tf = enviroform.Enviroform(fake_tf, root_path, known_args, ['plan'])
+        assert tf.run().rc == 0
+        return tf
+
+    data_dirs = []
+    for tfvars in ['default.tfvars', 'experiment.tfvars']:
+        tf = run(tfvars)
+        data_dirs.append(tf.data_dir)
+
+    init_calls = [c for c in calls.read_text().split('\n') if c[:4] == 'init']
+    assert init_calls[0] == 'init -backend=false -input=false'
+    assert len(init_calls) == 3
+    assert all(c.endswith(' -get=false') for c in init_calls[1:])
+    template_dir = tf.template_dir()
+    provider = 'providers/null/terraform-provider-null'
+    inode = os.stat(os.path.join(template_dir, provider)).st_ino
+    for data_dir in data_dirs:
+        assert os.stat(os.path.join(data_dir, provider)).st_ino == inode
+        assert os.path.isfile(os.path.join(data_dir, 'modules.json'))
+        assert os.path.isfile(os.path.join(data_dir, 'terraform.tfstate'))
+    assert not os.path.exists(os.path.join(template_dir, 'terraform.tfstate'))
+
+    # the lock file the template's init wrote doesn't make a new template
+    def template_inits():
+        return calls.read_text().count('init -backend=false')
+
+    shutil.rmtree(data_dirs[0])
+    assert run('default.tfvars').template_dir() == template_dir
+    assert template_inits() == 1
+    # but a changed lock file warms it again
+    lock_path = tmp_path / basic_args.terraform_config_path / '.terraform.lock.hcl'  # NOQA
+    lock_path.write_text('provider "null" { version = "2" }\n')
+    shutil.rmtree(data_dirs[0])
+    run('default.tfvars')
+    assert template_inits() == 2
+
+
+def test_plan_summarizer():
+    """Changes are counted however the JSON is split across writes."""
+    plan = json.dumps({
+        'format_version': '1.2',
+        'resource_changes': [
+            {'type': 'aws_s3_bucket', 'change': {
+                'actions': ['create'],
+                'after': {'policy': '{"a": ["\\"}"]}', 'type': 'x'},
+            }},
+            {'type': 'aws_iam_role', 'change': {
+                'before': {'actions': ['delete']},
+                'actions': ['delete', 'create'],
+            }},
+            {'type': 'aws_iam_role', 'change': {'actions': ['no-op']}},
+            {'type': 'aws_s3_bucket', 'change': {'actions': ['update']}},
+        ],
+        'prior_state': {'resource_changes': [{'type': 'nope'}]},
+    }, indent=2)
+    for size in [1, 3, 64, len(plan)]:
+        summarizer = enviroform.PlanSummarizer()
+        for i in range(0, len(plan), size):
+            summarizer.write(plan[i:i + size])
+        assert summarizer.summary() == {
+            'create': 1, 'update': 1, 'replace': 1, 'delete': 0,
+            'by_type': {
+                'aws_iam_role': {'replace': 1},
+                'aws_s3_bucket': {'create': 1, 'update': 1},
+            },
+        }
+
+
+def test_fleet_summary(tmp_path, capsys):
+    """--summarize reports each instance's and the fleet's changes."""
+    plan_json = tmp_path / 'plan.json'
+    plan_json.write_text(json.dumps({'resource_changes': [
+        {'type': 'null_resource', 'change': {'actions': ['create']}},
+        {'type': 'null_resource', 'change': {'actions': ['delete']}},
+    ]}))
+    fake_tf = write_fake_tf(tmp_path, f'''
+case "$1" in
+    plan) [ "$(basename "$PWD")" = example-app ] && exit 2; exit 0;;
+    show) [ "$2" = -json ] && cat {plan_json};;
+esac
+''')
+    known_args, other_args = enviroform.parse_args(fleet_flags + [
+        '--log-dir', str(tmp_path), '--quiet', '--summarize',
+        'fleet', 'plan',
+    ])
+    fleet = enviroform.Fleet(
+        fake_tf, get_test_root_path(), known_args, other_args
+    )
+    assert fleet.run_fleet() == 0
+    out = capsys.readouterr().out
+    assert 'Plan summary: 2 to create, 0 to update, 0 to replace, 2 to delete across 3 instances' in out  # NOQA
+    assert 'null_resource        2        0        0        2' in out
+    log = (tmp_path / 'example-account__us-east-1__apps__example-app__default.log').read_text()  # NOQA
+    assert 'Plan summary: 1 to create, 0 to update, 0 to replace, 1 to delete' in log  # NOQA
+    with open(enviroform.get_journal_path(get_test_root_path(), fleet.run_id)) as f:  # NOQA
+        summaries = [
+            r['summary'] for r in map(json.loads, f) if 'summary' in r
+        ]
+    assert sorted(s['delete'] for s in summaries) == [0, 1, 1]
+
+
+def test_drift_history(tmp_path, capsys):
+    """Runs are recorded; drift orders and budgets instances by them."""
+    fake_tf = write_fake_tf(tmp_path, '''
+[ "$1" = plan ] && [ "$(basename "$PWD")" = example-app ] && exit 2
+exit 0
+''')
+    known_args, other_args = enviroform.parse_args(fleet_flags + [
+        '--log-dir', str(tmp_path), '--quiet', 'fleet', 'plan',
+    ])
+    fleet = enviroform.Fleet(
+        fake_tf, get_test_root_path(), known_args, other_args
+    )
+    assert fleet.run_fleet() == 0
+    path = enviroform.get_history_path(get_test_root_path())
+    history = enviroform.HistoryStore(path)
+    stats = history.instances('plan')
+    assert {
+        label.split('/')[3]: s.stable_runs for label, s in stats.items()
+    } == {'example-app': 0, 'example-networking': 1}
+    app = 'example-account/us-east-1/apps/example-app/default'
+    phases = json.loads(history.db.execute(
+        'SELECT phases FROM runs WHERE label = ?', (app,)
+    ).fetchone()[0])
+    assert {'init', 'plan'} <= set(phases)
+    history.close()
+
+    known_args, other_args = enviroform.parse_args(fleet_flags + [
+        '--jobs', '1', '--time-budget', '50', 'fleet', 'drift',
+    ])
+    fleet = enviroform.Fleet(
+        fake_tf, get_test_root_path(), known_args, other_args
+    )
+    fleet.process_args()
+    assert fleet.tf_command == 'plan'
+    a, b, c, new = [
+        enviroform.Instance('e', 'r', 't', name, 'i', '', '')
+        for name in 'abcd'
+    ]
+    history = {
+        'e/r/t/a/i': enviroform.InstanceHistory(10, 0, 3),
+        'e/r/t/b/i': enviroform.InstanceHistory(30, 5, 1),
+        'e/r/t/c/i': enviroform.InstanceHistory(5, 5, 2),
+    }
+    # the never planned instance and the changing one come first, then
+    # the stable one checked least recently, until the budget is full
+    instances, stable = fleet.drift_order([a, b, c, new], history)
+    assert [i.config_name for i in instances] == ['d', 'a', 'c']
+    assert stable == [b]
+    fleet.time_budget = None
+    instances, stable = fleet.drift_order([a, b, c, new], history)
+    assert [i.config_name for i in instances] == ['d', 'b', 'a', 'c']
+
+    capsys.readouterr()
+    known_args, other_args = enviroform.parse_args(['history', 'slowest'])
+    assert enviroform.history_main(
+        get_test_root_path(), known_args, other_args
+    ) == 0
+    assert len(capsys.readouterr().out.splitlines()) == 4
+
+
+def test_shard_instances(tmp_path, capsys):
+    """Shards balance expected time, keeping configs together."""
+    instances = [
+        enviroform.Instance('e', 'r', 't', config, name, '', config)
+        for config, names in [('big', 'abcd'), ('mid', 'ab'), ('new', 'a')]
+        for name in names
+    ]
+    durations = {
+        'e/r/t/big/a': 40, 'e/r/t/big/b': 30, 'e/r/t/big/c': 20,
+        'e/r/t/big/d': 10, 'e/r/t/mid/a': 20, 'e/r/t/mid/b': 20,
+    }
+    shards = [
+        enviroform.shard_instances(instances, n, 3, durations)
+        for n in [1, 2, 3]
+    ]
+    assert sorted(i.label for s in shards for i in s) == \
+        sorted(i.label for i in instances)
+    # 'big' is more than a fair share (160 / 3), so it is split;
+    # 'new' has no history and is expected to take the mean, 23.3
+    assert [[i.label[6:] for i in s] for s in shards] == [
+        ['big/b', 'big/c'], ['big/a', 'new/a'], ['big/d', 'mid/a', 'mid/b'],
+    ]
+    # a dependency holds instances, and their configs, together
+    graph = {'e/r/t/new/a': {'e/r/t/mid/b'}}
+    shards = [
+        enviroform.shard_instances(instances, n, 2, durations, graph)
+        for n in [1, 2]
+    ]
+    together = [s for s in shards if 'e/r/t/new/a' in [i.label for i in s]]
+    assert [i.label[6:] for i in together[0] if i.config_name != 'big'] == [
+        'mid/a', 'mid/b', 'new/a'
+    ]
+    # a graph without edges splits configs like no graph at all
+    wide = [
+        enviroform.Instance('e', 'r', 't', config, name, '', config)
+        for config, names in [('big', 'abcdefgh'), ('other', 'a')]
+        for name in names
+    ]
+    for graph in [None, {i.label: set() for i in wide}]:
+        assert [len(enviroform.shard_instances(wide, n, 4, {}, graph))
+                for n in [1, 2, 3, 4]] == [3, 2, 2, 2]
+
+    durations_path = tmp_path / 'durations.json'
+    durations_path.write_text(json.dumps({
+        'example-account/us-east-1/apps/example-app/default': 50,
+        'example-account/us-east-1/apps/example-app/experiment': 50,
+        'example-account/us-east-1/infra/example-networking/default': 100,
+    }))
+    labels = []
+    for n in [1, 2]:
+        known_args, other_args = enviroform.parse_args(fleet_flags + [
+            '--shard', f'{n}/2', '--durations', str(durations_path),
+            'fleet', 'plan',
+        ])
+        fleet = enviroform.Fleet(
+            '/bin/false', get_test_root_path(), known_args, other_args
+        )
+        fleet.process_args()
+        labels.append([i.label for i in fleet.select_instances()])
+    assert labels == [
+        ['example-account/us-east-1/apps/example-app/default',
+         'example-account/us-east-1/apps/example-app/experiment'],
+        ['example-account/us-east-1/infra/example-networking/default'],
+    ]
+
+    # without --durations, each node's own history must not matter
+    labels = []
+    for n in [1, 2]:
+        known_args, other_args = enviroform.parse_args(fleet_flags + [
+            '--shard', f'{n}/2', 'fleet', 'plan',
+        ])
+        fleet = enviroform.Fleet(
+            '/bin/false', get_test_root_path(), known_args, other_args
+        )
+        fleet.process_args()
+        with patch('enviroform.HistoryStore') as history:
+            labels.extend(i.label for i in fleet.select_instances())
+            assert not history.called
+    assert sorted(labels) == [
+        'example-account/us-east-1/apps/example-app/default',
+        'example-account/us-east-1/apps/example-app/experiment',
+        'example-account/us-east-1/infra/example-networking/default',
+    ]
+    assert capsys.readouterr().out == ''
+
+
+def test_warm_provider_mirror(tmp_path, state_dir, capsys):
+    """warm mirrors each locked provider once, then init uses it."""
+    package = b'not really a zip'
+    digest = hashlib.sha256(package).hexdigest()
+    requests = []
+
+    class Registry(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            requests.append(self.path)
+            body = {
+                '/.well-known/terraform.json': json.dumps(
+                    {'providers.v1': '/v1/providers/'}
+                ).encode(),
+                '/v1/providers/hashicorp/null/3.2.1/download/linux/amd64':
+                    json.dumps({
+                        'download_url': '/null.zip', 'shasum': digest,
+                    }).encode(),
+                '/null.zip': package,
+            }.get(self.path)
+            self.send_response(200 if body else 404)
+            self.end_headers()
+            self.wfile.write(body or b'')
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Registry)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    root_path = copy_example(tmp_path)
+    lock = f'''
+provider "registry.terraform.io/hashicorp/null" {{
+  version     = "3.2.1"
+  constraints = "~> 3.0"
+  hashes = [
+    "h1:FbGfc+muBsC17Ohy5g806iuI1hQc4SIexpYCrQHQd8w=",
+    "zh:{digest}",
+  ]
+}}
+'''
+    for config in ['apps/example-app', 'infra/example-networking']:
+        with open(os.path.join(
+            root_path, 'example/terraform', config, '.terraform.lock.hcl'
+        ), 'w') as f:
+            f.write(lock)
+    known_args, other_args = enviroform.parse_args([
+        '--terraform-dir', 'example/terraform', '--platform', 'linux_amd64',
+        '--registry-url', f'http://127.0.0.1:{server.server_port}', 'warm',
+    ])
+    try:
+        assert enviroform.warm_main(root_path, known_args, other_args) == 0
+        # again: nothing left to download
+        assert enviroform.warm_main(root_path, known_args, other_args) == 0
+        assert requests.count('/null.zip') == 1
+        with open(state_dir / 'provider-mirror/registry.terraform.io/hashicorp/null/terraform-provider-null_3.2.1_linux_amd64.zip', 'rb') as f:  # NOQA
+            assert f.read() == package
+        config = (state_dir / 'provider-mirror.tfrc').read_text()
+        assert 'include = ["registry.terraform.io/*/*"]' in config
+        home = tmp_path / 'home'
+        home.mkdir()
+
+        def cli_config():
+            tf = enviroform.Enviroform(
+                'terraform', root_path, copy.copy(basic_args), ['plan']
+            )
+            with patch('enviroform.current_platform',
+                       return_value='linux_amd64'):
+                tf.process_args()
+            return tf.environ.get('TF_CLI_CONFIG_FILE')
+
+        with patch.dict(os.environ, {'HOME': str(home)}):
+            os.environ.pop('TF_CLI_CONFIG_FILE', None)
+            assert cli_config() == str(state_dir / 'provider-mirror.tfrc')
+            # your own CLI config is kept, e.g. registry credentials
+            (home / '.terraformrc').write_text(
+                'credentials "app.terraform.io" {\n  token = "x"\n}\n'
+            )
+            path = cli_config()
+            assert os.path.dirname(path) == str(
+                state_dir / 'provider-mirror-configs'
+            )
+            assert os.stat(path).st_mode & 0o777 == 0o600
+            with open(path) as f:
+                content = f.read()
+            assert content.index('credentials "app') < \
+                content.index('provider_installation {')
+            # unless it installs providers its own way
+            (home / '.terraformrc').write_text(
+                'provider_installation {\n  direct {}\n}\n'
+            )
+            assert cli_config() is None
+
+        # a package not matching the lock file's hashes is refused
+        shutil.rmtree(state_dir / 'provider-mirror')
+        package = b'tampered'
+        digest = hashlib.sha256(package).hexdigest()
+        assert enviroform.warm_main(root_path, known_args, other_args) == 1
+        assert 'is not in the lock files' in capsys.readouterr().out
+    finally:
+        server.shutdown()
+
+
+def test_export_jobs(tmp_path, capsys):
+    """export compiles each instance's steps into a job graph."""
+    fake_tf = write_fake_tf(tmp_path, f'''
+echo "$TF_DATA_DIR $@" >> {tmp_path}/calls
+[ "$1" = plan ] && exit 2
+exit 0
+''')
+    known_args, other_args = enviroform.parse_args(fleet_flags + [
+        '--filter', '*/apps/*', 'export', 'plan',
+    ])
+    assert enviroform.export_main(
+        fake_tf, get_test_root_path(), known_args, other_args
+    ) == 0
+    export = json.loads(capsys.readouterr().out)
+    assert export['command'] == ['plan']
+    jobs = {job['id']: job for job in export['jobs']}
+    plan = jobs['example-account/us-east-1/apps/example-app/default/plan']
+    assert plan['deps'] == [
+        'example-account/us-east-1/apps/example-app/default/init'
+    ]
+    assert plan['argv'][:2] == [fake_tf, 'plan']
+    assert '-detailed-exitcode' in plan['argv']
+    assert plan['expected_rcs'] == [0, 2]
+    assert plan['cwd'].endswith('example/terraform/apps/example-app')
+    assert plan['env']['TF_DATA_DIR'].endswith(
+        'data/example-account/us-east-1/apps/example-app/default'
+    )
+    init = jobs['example-account/us-east-1/apps/example-app/default/init']
+    assert init['pool'] == 'plugin-cache'
+    assert len(jobs) == 6
+
+    # the Makefile runs without enviroform, plan's rc 2 is a success
+    makefile = tmp_path / 'Makefile'
+    known_args, other_args = enviroform.parse_args(fleet_flags + [
+        '--filter', '*/apps/*', '--format', 'make',
+        '--output', str(makefile), 'export', 'plan',
+    ])
+    enviroform.export_main(
+        fake_tf, get_test_root_path(), known_args, other_args
+    )
+    subprocess.run(
+        ['make', '-s', '-j4', '-f', str(makefile)], check=True,
+        stdout=subprocess.DEVNULL
+    )
+    calls = (tmp_path / 'calls').read_text().splitlines()
+    assert sorted(call.split()[1] for call in calls) == \
+        ['init', 'init', 'plan', 'plan']
+    # its var file would be written between commands, by enviroform
+    known_args, other_args = enviroform.parse_args(fleet_flags + [
+        '--upstream-outputs', 'export', 'plan',
+    ])
+    with pytest.raises(SystemExit, match='--upstream-outputs works'):
+        enviroform.export_main(
+            fake_tf, get_test_root_path(), known_args, other_args
+        )
+
+
+def test_upstream_outputs(tmp_path, state_dir, capsys):
+    """Upstream outputs are read once, cached, and passed as a var file."""
+    root_path = copy_example(tmp_path)
+    with open(tmp_path / 'example/environments/example-account/us-east-1/apps/example-app/default.tfvars', 'a') as f:  # NOQA
+        f.write('\n# enviroform: depends_on infra/example-networking/default\n')  # NOQA
+    fake_tf = write_fake_tf(tmp_path, f'''
+if [ "$1" = output ]; then
+    echo output >> {tmp_path}/reads
+    echo '{{"vpc_id": {{"value": "vpc-1", "type": "string"}}}}'
+fi
+exit 0
+''')
+    args = copy.copy(basic_args)
+    args.upstream_outputs = True
+
+    def plan():
+        result = enviroform.Enviroform(
+            fake_tf, root_path, copy.copy(args), ['plan']
+        ).run()
+        assert result.rc == 0, result.error
+        return result
+
+    for _ in range(2):
+        result = plan()
+    assert (tmp_path / 'reads').read_text() == 'output\n'
+    var_file = [
+        arg for arg in result.commands[-1] if '/outputs/vars/' in arg
+    ][0].split('=', 1)[1]
+    with open(var_file) as f:
+        assert json.load(f) == {'upstream_outputs': {
+            'infra/example-networking/default': {'vpc_id': 'vpc-1'}
+        }}
+    assert oct(os.stat(var_file).st_mode & 0o777) == '0o600'
+
+    # applying the upstream instance drops its cached outputs
+    net_args = copy.copy(basic_args)
+    net_args.terraform_config_path = 'example/terraform/infra/example-networking'  # NOQA
+    net_args.tfvars_file_path = 'example/environments/example-account/us-east-1/infra/example-networking/default.tfvars'  # NOQA
+    assert enviroform.Enviroform(
+        fake_tf, root_path, net_args, ['apply', '-auto-approve']
+    ).run().rc == 0
+    plan()
+    assert (tmp_path / 'reads').read_text() == 'output\n' * 2
+
+    capsys.readouterr()
+    known_args, other_args = enviroform.parse_args([
+        '--environments-dir', 'example/environments',
+        '--terraform-dir', 'example/terraform',
+        '--filter', '*/infra/*', 'outputs', 'vpc_id',
+    ])
+    assert enviroform.outputs_main(
+        fake_tf, root_path, known_args, other_args
+    ) == 0
+    assert json.loads(capsys.readouterr().out) == {
+        'example-account/us-east-1/infra/example-networking/default': 'vpc-1'
+    }
+    assert (tmp_path / 'reads').read_text() == 'output\n' * 2
+
+
+def test_merge_tfvars(tmp_path, state_dir):
+    """--merge-tfvars passes one cached bundle of the merged var files."""
+    assert enviroform.TfvarsParser('''
+# comment
+name = "a" // comment
+sizes = [1, 2.5,
+  3,]
+tags = {
+  team = "x"
+  "cost-center": null, enabled = true
+}
+motd = <<-EOT
+    hello
+    EOT
+literal = "$${not_interpolated}"
+''').parse() == {
+        'name': 'a', 'sizes': [1, 2.5, 3], 'motd': 'hello\n',
+        'tags': {'team': 'x', 'cost-center': None, 'enabled': True},
+        'literal': '${not_interpolated}',
+    }
+    for expression in ['var.x', '"${var.x}"', '1 + 2', 'max(1, 2)']:
+        with pytest.raises(ValueError):
+            enviroform.TfvarsParser(f'a = {expression}').parse()
+
+    root_path = copy_example(tmp_path)
+    args = copy.copy(basic_args)
+    args.merge_tfvars = True
+    args.dry_run = True
+
+    def plan(tfvars_file_path=basic_args.tfvars_file_path):
+        args.tfvars_file_path = tfvars_file_path
+        result = enviroform.Enviroform(
+            'terraform', root_path, copy.copy(args), ['plan']
+        ).run()
+        assert result.rc == 0, result.error
+        return [a for a in result.commands[-1] if a.startswith('-var-file')]
+
+    var_files = plan()
+    assert len(var_files) == 1
+    with open(var_files[0].split('=', 1)[1]) as f:
+        assert json.load(f) == {
+            'env_name': 'dev', 'aws_region': 'us-east-1',
+            'tf_state_bucket': 'myservice-us-east-1-prod-tf-state-bucket',
+            'app_name': 'example-app', 'task_count': 1,
+        }
+    with patch('enviroform.merge_tfvars') as merge:
+        assert plan() == var_files
+        assert not merge.called
+    # the instance overrides the environment
+    region = tmp_path / 'example/environments/example-account/us-east-1/region.tfvars'  # NOQA
+    with open(region, 'a') as f:
+        f.write('app_name = "from-region"\ntask_count = 2\n')
+    with open(plan()[0].split('=', 1)[1]) as f:
+        bundle = json.load(f)
+    assert (bundle['app_name'], bundle['task_count']) == ('example-app', 1)
+    # what can't be merged is passed as it is
+    with open(region, 'a') as f:
+        f.write('zones = ["${local.zone}"]\n')
+    assert len(plan()) == 3
+
+
+def test_daemon(tmp_path, state_dir):
+    """The daemon runs requests once, however many clients ask at once."""
+    calls = tmp_path / 'calls'
+    fake_tf = write_fake_tf(tmp_path, f'''
+[ "$1" = apply ] && sleep 0.5
+echo "$1" >> {calls}
+echo "terraform $1 in $TF_DATA_DIR"
+''')
+    socket_path = str(tmp_path / 'daemon.sock')
+    daemon = enviroform.Daemon(get_test_root_path(), socket_path)
+    server = threading.Thread(target=daemon.serve)
+    server.start()
+    while not os.path.exists(socket_path):
+        time.sleep(0.01)
+    argv = [
+        '-t', basic_args.terraform_config_path,
+        '-z', basic_args.tfvars_file_path,
+        'apply', '-auto-approve',
+    ]
+    env = dict(os.environ, TERRAFORM_EXECUTABLE=fake_tf)
+    outputs = [io.StringIO(), io.StringIO()]
+    rcs = []
+    clients = [
+        threading.Thread(target=lambda out=out: rcs.append(
+            enviroform_client.request(socket_path, argv, env, out)
+        ))
+        for out in outputs
+    ]
+    try:
+        for client in clients:
+            client.start()
+            time.sleep(0.1)
+        for client in clients:
+            client.join()
+        assert rcs == [0, 0]
+        assert calls.read_text() == 'init\napply\n'
+        for out in outputs:
+            assert 'terraform apply' in out.getvalue()
+        assert outputs[0].getvalue() == outputs[1].getvalue()
+        assert f'in {state_dir}/data/' in outputs[0].getvalue()
+        # fleet runs, and questions for the user, are handed back
+        assert enviroform_client.request(
+            socket_path, ['fleet', 'plan'], env, io.StringIO()
+        ) is None
+        assert enviroform_client.request(
+            socket_path, argv[:-1], env, io.StringIO()
+        ) is None
+    finally:
+        with socket.socket(socket.AF_UNIX) as client:
+            client.connect(socket_path)
+            client.sendall(b'{"stop": true}\n')
+            client.makefile().readline()
+        server.join()
+    assert not os.path.exists(socket_path)
+
+    # output all followers were sent is dropped, beyond what is kept
+    job = enviroform.DaemonJob()
+    with patch('enviroform.DAEMON_OUTPUT_KEEP', 10):
+        follower = job.follow()
+        for n in range(5):
+            job.write(f'line {n}\n')
+            assert next(follower) == f'line {n}\n'
+        assert list(job.chunks) == ['line 4\n']
+        late = job.follow()
+        assert next(late) == '[28 characters of earlier output dropped]\n'
+        job.finish(0)
+        assert list(late) == ['line 4\n']
+        assert list(follower) == []